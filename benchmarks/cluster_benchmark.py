@@ -0,0 +1,236 @@
+""" End to end throughput and latency of a localhost cluster under YCSB style workloads: python -m benchmarks.cluster_benchmark """
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import sys
+import time
+from socket import timeout as SocketTimeout
+from threading import Thread
+
+from schema.kv_store import KVStoreRequest, Action, Consistency
+from kv_store_server import KVStoreServer
+from kv_store_async_server import AsyncKVStoreServer
+from kv_store_client import KVStoreClient
+from service_discovery import ServiceDiscovery
+from raft_config import RaftConfig
+from benchmarks.server_benchmark import connect, call, percentile
+
+MODES = {'threads': KVStoreServer, 'asyncio': AsyncKVStoreServer}
+# fraction of reads in the YCSB core workloads, the rest are updates
+WORKLOADS = {'a': 0.5, 'b': 0.95, 'c': 1.0, 'w': 0.0}
+
+class LocalDiscovery(ServiceDiscovery):
+    """ n servers on localhost from base_port, kv port base_port + 10n and raft port one above it """
+    def __init__(self, n, base_port):
+        self.SERVERS = {x: ('localhost', base_port + 10 * x) for x in range(n)}
+        self.leader = None
+
+    def select_random_server(self):
+        # clients go straight to the leader once known, saving a redirect per client
+        if self.leader is not None:
+            return self.SERVERS[self.leader]
+        return super().select_random_server()
+
+class ZipfianGenerator:
+    """ YCSB's zipfian generator (Gray et al.), item 0 is the most popular """
+    def __init__(self, items, theta=0.99, rng=random):
+        self.items = items
+        self.theta = theta
+        self.rng = rng
+        self.zetan = sum(1 / (i ** theta) for i in range(1, items + 1))
+        zeta2 = 1 + 1 / (2 ** theta)
+        self.alpha = 1 / (1 - theta)
+        self.eta = (1 - (2 / items) ** (1 - theta)) / (1 - zeta2 / self.zetan)
+
+    def next(self):
+        u = self.rng.random()
+        uz = u * self.zetan
+        if uz < 1:
+            return 0
+        if uz < 1 + 0.5 ** self.theta:
+            return 1
+        return int(self.items * (self.eta * u - self.eta + 1) ** self.alpha)
+
+class UniformGenerator:
+    def __init__(self, items, rng=random):
+        self.items = items
+        self.rng = rng
+
+    def next(self):
+        return self.rng.randrange(self.items)
+
+def key_generator(distribution, items, rng):
+    if distribution == 'zipfian':
+        return ZipfianGenerator(items, rng=rng)
+    return UniformGenerator(items, rng)
+
+def serve(mode, n, discovery, args):
+    logging.disable(logging.ERROR)
+    server = MODES[mode].build_distributed_store(
+        n, discovery.get_addr(n), discovery.get_raft_config(1), workers=args.workers,
+        raft_config=RaftConfig(lease_reads=args.lease_reads, transport=args.transport))
+    server.start()
+
+def find_leader(discovery, deadline=15.0):
+    start = time.perf_counter()
+    while time.perf_counter() - start < deadline:
+        for n, addr in discovery.get_server_config().items():
+            try:
+                sock = connect(addr, 1.0)
+                try:
+                    if call(sock, KVStoreRequest(Action.SET, "warmup", "1")).is_success():
+                        return n
+                finally:
+                    sock.close()
+            except (OSError, IOError):
+                pass
+        time.sleep(0.1)
+    raise Exception("No leader elected")
+
+def load(discovery, keys, value):
+    # one mset per log entry, kept well under the 8k raft datagram
+    batch = max(1, 4096 // (len(value) + 16))
+    client = KVStoreClient(discovery)
+    for first in range(0, keys, batch):
+        names = [f"user{x}" for x in range(first, min(keys, first + batch))]
+        client.send_message(KVStoreRequest(Action.MSET, names, [value] * len(names)))
+    client.end()
+
+def connect_client(discovery, addr, timeout, deadline):
+    """ A client of addr, or of any live server when addr is None, None if none answered before deadline """
+    while time.perf_counter() < deadline:
+        try:
+            client = KVStoreClient(discovery, addr)
+        except Exception:
+            # every server refused, they may be restarting or electing a leader
+            time.sleep(0.1)
+            continue
+        client.sock.settimeout(timeout)
+        return client
+    return None
+
+def run_client(discovery, args, seed, deadline, results):
+    rng = random.Random(seed)
+    keys = key_generator(args.distribution, args.keys, rng)
+    value = 'v' * args.value_size
+    latencies = {'read': [], 'update': []}
+    errors = 0
+    # updates and strong reads go to the leader, bounded and any reads to a server picked per client
+    addrs = {'update': None, 'read': None}
+    if args.consistency != 'strong':
+        addrs['read'] = discovery.get_addr(seed % args.servers)
+    clients = {}
+    try:
+        while time.perf_counter() < deadline:
+            key = f"user{keys.next()}"
+            if rng.random() < args.read_ratio:
+                op, request = 'read', KVStoreRequest(Action.GET, key, consistency=Consistency[args.consistency.upper()])
+            else:
+                op, request = 'update', KVStoreRequest(Action.SET, key, value)
+            addr = addrs[op]
+            client = clients.get(addr)
+            if client is None:
+                client = connect_client(discovery, addr, args.timeout, deadline)
+                if client is None:
+                    break
+                clients[addr] = client
+            start = time.perf_counter()
+            try:
+                response = client.send_message(request)
+            except (SocketTimeout, OSError, IOError):
+                # the connection may hold a late response, start over on a fresh one
+                errors += 1
+                client.end()
+                del clients[addr]
+                continue
+            if response.is_success() or response.is_not_found():
+                latencies[op].append(time.perf_counter() - start)
+            else:
+                errors += 1
+    finally:
+        for client in clients.values():
+            client.end()
+        results.append((latencies, errors))
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'ops': 0}
+    return {
+        'ops': len(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1e3,
+        'p99_ms': percentile(latencies, 0.99) * 1e3,
+        'p999_ms': percentile(latencies, 0.999) * 1e3,
+    }
+
+def run(args):
+    discovery = LocalDiscovery(args.servers, args.port)
+    processes = [
+        multiprocessing.Process(
+            target=serve, args=[args.mode, n, discovery, args], daemon=True)
+        for n in range(args.servers)]
+    for process in processes:
+        process.start()
+    try:
+        discovery.leader = find_leader(discovery)
+        load(discovery, args.keys, 'v' * args.value_size)
+        results = []
+        deadline = time.perf_counter() + args.duration
+        clients = [
+            Thread(target=run_client, args=[discovery, args, args.seed + n, deadline, results])
+            for n in range(args.clients)]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        # raft threads are not daemons, the servers only go away when killed
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+    by_op = {op: [x for latencies, _ in results for x in latencies[op]] for op in ('read', 'update')}
+    total = summarize(by_op['read'] + by_op['update'])
+    return {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'ops_per_sec': total['ops'] / elapsed,
+        'errors': sum(errors for _, errors in results),
+        'latency': dict(total, **{op: summarize(values) for op, values in by_op.items() if values}),
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--servers', type=int, default=3)
+    parser.add_argument('--mode', choices=sorted(MODES), default='threads')
+    parser.add_argument('--workload', choices=sorted(WORKLOADS), default='a',
+        help="YCSB mix: a 50%% reads, b 95%%, c read only, w write only")
+    parser.add_argument('--read-ratio', type=float, default=None, help="overrides the workload's read fraction")
+    parser.add_argument('--distribution', choices=['uniform', 'zipfian'], default='zipfian')
+    parser.add_argument('--consistency', choices=[c.name.lower() for c in Consistency], default='strong')
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--value-size', type=int, default=100)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=2.0)
+    parser.add_argument('--lease-reads', action='store_true')
+    parser.add_argument('--transport', choices=['udp', 'tcp'], default='udp')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=26000)
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    if args.read_ratio is None:
+        args.read_ratio = WORKLOADS[args.workload]
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        sys.stdout.write(report + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+""" Compare the binary raft codec with the pickle format it replaced: python -m benchmarks.codec_benchmark """
+import argparse
+import timeit
+import uuid
+try:
+   import cPickle as pickle
+except:
+   import pickle
+
+from schema.base_schema import BaseSchema
+from schema.raft_log import LogEntry
+from schema.raft_rpc import AppendEntries, AppendEntriesResponse, RequestVote
+
+def pickle_serialize(msg):
+    return BaseSchema.serialize(msg)
+
+def pickle_deserialize(raw):
+    return pickle.loads(raw[1:])
+
+def build_append_entries(n, value_size):
+    entries = [LogEntry(7, f"{uuid.uuid4()}2key{x}>{'v' * value_size}") for x in range(n)]
+    return AppendEntries(7, 0, 7, 1000, 990, entries)
+
+def follower_append(deserialize, raw):
+    # what a follower does with an AppendEntries: decode it and encode its entries for the log
+    msg = deserialize(raw)
+    return [entry.encode() for entry in msg.entries]
+
+def bench(label, fn, number):
+    seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    return label, seconds * 1e6
+
+def run(entries, value_size, number):
+    messages = {
+        'AppendEntries(0)': build_append_entries(0, value_size),
+        f'AppendEntries({entries})': build_append_entries(entries, value_size),
+        'AppendEntriesResponse': AppendEntriesResponse(True, 2, 1000),
+        'RequestVote': RequestVote(7, 1, 1000, 6),
+    }
+    rows = []
+    for name, msg in messages.items():
+        raw_pickle = pickle_serialize(msg)
+        raw_codec = msg.serialize()
+        cls = type(msg)
+        results = [
+            bench('pickle encode', lambda: pickle_serialize(msg), number),
+            bench('codec encode', lambda: msg.serialize(), number),
+            bench('pickle decode', lambda: pickle_deserialize(raw_pickle), number),
+            bench('codec decode', lambda: cls.deserialize(raw_codec), number),
+        ]
+        if isinstance(msg, AppendEntries) and msg.entries:
+            results.append(bench('pickle follower append', lambda: follower_append(pickle_deserialize, raw_pickle), number))
+            results.append(bench('codec follower append', lambda: follower_append(cls.deserialize, raw_codec), number))
+        rows.append((name, len(raw_pickle), len(raw_codec), results))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=64)
+    parser.add_argument('--value-size', type=int, default=32)
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+    for name, pickle_size, codec_size, results in run(args.entries, args.value_size, args.number):
+        print(f"{name}: {pickle_size} bytes pickled, {codec_size} bytes encoded")
+        for label, micros in results:
+            print(f"    {label:<24} {micros:10.2f} us")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+""" Connections held open versus request latency, thread pool and asyncio servers: python -m benchmarks.server_benchmark """
+import argparse
+import logging
+import multiprocessing
+import time
+from socket import socket, AF_INET, SOCK_STREAM, timeout as SocketTimeout
+from threading import Thread
+
+from library.messages import send_message, recv_message
+from schema.kv_store import KVStoreRequest, KVStoreResponse, Action, Consistency
+from kv_store_server import KVStoreServer
+from kv_store_async_server import AsyncKVStoreServer
+
+MODES = {'threads': KVStoreServer, 'asyncio': AsyncKVStoreServer}
+
+def serve(mode, kv_addr, raft_addr, workers):
+    logging.disable(logging.ERROR)
+    server = MODES[mode].build_distributed_store(0, kv_addr, {0: raft_addr}, workers=workers)
+    server.start()
+
+def connect(addr, timeout):
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(addr)
+    return sock
+
+def call(sock, request):
+    send_message(sock, request.serialize())
+    return KVStoreResponse.deserialize(recv_message(sock))
+
+def wait_for_leader(addr, deadline=10.0):
+    start = time.perf_counter()
+    while time.perf_counter() - start < deadline:
+        try:
+            sock = connect(addr, 1.0)
+            try:
+                if call(sock, KVStoreRequest(Action.SET, "warmup", "1")).is_success():
+                    return
+            finally:
+                sock.close()
+        except (OSError, IOError):
+            pass
+        time.sleep(0.1)
+    raise Exception(f"No leader at {addr}")
+
+def hold(addr, sockets, n, timeout):
+    # a held connection has sent a request, so the thread pool server dedicates a worker to it
+    for _ in range(n):
+        try:
+            sock = connect(addr, timeout)
+        except (OSError, IOError):
+            # out of file descriptors or local ports, report what could be held
+            return
+        send_message(sock, KVStoreRequest(Action.GET, "warmup", consistency=Consistency.ANY).serialize())
+        sockets.append(sock)
+
+def active_client(addr, requests, timeout, latencies, failures):
+    try:
+        sock = connect(addr, timeout)
+    except (OSError, IOError):
+        failures.append(requests)
+        return
+    for x in range(requests):
+        request = KVStoreRequest(Action.SET, f"key{x}", "value") if x % 2 else KVStoreRequest(Action.GET, f"key{x - 1}")
+        start = time.perf_counter()
+        try:
+            call(sock, request)
+        except (SocketTimeout, OSError, IOError):
+            # a stuck connection fails everything queued behind it
+            failures.append(requests - x)
+            break
+        latencies.append(time.perf_counter() - start)
+    sock.close()
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+def run_mode(mode, args, port):
+    kv_addr, raft_addr = ('localhost', port), ('localhost', port + 1)
+    process = multiprocessing.Process(target=serve, args=[mode, kv_addr, raft_addr, args.workers], daemon=True)
+    process.start()
+    rows = []
+    held = []
+    try:
+        wait_for_leader(kv_addr)
+        for connections in args.connections:
+            hold(kv_addr, held, connections - len(held), args.timeout)
+            latencies, failures = [], []
+            clients = [
+                Thread(target=active_client, args=[kv_addr, args.requests, args.timeout, latencies, failures])
+                for _ in range(args.clients)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            latencies.sort()
+            rows.append((len(held), len(latencies), sum(failures), percentile(latencies, 0.5), percentile(latencies, 0.99)))
+    finally:
+        for sock in held:
+            sock.close()
+        process.terminate()
+        process.join()
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, nargs='+', default=[0, 8, 64, 512, 2048])
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=1.0)
+    parser.add_argument('--port', type=int, default=25000)
+    args = parser.parse_args()
+    for n, mode in enumerate(MODES):
+        print(f"{mode} (workers={args.workers})")
+        for connections, ok, failed, p50, p99 in run_mode(mode, args, args.port + 10 * n):
+            print(f"    {connections:>6} held: {ok:>5} ok {failed:>5} failed  p50 {p50 * 1e3:8.2f} ms  p99 {p99 * 1e3:8.2f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import asyncio
+
+from schema.kv_store import KVStoreResponse
+from library.messages import frame, recv_message_async
+
+class AsyncKVStoreClient:
+    """
+    asyncio client keeping many requests outstanding on one connection.
+    Responses are matched back to their request by id, in whatever order the server answers.
+    """
+    MAX_REDIRECTS = 3
+
+    def __init__(self, service_discovery):
+        self.service_discovery = service_discovery
+        # request id -> [request, future, redirects, writer it was sent on]
+        self._pending = {}
+        self._writers = []
+        self._writer = None
+        self.server_addr = None
+
+    @classmethod
+    async def connect(cls, service_discovery, addr=None):
+        client = AsyncKVStoreClient(service_discovery)
+        addr = addr if addr is not None else service_discovery.select_random_server()
+        client._use(addr, *await asyncio.open_connection(*addr))
+        return client
+
+    def _use(self, addr, reader, writer):
+        self.server_addr = addr
+        self._writer = writer
+        self._writers.append(writer)
+        asyncio.ensure_future(self._read_responses(reader, writer))
+
+    async def end(self):
+        for writer in self._writers:
+            writer.close()
+
+    async def send_message(self, request):
+        future = asyncio.get_event_loop().create_future()
+        await self._send(request, future, 0)
+        return await future
+
+    async def _send(self, request, future, redirects):
+        writer = self._writer
+        self._pending[request.id] = [request, future, redirects, writer]
+        try:
+            writer.write(frame(request.serialize()))
+            await writer.drain()
+        except (IOError, OSError) as e:
+            if self._pending.pop(request.id, None) is not None and not future.done():
+                future.set_exception(e)
+
+    async def _read_responses(self, reader, writer):
+        try:
+            while True:
+                await self._on_response(KVStoreResponse.deserialize(await recv_message_async(reader)))
+        except (IOError, asyncio.IncompleteReadError) as e:
+            orphans = [pending for pending in self._pending.values() if pending[3] is writer]
+            for request, _, _, _ in orphans:
+                del self._pending[request.id]
+            for request, future, redirects, _ in orphans:
+                if future.done():
+                    continue
+                # requests left on a connection we moved away from follow us to the new one
+                if writer is not self._writer and redirects < self.MAX_REDIRECTS:
+                    await self._send(request, future, redirects + 1)
+                else:
+                    future.set_exception(e)
+
+    async def _on_response(self, response):
+        pending = self._pending.pop(response.id, None)
+        if pending is None:
+            return
+        request, future, redirects, _ = pending
+        if response.is_redirect() and redirects < self.MAX_REDIRECTS:
+            leader = self.service_discovery.get_addr(int(response.msg))
+            current = self.server_addr
+            if leader != current:
+                try:
+                    reader, writer = await asyncio.open_connection(*leader)
+                except OSError as e:
+                    future.set_exception(e)
+                    return
+                if self.server_addr == current:
+                    self._use(leader, reader, writer)
+                else:
+                    # another redirect switched connections first
+                    writer.close()
+            await self._send(request, future, redirects + 1)
+            return
+        future.set_result(response)
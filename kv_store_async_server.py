@@ -0,0 +1,101 @@
+import asyncio
+from threading import Thread
+import os
+from time import perf_counter
+
+from library.messages import recv_message_async
+from schema.kv_store import KVStoreRequest
+from kv_store_server import KVStoreServer, RequestOrder, main
+from library.logging import get_logger
+
+logger = get_logger(os.path.basename(__file__))
+
+class AsyncConnection:
+    """ Socket stand-in for send_message, writes are handed to the event loop from any thread """
+    def __init__(self, loop, writer):
+        self._loop = loop
+        self._writer = writer
+
+    def sendall(self, data):
+        try:
+            self._loop.call_soon_threadsafe(self._write, data)
+        except RuntimeError:
+            # the server stopped and closed its loop, like writing to a closed socket
+            raise ConnectionError("Event loop is closed")
+
+    def _write(self, data):
+        if not self._writer.is_closing():
+            self._writer.write(data)
+
+    def close(self):
+        try:
+            self._loop.call_soon_threadsafe(self._writer.close)
+        except RuntimeError:
+            # closing the loop already dropped the connection
+            pass
+
+class AsyncKVStoreServer(KVStoreServer):
+    """
+    1 event loop thread reading every client connection
+    1 outbound network thread
+    n request processing threads, only busy while a request is processed
+    """
+    def __init__(self, addr, raft, handler, workers, metrics=None):
+        super().__init__(addr, raft, handler, workers, metrics)
+        self._loop = None
+        self._server = None
+
+    def start(self):
+        self.raft.start()
+        self.running = True
+        Thread(target=self.send_responses).start()
+        Thread(target=self.execute_message).start()
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            self.request_executor.shutdown(wait=False)
+            self._loop.close()
+
+    async def _serve(self):
+        self._server = await asyncio.start_server(self.read_request_async, *self.addr, reuse_address=True)
+        logger.info(f"Serving traffic at {self.addr}")
+        async with self._server:
+            if not self.running:
+                # stopped before the server existed, there was nothing for stop to close
+                return
+            try:
+                await self._server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+    def stop(self):
+        self.running = False
+        if self._server is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._server.close)
+            except RuntimeError:
+                # the loop already finished
+                pass
+        self.outbound_queue.put(None)
+        self.raft.stop()
+
+    async def read_request_async(self, reader, writer):
+        conn = AsyncConnection(self._loop, writer)
+        pipelined = asyncio.Semaphore(self.MAX_PIPELINED)
+        order = RequestOrder()
+        try:
+            while self.running:
+                msg = await recv_message_async(reader)
+                # idle connections hold no thread, pipelined requests run concurrently
+                received_at = perf_counter()
+                await pipelined.acquire()
+                request = KVStoreRequest.deserialize(msg)
+                future = self._loop.run_in_executor(
+                    self.request_executor, self.handle_request, conn, request, received_at, order.ticket(request))
+                future.add_done_callback(lambda _: pipelined.release())
+        except (IOError, asyncio.IncompleteReadError):
+            writer.close()
+
+if __name__ == '__main__':
+    main(AsyncKVStoreServer)
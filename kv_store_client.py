@@ -1,15 +1,21 @@
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, gaierror, herror, error
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR, gaierror, herror, error
+from concurrent.futures import Future
+from threading import Thread, Lock
+import os
 
 from schema.kv_store import KVStoreRequest
 from schema.kv_store import KVStoreResponse
 from library.messages import send_message, recv_message
+from library.logging import get_logger
 from service_discovery import ServiceDiscovery
 
+logger = get_logger(os.path.basename(__file__))
+
 class KVStoreClient:
-    def __init__(self, service_discovery):
+    def __init__(self, service_discovery, addr=None):
         self.sock = None
         self.service_discovery = service_discovery
-        self.server_addr = self.service_discovery.select_random_server()
+        self.server_addr = addr if addr is not None else self.service_discovery.select_random_server()
         self._connect_server()
 
     def _connect_new_server(self, idx):
@@ -45,7 +51,7 @@ class KVStoreClient:
         response_msg = recv_message(self.sock)
         response = KVStoreResponse.deserialize(response_msg)
         if response.is_redirect():
-            print(f"Redirected to: {response}")
+            logger.info(f"Redirected to: {response}")
             self._connect_new_server(int(response.msg))
             send_message(self.sock, msg)
             redirected_response_msg = recv_message(self.sock)
@@ -53,6 +59,108 @@ class KVStoreClient:
             return redirected_response
         return response
 
+class PipelinedKVStoreClient:
+    """
+    Keeps many requests outstanding on one connection. The server answers them in
+    any order and responses are matched back to their request by id.
+    submit returns a concurrent.futures.Future resolving to the KVStoreResponse.
+    """
+    MAX_REDIRECTS = 3
+
+    def __init__(self, service_discovery, addr=None):
+        self.service_discovery = service_discovery
+        self._lock = Lock()
+        # request id -> [request, future, redirects, socket it was sent on]
+        self._pending = {}
+        self._socks = []
+        addr = addr if addr is not None else service_discovery.select_random_server()
+        self._use(addr, self._connect(addr))
+
+    def _connect(self, addr):
+        # blocking, never called under _lock
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.connect(addr)
+        return sock
+
+    def _use(self, addr, sock):
+        self.server_addr = addr
+        self.sock = sock
+        self._socks.append(sock)
+        Thread(target=self._read_responses, args=[sock], daemon=True).start()
+
+    def end(self):
+        for sock in self._socks:
+            try:
+                # wakes the response reader, close alone does not
+                sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def submit(self, request):
+        future = Future()
+        with self._lock:
+            self._pending[request.id] = [request, future, 0, self.sock]
+            send_message(self.sock, request.serialize())
+        return future
+
+    def _resend(self, request, future, redirects):
+        with self._lock:
+            self._pending[request.id] = [request, future, redirects, self.sock]
+            try:
+                send_message(self.sock, request.serialize())
+                return
+            except OSError as e:
+                self._pending.pop(request.id, None)
+                error = e
+        future.set_exception(error)
+
+    def send_message(self, request, timeout=None):
+        return self.submit(request).result(timeout)
+
+    def _read_responses(self, sock):
+        try:
+            while True:
+                self._on_response(KVStoreResponse.deserialize(recv_message(sock)))
+        except (IOError, OSError) as e:
+            with self._lock:
+                orphans = [pending for pending in self._pending.values() if pending[3] is sock]
+                for request, _, _, _ in orphans:
+                    del self._pending[request.id]
+                current = self.sock
+            for request, future, redirects, _ in orphans:
+                # requests left on a connection we moved away from follow us to the new one
+                if sock is not current and redirects < self.MAX_REDIRECTS:
+                    self._resend(request, future, redirects + 1)
+                else:
+                    future.set_exception(e)
+
+    def _on_response(self, response):
+        with self._lock:
+            pending = self._pending.pop(response.id, None)
+            if pending is None:
+                return
+            request, future, redirects, _ = pending
+            current = self.server_addr
+        if response.is_redirect() and redirects < self.MAX_REDIRECTS:
+            leader = self.service_discovery.get_addr(int(response.msg))
+            if leader != current:
+                try:
+                    sock = self._connect(leader)
+                except OSError as e:
+                    future.set_exception(e)
+                    return
+                with self._lock:
+                    if self.server_addr == current:
+                        self._use(leader, sock)
+                        sock = None
+                if sock is not None:
+                    # another redirect switched connections first
+                    sock.close()
+            self._resend(request, future, redirects + 1)
+            return
+        future.set_result(response)
+
 def start_kvclient():
     service_discovery = ServiceDiscovery()
     client = KVStoreClient(service_discovery)
@@ -62,7 +170,8 @@ def start_kvclient():
             break
         request = KVStoreRequest.build_from_msg(msg)
         response = client.send_message(request)
-        print(response)
+        # stats come back as prometheus text, one metric per line
+        print(response.msg if request.is_stats() else response)
     client.end()
 
 if __name__ == '__main__':
@@ -5,6 +5,17 @@ class KVStoreHandler:
     def __init__(self, kv_storage=None):
         self._kv_storage = kv_storage if kv_storage is not None else KVStorage()
 
+    def snapshot(self):
+        return self._kv_storage.snapshot()
+
+    def restore(self, data):
+        self._kv_storage.restore(data)
+
+    def receive_batch(self, requests):
+        """ Applies committed requests in one pass, multi key readers never observe part of the batch """
+        with self._kv_storage.batch():
+            return [self.receive(request) for request in requests]
+
     def receive_msg(self, msg):
         self.receive(KVStoreRequest.deserialize(msg))
 
@@ -21,5 +32,13 @@ class KVStoreHandler:
         elif request.is_delete():
             self._kv_storage.delete(request._key)
             return KVStoreResponse(Status.SUCCESS)
+        elif request.is_mget():
+            return KVStoreResponse(Status.SUCCESS, self._kv_storage.mget(request._key))
+        elif request.is_mset():
+            self._kv_storage.mset(request._key, request._value)
+            return KVStoreResponse(Status.SUCCESS)
+        elif request.is_mdelete():
+            self._kv_storage.mdelete(request._key)
+            return KVStoreResponse(Status.SUCCESS)
 
         return KVStoreResponse(Status.FAIL, "bad request")
@@ -1,29 +1,91 @@
 import concurrent.futures
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR
 from library.messages import send_message, recv_message
-from threading import Thread
+from threading import Thread, BoundedSemaphore
 from queue import Queue
 import os
+from time import perf_counter
+import logging
 
 from schema.kv_store import Status
 from schema.kv_store import KVStoreResponse
 from schema.kv_store import KVStoreRequest
+from schema.kv_store import Consistency
 from schema.raft_rpc import ResultState
+from schema.raft_log import Snapshot
 from service_discovery import ServiceDiscovery
 from kv_store_handler import KVStoreHandler
 from raft_runtime import RaftRuntime
-from library.logging import get_logger
-from library.utils import LRUCache
+from raft_handler import RaftHandler
+from raft_config import RaftConfig
+from library.logging import get_logger, hot, set_levels
+from library.utils import LRUCache, IndexWaiters
+from library.metrics import Metrics
 
 logger = get_logger(os.path.basename(__file__))
 
+class Ticket:
+    """ A request's place in its connection's order, see RequestOrder """
+    def __init__(self, queued_after, written_after, write):
+        self._queued_after = queued_after
+        self._written_after = written_after
+        # set once the write has its place in the log order, and to its log index once handled
+        self.queued = concurrent.futures.Future() if write else None
+        self.written = concurrent.futures.Future() if write else None
+
+    def wait_turn(self):
+        """ Writes wait for the previous write to be queued in raft, reads return the index of the writes before them """
+        if self.queued is not None:
+            if self._queued_after is not None:
+                self._queued_after.result()
+            return None
+        return self._written_after.result() if self._written_after is not None else None
+
+    def mark_queued(self):
+        if not self.queued.done():
+            self.queued.set_result(None)
+
+    def finish(self, index=None):
+        if self.queued is None:
+            return
+        self.mark_queued()
+        if not self.written.done():
+            # a failed write leaves the index of the writes before it for later reads
+            if index is None and self._written_after is not None:
+                index = self._written_after.result()
+            self.written.set_result(index)
+
+class RequestOrder:
+    """
+    Pipelined requests of a connection run concurrently, yet writes reach raft in the order
+    they were sent and reads wait until the writes sent before them are applied, so a client
+    reads its own writes. Only the replies may come back out of order.
+    """
+    def __init__(self):
+        self._last_write = None
+
+    def ticket(self, request):
+        write = not request.is_read() and not request.is_stats()
+        last = self._last_write
+        ticket = Ticket(last.queued if last else None, last.written if last else None, write)
+        if write:
+            self._last_write = ticket
+        return ticket
+
 class KVStoreServer:
     """
     1 connection thread
     1 outbound network thread
-    n processing threads
+    n connection reading threads
+    n request processing threads
+    Requests of a connection are processed concurrently, up to MAX_PIPELINED at a time, in the
+    order RequestOrder keeps, and answered in completion order tagged with the request id
     """
-    def __init__(self, addr, raft, handler, workers):
+    MAX_PIPELINED = 128
+    # committed ranges the applier takes off the raft queue at once
+    APPLY_BATCH = 256
+
+    def __init__(self, addr, raft, handler, workers, metrics=None):
         self._handler = handler
         self.outbound_queue = Queue()
         self.addr = addr
@@ -32,14 +94,28 @@ class KVStoreServer:
         self.running = False
         self.request_cache = LRUCache(1024)
         self.request_id_to_socket = LRUCache(1024)
+        self.snapshot_index = 0
+        # last log index applied to the handler, linearizable reads wait on it
+        self.applied = IndexWaiters()
+        self.request_executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        # raft reports its own stages, queues and replication lag into the same metrics
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.accept_latency = self.metrics.stage('accept')
+        self.apply_latency = self.metrics.stage('apply')
+        self.respond_latency = self.metrics.stage('respond')
+        self.metrics.gauge('kv_queue_depth', 'Items waiting in each queue',
+            lambda: [({'queue': 'kv_outbound'}, self.outbound_queue.qsize())])
 
     @classmethod
-    def build_distributed_store(cls, server_number, addr, server_config, handler=None, workers=10):
+    def build_distributed_store(cls, server_number, addr, server_config, handler=None, workers=10, raft_config=None):
+        metrics = Metrics()
         raft = RaftRuntime.build_runtime(
             node_num=server_number,
-            server_config=server_config)
+            server_config=server_config,
+            config=raft_config,
+            metrics=metrics)
         handler = handler if handler is not None else KVStoreHandler()
-        return KVStoreServer(addr, raft=raft, handler=handler, workers=workers)
+        return cls(addr, raft=raft, handler=handler, workers=workers, metrics=metrics)
 
     @classmethod
     def build_non_distributed_store(addr, handler=None, workers=1):
@@ -72,69 +148,183 @@ class KVStoreServer:
 
     def stop(self):
         self.running = False
+        try:
+            # wakes the thread blocked in accept, close alone does not
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
         self.sock.close()
         self.outbound_queue.put(None)
+        self.request_executor.shutdown(wait=False)
         self.raft.stop()
 
     def send_responses(self):
         while self.running:
-            outbound_pair = self.outbound_queue.get()
-            if outbound_pair is not None:
-                sock, response = outbound_pair
+            outbound = self.outbound_queue.get()
+            if outbound is not None:
+                sock, response, queued_at = outbound
                 msg = response.serialize()
-                send_message(sock, msg)
+                try:
+                    send_message(sock, msg)
+                    self.respond_latency.observe(perf_counter() - queued_at)
+                except OSError as e:
+                    # the client went away before its response was ready
+                    logger.warning(f"Dropping response {response}: {e}")
 
     def read_request(self, sock):
+        pipelined = BoundedSemaphore(self.MAX_PIPELINED)
+        order = RequestOrder()
         try:
             while self.running:
                 msg = recv_message(sock)
+                received_at = perf_counter()
+                pipelined.acquire()
                 request = KVStoreRequest.deserialize(msg)
-                cached_response = self.request_cache.get(request.id)
-                if cached_response != -1:
-                    self.outbound_queue.put((sock, cached_response))
-                    continue
-                log_entry = str(request) if request is not None else None
-                redirect = self.raft.redirect_to_leader()
-                if redirect is not None:
-                    response = KVStoreResponse(Status.REDIRECT, redirect)
-                    logger.warning(f"Not leader, redirecting to: {redirect}")
-                    self.outbound_queue.put((sock, response))
-                elif request.is_get():
-                    logger.info("Received GET")
-                    response = self._handler.receive(request)
-                    self.outbound_queue.put((sock, response))
-                else:
-                    logger.info("Received DELETE or SET")
-                    self.request_id_to_socket.put(request.id, sock)
-                    result, _ = self.raft.log_append(log_entry)
-                    if result == ResultState.FAIL:
-                        logger.error("Failed applying command to state machine")
-                        response = KVStoreResponse(Status.FAIL, "Raft failed to append to its log.")
-                        self.outbound_queue.put((sock, response))
+                future = self.request_executor.submit(
+                    self.handle_request, sock, request, received_at, order.ticket(request))
+                future.add_done_callback(lambda _: pipelined.release())
         except IOError:
             sock.close()
 
+    def reply(self, sock, request, response):
+        response.id = request.id
+        self.outbound_queue.put((sock, response, perf_counter()))
+
+    def handle_request(self, sock, request, received_at=None, ticket=None):
+        """ Blocks until the request is answered or handed to raft, the response goes out through outbound_queue """
+        if ticket is None:
+            self._handle_request(sock, request, received_at, None)
+            return
+        try:
+            self._handle_request(sock, request, received_at, ticket)
+        finally:
+            ticket.finish()
+
+    def _handle_request(self, sock, request, received_at, ticket):
+        written = ticket.wait_turn() if ticket is not None else None
+        if received_at is not None:
+            self.accept_latency.observe(perf_counter() - received_at)
+        if written is not None and not self.applied.wait(written, RaftHandler.REQUEST_TIMEOUT):
+            self.reply(sock, request, KVStoreResponse(Status.TIMEOUT, "Earlier writes on this connection were not applied."))
+            return
+        if request.is_stats():
+            self.reply(sock, request, KVStoreResponse(Status.SUCCESS, self.metrics.render()))
+            return
+        cached_response = self.request_cache.get(request.id)
+        if cached_response != -1:
+            self.reply(sock, request, cached_response)
+            return
+        log_entry = str(request) if request is not None else None
+        if request.is_read() and request.consistency != Consistency.STRONG:
+            # weaker reads are answered by any replica that is fresh enough
+            response = self.follower_read(request)
+            if response is not None:
+                self.reply(sock, request, response)
+                return
+        redirect = self.raft.redirect_to_leader()
+        if redirect is not None:
+            response = KVStoreResponse(Status.REDIRECT, redirect)
+            if hot(logger, 'redirect', logging.WARNING):
+                logger.warning(f"Not leader, redirecting to: {redirect}")
+            self.reply(sock, request, response)
+        elif request.is_read():
+            logger.debug("Received GET")
+            self.reply(sock, request, self.linearizable_read(request))
+        else:
+            logger.debug("Received DELETE or SET")
+            self.request_id_to_socket.put(request.id, sock)
+            result, index = self.raft.log_append(log_entry, ticket.mark_queued if ticket is not None else None)
+            if ticket is not None:
+                ticket.finish(index)
+            if result == ResultState.FAIL:
+                logger.error("Failed applying command to state machine")
+                response = KVStoreResponse(Status.FAIL, "Raft failed to append to its log.")
+                self.reply(sock, request, response)
+
+    def linearizable_read(self, request):
+        read_index = self.raft.read_index()
+        if read_index is None:
+            return KVStoreResponse(Status.FAIL, "Raft could not confirm leadership for the read.")
+        return self.read_at(read_index, request)
+
+    def follower_read(self, request):
+        """ Serves ANY and BOUNDED reads locally, None when this node is too stale and the read goes to the leader """
+        if request.consistency == Consistency.ANY:
+            return self._handler.receive(request)
+        read_index = self.raft.follower_read_index(request.max_staleness)
+        if read_index is None:
+            return None
+        return self.read_at(read_index, request)
+
+    def read_at(self, read_index, request):
+        if not self.applied.wait(read_index, RaftHandler.REQUEST_TIMEOUT):
+            return KVStoreResponse(Status.TIMEOUT, "State machine did not catch up with the read index.")
+        return self._handler.receive(request)
+
     def execute_message(self):
+        """ Applier thread, drains committed ranges from raft and applies them a batch at a time """
         while self.running:
-            msg = self.raft.get_msg_to_execute()
-            if msg is None:
-                continue
-            request = KVStoreRequest.from_serialized_msg(msg)
-            response = self._handler.receive(request)
+            msgs, last_idx = [], None
+            for item in self.raft.get_msgs_to_execute(self.APPLY_BATCH) or []:
+                if item is None:
+                    continue
+                idx, item_msgs = item
+                if isinstance(item_msgs, Snapshot):
+                    # commands queued before the snapshot apply first, the snapshot replaces them all
+                    self.apply_batch(msgs, last_idx)
+                    msgs, last_idx = [], None
+                    logger.info(f"Restoring state machine from {item_msgs}")
+                    self._handler.restore(item_msgs.data)
+                    self.snapshot_index = idx
+                    self.applied.advance(idx)
+                    continue
+                # None is a leader no-op, it only moves the applied index
+                msgs.extend(msg for msg in item_msgs if msg is not None)
+                last_idx = idx + len(item_msgs) - 1
+            self.apply_batch(msgs, last_idx)
+
+    def apply_batch(self, msgs, last_idx):
+        if last_idx is None:
+            return
+        start = perf_counter()
+        requests = [KVStoreRequest.from_serialized_msg(msg) for msg in msgs]
+        responses = self._handler.receive_batch(requests)
+        self.apply_latency.observe(perf_counter() - start)
+        self.applied.advance(last_idx)
+        self.maybe_snapshot(last_idx)
+        for request, response in zip(requests, responses):
             sock = self.request_id_to_socket.get(request.id)
             # only reply if original request came to this host
             if sock != -1:
                 self.request_cache.put(request.id, response)
-                self.outbound_queue.put((sock, response))
+                self.reply(sock, request, response)
+
+    def maybe_snapshot(self, applied_index):
+        if applied_index - self.snapshot_index >= self.raft.config.snapshot_threshold:
+            self.raft.compact(applied_index, self._handler.snapshot())
+            self.snapshot_index = applied_index
 
-def start_kvserver(server_number):
+def start_kvserver(server_number, data_dir=None, lease_reads=False, server_cls=KVStoreServer, transport='udp',
+        pre_vote=False, check_quorum=False):
     service_discovery = ServiceDiscovery()
-    kv_store = KVStoreServer.build_distributed_store(
+    kv_store = server_cls.build_distributed_store(
         server_number,
         service_discovery.get_addr(server_number),
-        service_discovery.get_server_config())
+        # udp raft shares the kv port number, tcp listens one port above it
+        service_discovery.get_raft_config(1 if transport == 'tcp' else 0),
+        raft_config=RaftConfig(data_dir=data_dir, lease_reads=lease_reads, transport=transport,
+            pre_vote=pre_vote, check_quorum=check_quorum))
     kv_store.start()
 
-if __name__ == '__main__':
+def main(server_cls=KVStoreServer):
     import sys
-    start_kvserver(int(sys.argv[1]))
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    for arg in sys.argv[1:]:
+        if arg.startswith('--log-levels='):
+            set_levels(arg[len('--log-levels='):])
+    transport = 'tcp' if '--tcp' in sys.argv else 'udp'
+    start_kvserver(int(args[0]), args[1] if len(args) > 1 else None, '--lease-reads' in sys.argv, server_cls, transport,
+        '--pre-vote' in sys.argv, '--check-quorum' in sys.argv)
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,126 @@
 import logging
+import logging.handlers
+import atexit
+import os
+import queue
+from threading import Lock
+from time import monotonic
 
-def get_logger(name):
-    log = logging.getLogger(name)
-    log.setLevel(logging.INFO)
+LOG_DIR = '/tmp'
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+# per module levels as module=LEVEL pairs, e.g. KV_LOG_LEVELS=raft_handler.py=DEBUG,raft_state.py=WARNING
+LEVELS_ENV = 'KV_LOG_LEVELS'
+# seconds between two lines of the same hot path key
+HOT_INTERVAL = 1.0
+
+_queue = queue.SimpleQueue()
+_listener = None
+_listener_lock = Lock()
+_hot_last = {}
+
+class StructuredFormatter(logging.Formatter):
+    """ Appends the record's fields, passed as extra=fields(...), as key=value pairs """
+    def format(self, record):
+        line = super().format(record)
+        record_fields = getattr(record, 'fields', None)
+        if record_fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in record_fields.items())
+        return line
+
+class FieldsQueueHandler(logging.handlers.QueueHandler):
+    """ Renders fields on the calling thread like the message args, their values may change once queued """
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.setFormatter(StructuredFormatter('%(message)s'))
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.fields = None
+        return record
+
+class ModuleFileHandler(logging.Handler):
+    """ Writes every module to its own /tmp/log_<module>.log, only the listener thread calls it """
+    def __init__(self):
+        super().__init__()
+        self._files = {}
+
+    def emit(self, record):
+        handler = self._files.get(record.name)
+        if handler is None:
+            handler = logging.FileHandler(os.path.join(LOG_DIR, f'log_{record.name}.log'), mode='a')
+            handler.setFormatter(self.formatter)
+            self._files[record.name] = handler
+        handler.emit(record)
 
-    console_handler = logging.StreamHandler()
-    file_handler = logging.FileHandler(f'/tmp/log_{name}.log', mode='a')
+    def close(self):
+        for handler in self._files.values():
+            handler.close()
+        super().close()
 
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    console_handler.setFormatter(formatter)
-    file_handler.setFormatter(formatter)
+def _start_listener():
+    """ Console and file writes happen on one background thread, callers only pay for a queue put """
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            return
+        formatter = StructuredFormatter(FORMAT)
+        console_handler = logging.StreamHandler()
+        file_handler = ModuleFileHandler()
+        console_handler.setFormatter(formatter)
+        file_handler.setFormatter(formatter)
+        _listener = logging.handlers.QueueListener(_queue, console_handler, file_handler)
+        _listener.start()
+        atexit.register(stop_logging)
 
-    log.addHandler(console_handler)
-    log.addHandler(file_handler)
+def stop_logging():
+    """ Flushes whatever is still queued """
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
 
+def parse_levels(spec):
+    levels = {}
+    for pair in filter(None, (spec or '').split(',')):
+        name, level = pair.split('=')
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+def set_level(name, level):
+    """ Changes a module's level at runtime, name is what the module passed to get_logger """
+    logging.getLogger(name).setLevel(level)
+
+def set_levels(spec):
+    for name, level in parse_levels(spec).items():
+        set_level(name, level)
+
+def fields(**kwargs):
+    """ logger.info("msg", extra=fields(term=3)) logs term=3 after the message """
+    return {'fields': kwargs}
+
+def hot(log, key, level=logging.INFO, interval=HOT_INTERVAL):
+    """
+    Guard for lines logged per message: True at most once per interval for key.
+    Skipped lines cost a level check and a dict lookup, their message is never formatted.
+    """
+    if not log.isEnabledFor(level):
+        return False
+    now = monotonic()
+    hot_key = (log.name, key)
+    if now - _hot_last.get(hot_key, float('-inf')) < interval:
+        return False
+    _hot_last[hot_key] = now
+    return True
+
+def get_logger(name):
+    log = logging.getLogger(name)
+    if any(isinstance(handler, logging.handlers.QueueHandler) for handler in log.handlers):
+        return log
+    log.setLevel(parse_levels(os.environ.get(LEVELS_ENV)).get(name, logging.INFO))
+    _start_listener()
+    log.addHandler(FieldsQueueHandler(_queue))
     return log
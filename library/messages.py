@@ -1,7 +1,10 @@
-def send_message(sock, msg):
+def frame(msg):
     size = b'%10d' % len(msg)    # Make a 10-byte length field
-    sock.sendall(size)
-    sock.sendall(msg)
+    return size + msg
+
+def send_message(sock, msg):
+    # one write, a separate header segment stalls on Nagle's algorithm waiting for a delayed ack
+    sock.sendall(frame(msg))
 
 def recv_exactly(sock, nbytes):
     chunks = []
@@ -16,3 +19,8 @@ def recv_exactly(sock, nbytes):
 def recv_message(sock):
     size = int(recv_exactly(sock, 10))
     return recv_exactly(sock, size)
+
+async def recv_message_async(reader):
+    """ recv_message for an asyncio StreamReader """
+    size = int(await reader.readexactly(10))
+    return await reader.readexactly(size)
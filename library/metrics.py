@@ -0,0 +1,90 @@
+from bisect import bisect_left
+from threading import Lock
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+class Histogram:
+    """ Fixed buckets in seconds, observe is a bisect and three additions under a lock """
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self, buckets=BUCKETS):
+        self._bounds = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value):
+        bucket = bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[bucket] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """ (le, cumulative count) pairs ending with +Inf, and the sum """
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative, running = [], 0
+        for bound, count in zip(list(self._bounds) + ['+Inf'], counts):
+            running += count
+            cumulative.append((bound, running))
+        return cumulative, total
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+class Metrics:
+    """
+    Histograms are updated on the request path, gauges are collected only when rendered.
+    render() returns the Prometheus text exposition format.
+    """
+    def __init__(self):
+        self._histograms = {}
+        # name -> collectors, several components may report under one name
+        self._gauges = {}
+        self._help = {}
+        self._lock = Lock()
+
+    def histogram(self, name, help, **labels):
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            self._help[name] = help
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            return self._histograms[key]
+
+    def stage(self, stage):
+        """ Latency of one stage of the request path: accept, raft_append, quorum_commit, apply, respond """
+        return self.histogram('kv_stage_seconds', 'Time spent in each stage of the request path', stage=stage)
+
+    def gauge(self, name, help, collect):
+        """ collect returns (labels dict, value) pairs """
+        with self._lock:
+            self._help[name] = help
+            self._gauges.setdefault(name, []).append(collect)
+
+    def render(self):
+        lines = []
+        seen = set()
+        with self._lock:
+            # series of one family stay together
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0][0])
+            gauges = [(name, list(collectors)) for name, collectors in self._gauges.items()]
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines += [f'# HELP {name} {self._help[name]}', f'# TYPE {name} histogram']
+            buckets, total = histogram.snapshot()
+            for bound, count in buckets:
+                lines.append(f'{name}_bucket{format_labels(dict(labels, le=bound))} {count}')
+            lines.append(f'{name}_sum{format_labels(dict(labels))} {total}')
+            lines.append(f'{name}_count{format_labels(dict(labels))} {buckets[-1][1]}')
+        for name, collectors in gauges:
+            lines += [f'# HELP {name} {self._help[name]}', f'# TYPE {name} gauge']
+            for collect in collectors:
+                for labels, value in collect():
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
@@ -1,6 +1,14 @@
+try:
+   import cPickle as pickle
+except:
+   import pickle
+from threading import RLock
+
 class KVStorage(object):
     def __init__(self):
         self.kv = {}
+        # multi key operations and applied batches hold it so nobody observes half of one
+        self._lock = RLock()
     
     def get(self, key):
         return self.kv.get(key, None)
@@ -10,3 +18,25 @@ class KVStorage(object):
 
     def delete(self, key):
         del self.kv[key]
+
+    def batch(self):
+        return self._lock
+
+    def mget(self, keys):
+        with self._lock:
+            return [self.kv.get(key, None) for key in keys]
+
+    def mset(self, keys, values):
+        with self._lock:
+            self.kv.update(zip(keys, values))
+
+    def mdelete(self, keys):
+        with self._lock:
+            for key in keys:
+                self.kv.pop(key, None)
+
+    def snapshot(self):
+        return pickle.dumps(self.kv)
+
+    def restore(self, data):
+        self.kv = pickle.loads(data)
@@ -1,5 +1,9 @@
 import re
+import heapq
+from bisect import bisect_left, insort
 from collections import OrderedDict
+from itertools import count
+from threading import Event, Lock
 
 def pairwise(t):
     it = iter(t)
@@ -35,4 +39,93 @@ class LRUCache:
             self.cache.move_to_end(key)
         self.cache[key] = value
         if len(self.cache) > self.capacity:
-            self.cache.popitem(last=False)
\ No newline at end of file
+            self.cache.popitem(last=False)
+
+class IndexWaiters:
+    """ Threads block until a monotonically increasing index reaches their target, advance wakes them in bulk """
+    def __init__(self, index=0):
+        self._lock = Lock()
+        self._index = index
+        self._waiters = []
+        self._seq = count()
+
+    @property
+    def index(self):
+        return self._index
+
+    def advance(self, index):
+        with self._lock:
+            if index <= self._index:
+                return
+            self._index = index
+            ready = []
+            while self._waiters and self._waiters[0][0] <= index:
+                ready.append(heapq.heappop(self._waiters)[2])
+        for event in ready:
+            event.set()
+
+    def wait(self, target, timeout=None):
+        """ Returns True once index >= target, False on timeout """
+        with self._lock:
+            if self._index >= target:
+                return True
+            event = Event()
+            heapq.heappush(self._waiters, (target, next(self._seq), event))
+        return event.wait(timeout)
+
+    def pending(self):
+        return len(self._waiters)
+
+class TimerHeap:
+    """ Named deadlines, scheduling a name again replaces its deadline, replaced entries are skipped lazily """
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+
+    def schedule(self, name, at):
+        if self._deadlines.get(name) == at:
+            return
+        self._deadlines[name] = at
+        heapq.heappush(self._heap, (at, name))
+
+    def cancel(self, name):
+        self._deadlines.pop(name, None)
+
+    def scheduled(self, name):
+        return name in self._deadlines
+
+    def next_deadline(self):
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """ Names whose deadline passed, in deadline order """
+        due = []
+        while self.next_deadline() is not None and self._heap[0][0] <= now:
+            _, name = heapq.heappop(self._heap)
+            del self._deadlines[name]
+            due.append(name)
+        return due
+
+class QuorumTracker:
+    """ Follower match indexes kept sorted, so an update is a bisect rather than a sort of every peer """
+    def __init__(self, match_index, quorum):
+        self._match = dict(match_index)
+        self._sorted = sorted(self._match.values())
+        self._quorum = quorum
+
+    def update(self, follower, index):
+        old = self._match.get(follower)
+        if old == index:
+            return
+        if old is not None:
+            del self._sorted[bisect_left(self._sorted, old)]
+        self._match[follower] = index
+        insort(self._sorted, index)
+
+    def quorum_index(self):
+        """ Highest index held by at least quorum followers, None without enough of them """
+        if self._quorum < 1 or len(self._sorted) < self._quorum:
+            return None
+        return self._sorted[-self._quorum]
@@ -0,0 +1,269 @@
+from bisect import bisect_right
+from threading import Condition, Lock
+import os
+import struct
+import zlib
+
+from library.logging import get_logger
+
+logger = get_logger(os.path.basename(__file__))
+
+class Segment:
+    def __init__(self, path, first_index):
+        self.path = path
+        self.first_index = first_index
+        self.offsets = []  # byte offset of each record, offsets[i] holds first_index + i
+        self.size = 0
+
+    def last_index(self):
+        return self.first_index + len(self.offsets) - 1
+
+class WriteAheadLog:
+    """
+    Append-only log of (index, payload) records split across segment files.
+    Each record is framed as crc32 | length | index | payload so torn or corrupt
+    tails are detected on replay. sync() is a group commit: concurrent callers
+    share one fsync covering everything written before it started.
+    """
+    HEADER = struct.Struct('>IIQ')
+    SUFFIX = '.wal'
+    SEGMENT_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path, segment_size=None):
+        self._path = path
+        self._segment_size = segment_size if segment_size is not None else self.SEGMENT_SIZE
+        self._lock = Lock()
+        self._sync_cond = Condition()
+        self._syncing = False
+        self._written = 0
+        self._synced = 0
+        self._segments = []
+        self._file = None
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def segment_name(cls, first_index):
+        return f"{first_index:020d}{cls.SUFFIX}"
+
+    def _segment_paths(self):
+        names = sorted(x for x in os.listdir(self._path) if x.endswith(self.SUFFIX))
+        return [(int(x[:-len(self.SUFFIX)]), os.path.join(self._path, x)) for x in names]
+
+    def replay(self):
+        """ Load every valid record, truncating a torn tail. Returns [(index, payload)] """
+        records = []
+        self._segments = []
+        paths = self._segment_paths()
+        for n, (first_index, path) in enumerate(paths):
+            segment = Segment(path, first_index)
+            with open(path, 'rb') as f:
+                data = f.read()
+            offset = 0
+            while offset < len(data):
+                record = self._decode(data, offset, first_index + len(segment.offsets))
+                if record is None:
+                    if n != len(paths) - 1:
+                        raise IOError(f"Corrupt record in {path} at offset {offset}")
+                    logger.warning(f"Truncating torn tail of {path} at offset {offset}")
+                    os.truncate(path, offset)
+                    break
+                index, payload, size = record
+                segment.offsets.append(offset)
+                records.append((index, payload))
+                offset += size
+            segment.size = offset
+            self._segments.append(segment)
+        if self._segments:
+            self._file = open(self._segments[-1].path, 'ab')
+        return records
+
+    def _decode(self, data, offset, expected_index):
+        if offset + self.HEADER.size > len(data):
+            return None
+        crc, length, index = self.HEADER.unpack_from(data, offset)
+        start = offset + self.HEADER.size
+        payload = data[start:start + length]
+        if len(payload) != length or index != expected_index:
+            return None
+        if zlib.crc32(payload, zlib.crc32(data[offset + 4:start])) != crc:
+            return None
+        return index, payload, self.HEADER.size + length
+
+    @classmethod
+    def _encode(cls, index, payload):
+        body = cls.HEADER.pack(0, len(payload), index)[4:] + payload
+        return struct.pack('>I', zlib.crc32(body)) + body
+
+    def first_index(self):
+        return self._segments[0].first_index if self._segments else None
+
+    def last_index(self):
+        return self._segments[-1].last_index() if self._segments else None
+
+    def append(self, index, payload):
+        with self._lock:
+            last_index = self.last_index()
+            if last_index is not None and index != last_index + 1:
+                raise ValueError(f"Non contiguous append at {index}, last index is {last_index}")
+            if not self._segments or self._segments[-1].size >= self._segment_size:
+                self._rotate(index)
+            segment = self._segments[-1]
+            record = self._encode(index, payload)
+            self._file.write(record)
+            segment.offsets.append(segment.size)
+            segment.size += len(record)
+            self._written += 1
+
+    def _rotate(self, first_index):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        segment = Segment(os.path.join(self._path, self.segment_name(first_index)), first_index)
+        self._file = open(segment.path, 'ab')
+        self._segments.append(segment)
+        self._sync_dir()
+
+    def _sync_dir(self):
+        fd = os.open(self._path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def truncate(self, index):
+        """ Drop every record at index and above """
+        with self._lock:
+            if self._file is None or index > self.last_index():
+                return
+            n = max(bisect_right([x.first_index for x in self._segments], index) - 1, 0)
+            for segment in self._segments[n + 1:]:
+                os.remove(segment.path)
+            del self._segments[n + 1:]
+            segment = self._segments[n]
+            keep = max(index - segment.first_index, 0)
+            offset = segment.offsets[keep] if keep < len(segment.offsets) else segment.size
+            self._file.close()
+            os.truncate(segment.path, offset)
+            del segment.offsets[keep:]
+            segment.size = offset
+            self._file = open(segment.path, 'ab')
+            os.fsync(self._file.fileno())
+            self._sync_dir()
+
+    def compact(self, index):
+        """ Remove segments holding only records at index and below, the active segment is kept """
+        with self._lock:
+            while len(self._segments) > 1 and self._segments[0].last_index() <= index:
+                os.remove(self._segments.pop(0).path)
+            self._sync_dir()
+
+    def reset(self):
+        """ Remove every segment, the next append may start at any index """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            for segment in self._segments:
+                os.remove(segment.path)
+            self._segments = []
+            self._sync_dir()
+
+    def sync(self):
+        """ Block until every record appended before this call is on disk """
+        with self._lock:
+            target = self._written
+        with self._sync_cond:
+            while self._synced < target:
+                if not self._syncing:
+                    self._syncing = True
+                    break
+                self._sync_cond.wait()
+            else:
+                return
+        covered = 0
+        try:
+            with self._lock:
+                written = self._written
+                if self._file is None:
+                    covered = written
+                    return
+                self._file.flush()
+                fd = os.dup(self._file.fileno())
+            try:
+                os.fsync(fd)
+                covered = written
+            finally:
+                os.close(fd)
+        finally:
+            with self._sync_cond:
+                self._syncing = False
+                self._synced = max(self._synced, covered)
+                self._sync_cond.notify_all()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+class SnapshotStore:
+    """ Latest snapshot as last_index | last_term | crc32 | data, replaced atomically """
+    FILENAME = 'snapshot'
+    HEADER = struct.Struct('>QQI')
+
+    def __init__(self, path):
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+
+    def load(self):
+        """ Returns (last_index, last_term, data) or None """
+        try:
+            with open(os.path.join(self._path, self.FILENAME), 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return None
+        last_index, last_term, crc = self.HEADER.unpack_from(raw)
+        data = raw[self.HEADER.size:]
+        if zlib.crc32(data) != crc:
+            raise IOError(f"Corrupt snapshot in {self._path}")
+        return last_index, last_term, data
+
+    def save(self, last_index, last_term, data):
+        write_atomic(self._path, self.FILENAME, self.HEADER.pack(last_index, last_term, zlib.crc32(data)) + data)
+
+def write_atomic(path, filename, raw):
+    target = os.path.join(path, filename)
+    tmp_path = target + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(raw)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, target)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class HardState:
+    """ current_term and voted_for, rewritten atomically on every change """
+    FILENAME = 'hard_state'
+    FORMAT = struct.Struct('>Qq')
+
+    def __init__(self, path):
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+
+    def load(self):
+        try:
+            with open(os.path.join(self._path, self.FILENAME), 'rb') as f:
+                term, voted_for = self.FORMAT.unpack(f.read())
+        except FileNotFoundError:
+            return None, None
+        return term, (voted_for if voted_for >= 0 else None)
+
+    def save(self, term, voted_for):
+        write_atomic(self._path, self.FILENAME, self.FORMAT.pack(term, voted_for if voted_for is not None else -1))
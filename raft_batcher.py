@@ -0,0 +1,68 @@
+from threading import Condition
+from time import perf_counter
+import os
+
+from library.logging import get_logger
+
+logger = get_logger(os.path.basename(__file__))
+
+class Batch:
+    def __init__(self):
+        self.commands = []
+        self.first_index = None
+        self.done = False
+
+class RaftBatcher:
+    """
+    Groups concurrent client commands into one log append.
+    The first command of a batch makes its caller the flusher: it waits up to
+    window seconds (or until max_size commands joined), and for any flush still
+    in progress, then hands the whole batch to flush_callback. Everyone else
+    blocks until their batch is flushed.
+    """
+    def __init__(self, flush_callback, window=0.0, max_size=512):
+        self._flush_callback = flush_callback
+        self._window = window
+        self._max_size = max_size
+        self._cond = Condition()
+        self._open = Batch()
+        self._flushing = False
+
+    def submit(self, command, queued=None):
+        """
+        Returns the log index the command was appended at, None if the append failed.
+        queued is called once the command's place in the log order is fixed, before the batch is flushed.
+        """
+        with self._cond:
+            if len(self._open.commands) >= self._max_size:
+                self._open = Batch()
+            batch = self._open
+            position = len(batch.commands)
+            batch.commands.append(command)
+            if queued is not None:
+                queued()
+            if len(batch.commands) >= self._max_size:
+                self._cond.notify_all()
+            if position != 0:
+                while not batch.done:
+                    self._cond.wait()
+                return None if batch.first_index is None else batch.first_index + position
+
+            deadline = perf_counter() + self._window
+            while len(batch.commands) < self._max_size and perf_counter() < deadline:
+                self._cond.wait(deadline - perf_counter())
+            # the batch stays open while the previous one is being flushed
+            while self._flushing:
+                self._cond.wait()
+            if self._open is batch:
+                self._open = Batch()
+            self._flushing = True
+        try:
+            batch.first_index = self._flush_callback(batch.commands)
+        finally:
+            with self._cond:
+                self._flushing = False
+                batch.done = True
+                self._cond.notify_all()
+        logger.debug(f"Flushed batch of {len(batch.commands)} at {batch.first_index}")
+        return batch.first_index
@@ -0,0 +1,53 @@
+import os
+
+class RaftConfig:
+    """
+    Per node raft settings.
+    data_dir: directory for the write ahead log and hard state, None keeps everything in memory
+    segment_size: bytes written to a log segment before rolling over to a new one
+    snapshot_threshold: applied entries between state machine snapshots, the log is compacted up to each one
+    snapshot_chunk_size: bytes of snapshot data per InstallSnapshot message
+    batch_window: seconds the leader waits for more client commands before appending a batch,
+        commands arriving while the previous batch is flushed are always grouped
+    batch_max_size: most client commands appended as one batch
+    heartbeat_interval: seconds without traffic before the leader sends an empty AppendEntries to a follower
+    replication_timeout: seconds to wait for an AppendEntries response before sending the entries again
+    max_append_entries: most log entries carried by one AppendEntries
+    max_append_bytes: most encoded entry bytes carried by one AppendEntries, a single larger entry still goes alone.
+        The default keeps an AppendEntries within an 8KB udp datagram
+    max_in_flight: AppendEntries batches sent to a follower ahead of its responses
+    lease_reads: serve reads on the leader without a confirmation round while a quorum acknowledged it
+        within the lease, followers then refuse votes while they hear from a leader. Set it on every node
+    lease_clock_drift: fraction of the minimum election timeout the lease gives up to clock rate differences
+    transport: 'udp' sends each message as one datagram, which must fit in 8KB,
+        'tcp' keeps a connection per peer with length prefixed frames and no size limit
+    inbound_priority: handle received votes and heartbeats before responses and before entries, otherwise in arrival order
+    pre_vote: before starting an election ask the peers whether they would vote, the term only moves once a majority
+        would, so a node coming back from a partition does not depose a working leader. Set it on every node
+    check_quorum: a leader that has not heard from a majority within the maximum election timeout steps down
+        instead of accepting writes it cannot commit
+    """
+    def __init__(self, data_dir=None, segment_size=None, snapshot_threshold=10000, snapshot_chunk_size=4096,
+            batch_window=0.0, batch_max_size=512, heartbeat_interval=0.05, replication_timeout=0.05,
+            max_append_entries=64, max_append_bytes=8000, max_in_flight=4, lease_reads=False, lease_clock_drift=0.2, transport='udp',
+            inbound_priority=True, pre_vote=False, check_quorum=False):
+        self.data_dir = data_dir
+        self.segment_size = segment_size
+        self.snapshot_threshold = snapshot_threshold
+        self.snapshot_chunk_size = snapshot_chunk_size
+        self.batch_window = batch_window
+        self.batch_max_size = batch_max_size
+        self.heartbeat_interval = heartbeat_interval
+        self.replication_timeout = replication_timeout
+        self.max_append_entries = max_append_entries
+        self.max_append_bytes = max_append_bytes
+        self.max_in_flight = max_in_flight
+        self.lease_reads = lease_reads
+        self.lease_clock_drift = lease_clock_drift
+        self.transport = transport
+        self.inbound_priority = inbound_priority
+        self.pre_vote = pre_vote
+        self.check_quorum = check_quorum
+
+    def node_dir(self, node_num):
+        return None if self.data_dir is None else os.path.join(self.data_dir, f"node_{node_num}")
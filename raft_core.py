@@ -1,62 +1,96 @@
 import os
+import logging
 
-from library.logging import get_logger
+from library.logging import get_logger, hot, fields
+from library.utils import QuorumTracker
 
 logger = get_logger(os.path.basename(__file__))
 
-def add_inverse_idx_ending_at_one(lst):
-    n = len(lst)
-    result = []
-    for i in range(n):
-        result.append((lst[i], n - i))
-    return result
-
 class RaftCore:
     @classmethod
     def append_entries(cls, log, prev_index, prev_term, entries):
         assert(prev_index >= 0)
+        if prev_index < log.snapshot_index:
+            # everything up to the snapshot is committed, only the entries past it matter
+            skip = log.snapshot_index - prev_index
+            if len(entries) <= skip:
+                return True
+            entries = entries[skip:]
+            prev_index, prev_term = log.snapshot_index, log.snapshot_term
         if prev_index == 0:
             assert(prev_term == None)
             if entries:
                 log.add_at(1, entries)
             return True
         if prev_index > log.size():
-            logger.warning(f"append_entries fail - Missing entry at idx {prev_index}")
+            if hot(logger, 'missing_entry', logging.WARNING):
+                logger.warning("append_entries fail - Missing entry", extra=fields(prev_index=prev_index))
             return False
         if not entries:
-            if log.get(prev_index).term == prev_term:
+            if log.term_at(prev_index) == prev_term:
                 return True
-            logger.warning(f"append_entries fail - Prev term mismatch")
+            if hot(logger, 'term_mismatch', logging.WARNING):
+                logger.warning("append_entries fail - Prev term mismatch", extra=fields(prev_index=prev_index, prev_term=prev_term))
             return False
-        if log.get(prev_index).term == prev_term:
+        if log.term_at(prev_index) == prev_term:
             if prev_index < log.size():
                 next_term = entries[0].term
                 if log.get(prev_index + 1).term != next_term:
-                    logger.warning(f"append_entries - Trimming from {prev_index + 1}")
+                    if hot(logger, 'trim', logging.WARNING):
+                        logger.warning("append_entries - Trimming", extra=fields(from_index=prev_index + 1))
                     log.trim(prev_index + 1)
             log.add_at(prev_index + 1, entries)
             return True
-        logger.warning("append_entries fail - Prev term mismatch")
+        if hot(logger, 'term_mismatch', logging.WARNING):
+            logger.warning("append_entries fail - Prev term mismatch", extra=fields(prev_index=prev_index, prev_term=prev_term))
         return False
 
+    @classmethod
+    def quorum_size(cls, num_peers):
+        """ Followers that together with the leader are a majority: needed to commit, elect, confirm reads and keep leading """
+        return (num_peers + 1) // 2
+
     @classmethod
     def get_candidate_commit_index(cls, match_index, log, current_term, num_peers):
-        match_index_candidates = sorted([x for x in match_index.values()])
-        match_index_candidates_with_idx = add_inverse_idx_ending_at_one(match_index_candidates)
-        majority_count = ((num_peers + 1) // 2) + 1
-        majority_candidates = [x[0] for x in match_index_candidates_with_idx if x[1] >= majority_count]
-        candidate = None
-        if majority_candidates:
-            for log_idx in range(majority_candidates[-1], 0, -1):
-                if log.get(log_idx).term == current_term:
-                    candidate = log_idx
-                    break
-        return candidate
+        tracker = QuorumTracker(match_index, cls.quorum_size(num_peers))
+        return cls.commit_index_at(tracker.quorum_index(), log, current_term)
+
+    @classmethod
+    def commit_index_at(cls, quorum_index, log, current_term):
+        """ Highest entry of current_term at or below quorum_index, only those commit by counting replicas """
+        if quorum_index is None:
+            return None
+        first_index = log.first_index_of_term(current_term)
+        if first_index is None or first_index > quorum_index:
+            return None
+        return min(quorum_index, log.last_index_of_term(current_term))
+
+    @classmethod
+    def find_conflict(cls, log, prev_index):
+        """ Hint for a rejected AppendEntries: (conflict_term, conflict_index) """
+        if prev_index > log.size():
+            return None, log.size() + 1
+        conflict_term = log.term_at(prev_index)
+        if prev_index <= log.snapshot_index:
+            return conflict_term, prev_index
+        # the leader can skip every entry of the conflicting term at once
+        return conflict_term, log.first_index_of_term(conflict_term)
+
+    @classmethod
+    def next_index_from_conflict(cls, log, conflict_term, conflict_index):
+        """ Where the leader resumes after a rejection carrying find_conflict's hint """
+        if conflict_term is not None:
+            # entries of conflict_term we share with the follower end where ours end
+            last_index = log.last_index_of_term(conflict_term)
+            if last_index is not None:
+                return last_index + 1
+        return conflict_index
 
     @classmethod
     def step_back_index(cls, follower_id, next_index, match_index):
         if next_index.get(follower_id, 0) > 1:
             next_index[follower_id] -= 1
-        prev_match_index = str(match_index)
+        prev_match_index = match_index[follower_id]
         match_index[follower_id] = min(next_index[follower_id] - 1, match_index[follower_id])
-        logger.info(f"Leader, match index change from {prev_match_index} to {str(match_index)}")
+        if hot(logger, 'step_back'):
+            logger.info("Leader, match index stepped back", extra=fields(follower=follower_id, old=prev_match_index, new=match_index[follower_id]))
@@ -1,36 +1,76 @@
 import os
-import time
-from collections import namedtuple
+import logging
+from collections import namedtuple, deque
+from time import perf_counter
+from threading import Lock
 
 from raft_core import RaftCore
-from schema.raft_state import RaftState
-from schema.raft_log import LogEntry
+from raft_config import RaftConfig
+from raft_batcher import RaftBatcher
+from raft_read_index import ReadIndexBatcher
+from schema.raft_state import RaftState, Status
+from schema.raft_log import LogEntry, Snapshot
 from schema.raft_rpc import AppendEntries
 from schema.raft_rpc import AppendEntriesResponse
 from schema.raft_rpc import RequestVote
 from schema.raft_rpc import RequestVoteResponse
+from schema.raft_rpc import InstallSnapshot
+from schema.raft_rpc import InstallSnapshotResponse
 from schema.raft_rpc import ResultState
-from library.logging import get_logger
-from library.utils import LRUCache
+from library.logging import get_logger, hot, fields
+from library.metrics import Metrics
+from library.utils import LRUCache, QuorumTracker
 
 logger = get_logger(os.path.basename(__file__))
 
-RaftResult = namedtuple('MyNamedTuple', ['raft_result_state', 'prev_index'])
+RaftResult = namedtuple('MyNamedTuple', ['raft_result_state', 'index'])
 
 class RaftHandler:
     REQUEST_TIMEOUT = 0.5
 
-    def __init__(self, state, send_message_callback, execute_message_callback=None, core=None):
+    def __init__(self, state, send_message_callback, execute_message_callback=None, core=None, config=None,
+            install_snapshot_callback=None, metrics=None):
         self._core = core if core is not None else RaftCore()
+        self._config = config if config is not None else RaftConfig()
         self._state = state
         self._send_message_callback = send_message_callback
         self._execute_message_callback = execute_message_callback
+        self._install_snapshot_callback = install_snapshot_callback
         self._request_cache = LRUCache(1024)
+        self._log_lock = Lock()
+        # serializes snapshot writes, taken before _log_lock
+        self._snapshot_lock = Lock()
+        self._batcher = RaftBatcher(self.flush_batch, self._config.batch_window, self._config.batch_max_size)
+        self._reads = ReadIndexBatcher(
+            self._probe_leadership, self._core.quorum_size(len(state.peers)), state.clock, self._wake_loop)
+        # set by the runtime, without an event loop (tests, simulator) pending work runs on the calling thread
+        self._wake = None
+        self._replicate_pending = False
+        # (term, index) of the no-op a leader appends when its term starts
+        self._noop = None
+        self._noop_lock = Lock()
+        self._metrics = metrics if metrics is not None else Metrics()
+        self._append_latency = self._metrics.stage('raft_append')
+        self._commit_latency = self._metrics.stage('quorum_commit')
+        self._metrics.gauge(
+            'kv_replication_lag_entries', 'Log entries the leader holds that a follower does not', self.replication_lag)
+        self._restore_snapshot()
 
     @classmethod
-    def build_new(self, node_num, peers, send_message_callback, execute_message_callback):
-        state = RaftState(node_num, peers)
-        return RaftHandler(state, send_message_callback, execute_message_callback)
+    def build_state(cls, node_num, peers, config):
+        data_dir = config.node_dir(node_num)
+        if data_dir is None:
+            return RaftState(node_num, peers)
+        return RaftState.open(node_num, peers, data_dir, config.segment_size)
+
+    @classmethod
+    def build_new(cls, node_num, peers, send_message_callback, execute_message_callback, config=None,
+            install_snapshot_callback=None, metrics=None):
+        config = config if config is not None else RaftConfig()
+        state = cls.build_state(node_num, peers, config)
+        return RaftHandler(
+            state, send_message_callback, execute_message_callback, config=config,
+            install_snapshot_callback=install_snapshot_callback, metrics=metrics)
         
     @property
     def node_num(self):
@@ -40,11 +80,22 @@ class RaftHandler:
     def peers(self):
         return self._state.peers
 
+    @property
+    def config(self):
+        return self._config
+
     def get_status(self):
         return self._state.status
 
     def restart(self):
-        self._state = RaftState(self._state.node_num, self._state.peers)
+        self._state.close()
+        self._state = self.build_state(self._state.node_num, self._state.peers, self._config)
+        self._restore_snapshot()
+
+    def _restore_snapshot(self):
+        # a state loaded from disk starts with its state machine at the snapshot
+        if self._state.snapshot is not None and self._install_snapshot_callback is not None:
+            self._install_snapshot_callback(self._state.snapshot)
 
     def receive(self, msg):
         if AppendEntries.is_type(msg):
@@ -53,66 +104,213 @@ class RaftHandler:
             self.handle_append_entries_response(AppendEntriesResponse.deserialize(msg))
         elif RequestVote.is_type(msg):
             request_vote = RequestVote.deserialize(msg)
-            logger.info(f"<<<Received {request_vote}")
+            logger.info("<<<Received", extra=fields(message=request_vote))
             self.handle_request_vote(request_vote)
         elif RequestVoteResponse.is_type(msg):
-            request_vote_response = RequestVote.deserialize(msg)
-            logger.info(f"<<<Received {request_vote_response}")
+            request_vote_response = RequestVoteResponse.deserialize(msg)
+            logger.info("<<<Received", extra=fields(message=request_vote_response))
             self.handle_request_vote_response(request_vote_response)
+        elif InstallSnapshot.is_type(msg):
+            self.handle_install_snapshot(InstallSnapshot.deserialize(msg))
+        elif InstallSnapshotResponse.is_type(msg):
+            self.handle_install_snapshot_response(InstallSnapshotResponse.deserialize(msg))
         else:
             raise ValueError("Invalid Request Type")
 
     def check_election_timeout(self):
         if not self._state.is_leader() and self._state.election_timeout():
-            self.request_vote()
+            if self._config.pre_vote:
+                self.request_pre_vote()
+            else:
+                self.request_vote()
 
     def redirect_to_leader(self):
         if not self._state.is_leader():
             return self._state.implicit_leader
         return None
 
-    def log_append(self, msg):
+    def log_append(self, msg, queued=None):
+        """ (result state, log index), queued is passed on to RaftBatcher.submit """
         if not self._state.is_leader():
             return ResultState.FAIL, None
         id = msg[:36]
         result = self._request_cache.get(id)
         if result == -1:
-            result = self.handle_client_log_append(msg)
+            result = self.handle_client_log_append(msg, queued)
             self._request_cache.put(id, result)
         else:
             if result.raft_result_state == ResultState.PENDING_REPLICATION:
-                result = self.get_or_wait_for_raft_result(result.prev_index, self.REQUEST_TIMEOUT)
+                result = self.get_or_wait_for_raft_result(result.index, self.REQUEST_TIMEOUT)
                 if result.raft_result_state == ResultState.COMMITED:
                     self._request_cache.put(id, result)
-        return result.raft_result_state, None
-
-    def get_or_wait_for_raft_result(self, prev_index, timeout):
-        start_time = time.time()
-        while time.time() - start_time < timeout and\
-                self._state.commit_index < prev_index:
-            time.sleep(0.01)
-        if self._state.commit_index >= prev_index:
-            return RaftResult(ResultState.COMMITED, prev_index)
+        return result.raft_result_state, result.index
+
+    def get_or_wait_for_raft_result(self, index, timeout):
+        # woken by commit_index advancing past index, no polling
+        if self._state.commit_waiters.wait(index, timeout):
+            return RaftResult(ResultState.COMMITED, index)
         else:
-            return RaftResult(ResultState.PENDING_REPLICATION, prev_index)
-
-    def handle_client_log_append(self, msg):
-        # Client adds a log entry (received by leader)
-        entries = [LogEntry(self._state.current_term, msg)]
-        prev_index = self._state.log.size()
-        prev_term = self._state.log.get_last_term()
-        success = self._core.append_entries(
-            log=self._state.log,
-            prev_index=prev_index,
-            prev_term=prev_term,
-            entries=entries)
-        if success:
-            return self.get_or_wait_for_raft_result(prev_index, self.REQUEST_TIMEOUT)
+            return RaftResult(ResultState.PENDING_REPLICATION, index)
+
+    def handle_client_log_append(self, msg, queued=None):
+        # Client adds a log entry (received by leader), concurrent requests are appended together
+        start = perf_counter()
+        index = self._batcher.submit(msg, queued)
+        if index is None:
+            return RaftResult(ResultState.FAIL, None)
+        appended = perf_counter()
+        self._append_latency.observe(appended - start)
+        result = self.get_or_wait_for_raft_result(index, self.REQUEST_TIMEOUT)
+        if result.raft_result_state == ResultState.COMMITED:
+            self._commit_latency.observe(perf_counter() - appended)
+        return result
+
+    def replication_lag(self):
+        """ (labels, entries behind) per follower, empty unless leader """
+        if not self._state.is_leader():
+            return []
+        last_index = self._state.log.size()
+        return [({'follower': follower}, last_index - match)
+                for follower, match in sorted(dict(self._state.match_index).items())]
+
+    def read_index(self, timeout):
+        """
+        ReadIndex: returns the commit index a linearizable read must wait to be applied,
+        once a heartbeat round confirmed we are still leader. None if not leader.
+        """
+        if not self._state.is_leader():
+            return None
+        with self._log_lock:
+            term_committed = self._state.log.term_at(self._state.commit_index) == self._state.current_term
+        if not term_committed:
+            # our commit index is only known to be up to date once an entry from this term commits
+            index = self._term_noop_index()
+            if index is None or not self._state.commit_waiters.wait(index, timeout):
+                return None
+        if self._config.lease_reads and self.lease_valid(self._state.clock()):
+            return self._state.commit_index
+        return self._reads.read(timeout)
+
+    def _term_noop_index(self):
+        """ Index of this term's no-op, appended here if the term started without one (leader set outside an election) """
+        with self._noop_lock:
+            term = self._state.current_term
+            if self._noop is None or self._noop[0] != term:
+                index = self._batcher.submit(None)
+                if index is None:
+                    return None
+                self._noop = (term, index)
+            return self._noop[1]
+
+    def _append_noop(self):
+        # commits the entries of earlier terms and tells reads when the commit index is current
+        with self._noop_lock:
+            index = self.flush_batch([None])
+            if index is not None:
+                self._noop = (self._state.current_term, index)
+
+    def follower_read_index(self, max_staleness, timeout):
+        """
+        Index a read at most max_staleness seconds behind the leader must wait to be applied.
+        Followers that have not committed up to the leader's commit index within max_staleness return None.
+        """
+        if self._state.is_leader():
+            return self.read_index(timeout)
+        if self._state.implicit_leader is None or self._state.clock() - self._state.caught_up_at > max_staleness:
+            return None
+        # everything the leader had committed when it sent the last AppendEntries
+        return self._state.commit_index
+
+    def lease_duration(self):
+        # followers that heard from us do not vote for ELECTION_TIMEOUT_MIN after they received the message
+        return RaftState.ELECTION_TIMEOUT_MIN * (1 - self._config.lease_clock_drift)
+
+    def lease_valid(self, now):
+        """ True while a quorum acknowledged messages sent less than lease_duration ago (leader) """
+        quorum = self._core.quorum_size(len(self.peers))
+        if quorum == 0:
+            return True
+        acked = sorted(self._state.acked_seq.values(), reverse=True)
+        if len(acked) < quorum:
+            return False
+        lease_start = self._state.seq_sent_at(acked[quorum - 1])
+        return lease_start is not None and now < lease_start + self.lease_duration()
+
+    def _probe_leadership(self):
+        # empty AppendEntries at index 0 always succeeds, it only asks followers to accept our term
+        commit_index = self._state.commit_index
+        seq = self._state.next_seq(self._state.clock())
+        for follower in self.peers:
+            append_entries = AppendEntries(
+                term=self._state.current_term,
+                leader_id=self.node_num,
+                prev_term=None,
+                prev_index=0,
+                leader_commit=self._state.commit_index,
+                entries=[],
+                seq=seq)
+            self._send_message_callback(follower, append_entries)
+        return self._state.current_term, commit_index, seq
+
+    def flush_batch(self, commands):
+        # role and term only change under _log_lock, entries carry a term this node leads
+        with self._log_lock:
+            if not self._state.is_leader():
+                return None
+            entries = [LogEntry(self._state.current_term, msg) for msg in commands]
+            prev_index = self._state.log.size()
+            prev_term = self._state.log.get_last_term()
+            success = self._core.append_entries(
+                log=self._state.log,
+                prev_index=prev_index,
+                prev_term=prev_term,
+                entries=entries)
+        if not success:
+            return None
+        self._state.log.sync()
+        # one AppendEntries fan-out carries the whole batch, sent from the event loop
+        self._replicate_pending = True
+        self._wake_loop()
+        return prev_index + 1
+
+    def set_wake(self, wake):
+        """ wake makes the event loop call run_pending soon, replication state is only touched from the loop """
+        self._wake = wake
+
+    def _wake_loop(self):
+        if self._wake is None:
+            self.run_pending()
         else:
-            return RaftResult(ResultState.FAIL, prev_index)
+            self._wake()
+
+    def run_pending(self):
+        """ Event loop: replicate batches appended by client threads and probe leadership for waiting reads """
+        if self._replicate_pending:
+            self._replicate_pending = False
+            self.replicate()
+            if not self.peers and self._state.is_leader():
+                # a single node cluster commits as soon as the batch is durable
+                self._state.commit_index = self._state.log.size()
+                self._apply_committed()
+        self._reads.probe()
+
+    def request_pre_vote(self):
+        """ Asks the peers whether they would vote for us in the next term, which only starts once a majority would """
+        self._state.start_pre_vote()
+        for peer in self.peers:
+            request_vote = RequestVote(
+                term=self._state.current_term + 1,
+                candidate_id=self.node_num,
+                last_log_index=self._state.log.size(),
+                last_log_term=self._state.log.get_last_term(),
+                pre_vote=True
+            )
+            self._send_message_callback(peer, request_vote)
+        self._count_pre_votes()
 
     def request_vote(self):
-        self._state.become_candidate()
+        with self._log_lock:
+            self._state.become_candidate()
         for peer in self.peers:
             request_vote = RequestVote(
                 term=self._state.current_term,
@@ -121,15 +319,20 @@ class RaftHandler:
                 last_log_term=self._state.log.get_last_term()
             )
             self._send_message_callback(peer, request_vote)
+        self._count_votes()
 
     def handle_request_vote(self, request_vote):
+        if (self._config.lease_reads and request_vote.candidate_id != self._state.implicit_leader and
+                self._state.clock() - self._state.leader_contact < RaftState.ELECTION_TIMEOUT_MIN):
+            # the leader's lease counts on us not electing anyone else this soon
+            logger.info("Ignoring vote request, leader is alive", extra=fields(candidate=request_vote.candidate_id, leader=self._state.implicit_leader))
+            return
+        if request_vote.pre_vote:
+            self._handle_pre_vote(request_vote)
+            return
         self._term_check(request_vote.term)
         vote_for_requester = self._state.voted_for is None or self._state.voted_for == request_vote.candidate_id
-        requester_term_gt = (request_vote.last_log_term or 0) > (self._state.log.get_last_term() or 0)
-        requester_term_tie = (
-            request_vote.last_log_term == self._state.log.get_last_term() and
-            request_vote._last_log_index >= self._state.log.size())
-        requester_term_check = requester_term_gt or requester_term_tie
+        requester_term_check = self._log_up_to_date(request_vote)
         vote_granted = vote_for_requester and requester_term_check
         if vote_granted:
             self._state.voted_for = request_vote.candidate_id
@@ -138,21 +341,57 @@ class RaftHandler:
             term=self._state.current_term,
             vote_granted=vote_granted
         )
-        logger.info(f">>>Sending vote for {request_vote.candidate_id}: {request_vote_response}. Reason: term_check={requester_term_check} not_voted_others: {vote_for_requester}")
+        logger.info(">>>Sending vote", extra=fields(candidate=request_vote.candidate_id, response=request_vote_response, term_check=requester_term_check, not_voted_others=vote_for_requester))
+        self._send_message_callback(request_vote.candidate_id, request_vote_response)
+
+    def _log_up_to_date(self, request_vote):
+        requester_term_gt = (request_vote.last_log_term or 0) > (self._state.log.get_last_term() or 0)
+        requester_term_tie = (
+            request_vote.last_log_term == self._state.log.get_last_term() and
+            request_vote.last_log_index >= self._state.log.size())
+        return requester_term_gt or requester_term_tie
+
+    def _handle_pre_vote(self, request_vote):
+        # nothing changes here, a grant only tells the requester a real election could succeed
+        leader_alive = self._state.is_leader() or \
+            self._state.clock() - self._state.leader_contact < RaftState.ELECTION_TIMEOUT_MIN
+        vote_granted = request_vote.term > self._state.current_term and not leader_alive and self._log_up_to_date(request_vote)
+        request_vote_response = RequestVoteResponse(
+            follower_id=self.node_num,
+            term=self._state.current_term,
+            vote_granted=vote_granted,
+            pre_vote=True
+        )
+        logger.info(">>>Sending pre-vote", extra=fields(candidate=request_vote.candidate_id, response=request_vote_response, leader_alive=leader_alive))
         self._send_message_callback(request_vote.candidate_id, request_vote_response)
 
     def handle_request_vote_response(self, request_vote_response):
         self._term_check(request_vote_response.term)
+        if request_vote_response.pre_vote:
+            if request_vote_response.vote_granted and self._state.pre_votes_from is not None:
+                self._state.pre_votes_from.add(request_vote_response.follower_id)
+                self._count_pre_votes()
+            return
         if request_vote_response.vote_granted:
             self._state.received_votes_from.add(request_vote_response.follower_id)
-            if len(self._state.received_votes_from) + 1 > (len(self.peers) + 1) // 2:
+            self._count_votes()
+
+    def _count_pre_votes(self):
+        if self._state.pre_votes_from is not None and len(self._state.pre_votes_from) >= self._core.quorum_size(len(self.peers)):
+            self.request_vote()
+
+    def _count_votes(self):
+        if self._state.is_candidate() and len(self._state.received_votes_from) >= self._core.quorum_size(len(self.peers)):
+            with self._log_lock:
                 self._state.become_leader()
-                self.handle_heartbeat()
+            self._append_noop()
+            self.handle_heartbeat()
 
     def _term_check(self, request_term):
-        if request_term > self._state.current_term:
-            self._state.become_follower()
-            self._state.current_term = request_term
+        if request_term is not None and request_term > self._state.current_term:
+            with self._log_lock:
+                self._state.become_follower(request_term)
+            self._reads.abort()
             return True
         return False
 
@@ -161,80 +400,331 @@ class RaftHandler:
         if self._state.is_leader() and append_entries.term == self._state.current_term:
             raise Exception("Received a vote from a leader with the same term")
         self._term_check(append_entries.term)
+        if append_entries.term < self._state.current_term:
+            # a deposed leader learns the new term from the rejection
+            self._send_message_callback(append_entries.leader_id, AppendEntriesResponse(
+                success=False,
+                follower_id=self.node_num,
+                term=self._state.current_term,
+                seq=append_entries.seq))
+            return
+        if self._state.is_candidate():
+            # another candidate won this term
+            with self._log_lock:
+                self._state.status = Status.FOLLOWER
         if self._state.is_follower():
             self._state.reset_election_timeout()
-            success = self._core.append_entries(
-                    log=self._state.log,
-                    prev_index=append_entries.prev_index,
-                    prev_term=append_entries.prev_term,
-                    entries=append_entries.entries)
+            self._state.leader_contact = self._state.clock()
+            if self._state.pre_votes_from is not None:
+                # the leader is back, no election
+                self._state.pre_votes_from = None
+            with self._log_lock:
+                success = self._core.append_entries(
+                        log=self._state.log,
+                        prev_index=append_entries.prev_index,
+                        prev_term=append_entries.prev_term,
+                        entries=append_entries.entries)
             append_entries_response = None
             if success:
+                if append_entries.entries:
+                    self._state.log.sync()
                 self._state.implicit_leader = append_entries.leader_id
                 if append_entries.leader_commit >= self._state.commit_index:
-                    self._state.commit_index = min(
+                    self._state.commit_index = max(self._state.commit_index, min(
                         append_entries.leader_commit,
-                        append_entries.prev_index + len(append_entries.entries))
-                    if self._execute_message_callback is not None:
-                        for idx in range(self._state.last_applied + 1, self._state.commit_index + 1):
-                            command = self._state.log.get(idx).item
-                            logger.info(f"Following adding command {idx} for execution: {command}")
-                            self._execute_message_callback(command)
-                            self._state.last_applied = idx
+                        append_entries.prev_index + len(append_entries.entries)))
+                    self._apply_committed()
+                if self._state.commit_index >= append_entries.leader_commit:
+                    # a heartbeat alone says nothing about how far behind the log is
+                    self._state.caught_up_at = self._state.clock()
                 append_entries_response = AppendEntriesResponse(
                     success=True,
                     follower_id=self.node_num,
-                    match_index=append_entries.prev_index + len(append_entries.entries)
+                    match_index=append_entries.prev_index + len(append_entries.entries),
+                    term=self._state.current_term,
+                    seq=append_entries.seq
                 )
                 if append_entries.entries:
-                    logger.info(f"{self._state.node_num} log changed")
+                    if hot(logger, 'log_changed'):
+                        logger.info("log changed", extra=fields(node=self._state.node_num))
             else:
+                with self._log_lock:
+                    conflict_term, conflict_index = self._core.find_conflict(self._state.log, append_entries.prev_index)
                 append_entries_response = AppendEntriesResponse(
                     success=False,
-                    follower_id=self.node_num)
+                    follower_id=self.node_num,
+                    term=self._state.current_term,
+                    seq=append_entries.seq,
+                    conflict_term=conflict_term,
+                    conflict_index=conflict_index)
 
             if append_entries.entries or not success:
-                logger.info(f"<<<Received {append_entries}, responding >>> {append_entries_response}")
+                if hot(logger, 'append_entries'):
+                    logger.info("<<<Received append entries", extra=fields(request=append_entries, response=append_entries_response))
             self._send_message_callback(append_entries.leader_id, append_entries_response)
 
     def handle_append_entries_response(self, response):
+        if self._term_check(response.term) or not self._state.is_leader():
+            return
+        follower = response.follower_id
+        if response.term == self._state.current_term:
+            self._state.last_ack[follower] = self._state.clock()
+            # any answer in our term confirms leadership as of the time seq was started
+            if response.seq > self._state.acked_seq.get(follower, 0):
+                self._state.acked_seq[follower] = response.seq
+            self._reads.ack(follower, response.term, response.seq)
         if response.success:
-            if response.match_index > self._state.match_index.get(response.follower_id, 0):
-                from_match_index = str(self._state.match_index[response.follower_id])
-                from_next_index = str(self._state.next_index[response.follower_id])
-                self._state.match_index[response.follower_id] = response.match_index
-                self._state.next_index[response.follower_id] = response.match_index + 1
-                logger.info(f"match index for {response.follower_id}: {from_match_index} -> {self._state.match_index[response.follower_id]}")
-                logger.info(f"next index for {response.follower_id}: {from_next_index} -> {self._state.next_index[response.follower_id]}")
-                candidate = self._core.get_candidate_commit_index(
-                    self._state.match_index,
+            in_flight = self._state.in_flight.get(follower)
+            while in_flight and in_flight[0][1] <= response.match_index:
+                in_flight.popleft()
+            if not in_flight:
+                self._state.in_flight.pop(follower, None)
+            if response.match_index > self._state.match_index.get(follower, 0):
+                from_match_index = str(self._state.match_index[follower])
+                from_next_index = str(self._state.next_index[follower])
+                self._state.match_index[follower] = response.match_index
+                self._state.next_index[follower] = max(self._state.next_index[follower], response.match_index + 1)
+                if hot(logger, 'match_index'):
+                    logger.info("match index", extra=fields(follower=follower, old=from_match_index, new=self._state.match_index[follower]))
+                if hot(logger, 'next_index'):
+                    logger.info("next index", extra=fields(follower=follower, old=from_next_index, new=self._state.next_index[follower]))
+                candidate = self._core.commit_index_at(
+                    self._quorum_index(follower),
                     self._state.log,
-                    self._state.current_term,
-                    len(self.peers))
+                    self._state.current_term)
                 if candidate and candidate > self._state.commit_index:
                     self._state.commit_index = candidate
+                    self._apply_committed()
+            # keep the follower's pipeline full, without waiting for a tick
+            self._replicate_to(follower, self._state.clock(), heartbeat=False)
+        elif response.seq >= self._state.rewound_seq.get(follower, 0):
+            # retried from the stepped back index on the next tick
+            self._rewind(follower)
+            if response.conflict_index is None:
+                self._core.step_back_index(follower, self._state.next_index, self._state.match_index)
+                self._quorum_index(follower)
+                return
+            with self._log_lock:
+                next_index = self._core.next_index_from_conflict(
+                    self._state.log, response.conflict_term, response.conflict_index)
+            # skip a whole term per rejection, never past what the follower is known to hold
+            next_index = max(self._state.match_index[follower] + 1, min(next_index, self._state.next_index[follower]))
+            if hot(logger, 'conflict'):
+                logger.info("next index after conflict", extra=fields(follower=follower, old=self._state.next_index[follower], new=next_index, conflict_term=response.conflict_term))
+            self._state.next_index[follower] = next_index
+
+    def _apply_committed(self):
+        """ Hand the newly committed range to the state machine in one call, it is applied off the raft threads """
+        if self._execute_message_callback is None:
+            return
+        first_idx, commit_index = self._state.last_applied + 1, self._state.commit_index
+        if commit_index < first_idx:
+            return
+        # None commands are leader no-ops, passed on so the state machine's applied index keeps up
+        commands = [entry.item for entry in self._state.log.get_n(first_idx, commit_index - first_idx + 1)]
+        logger.debug("Handing commands over for execution", extra=fields(first=first_idx, last=commit_index))
+        self._execute_message_callback(first_idx, commands)
+        self._state.last_applied = commit_index
+
+    def compact(self, idx, data):
+        # Called by the state machine once it has applied everything up to idx
+        with self._log_lock:
+            if idx <= self._state.log.snapshot_index or idx > self._state.commit_index:
+                return
+            term = self._state.log.term_at(idx)
+        if self._save_snapshot(Snapshot(idx, term, data)):
+            logger.info("compacted log", extra=fields(node=self.node_num, up_to=idx))
 
-                    if self._execute_message_callback is not None:
-                        for idx in range(self._state.last_applied + 1, self._state.commit_index + 1):
-                            command = self._state.log.get(idx).item
-                            logger.info(f"Following adding command {idx} for execution: {command}")
-                            self._execute_message_callback(command)
-                            self._state.last_applied = idx
+    def _save_snapshot(self, snapshot):
+        """ Writes the snapshot without holding _log_lock, False if a later snapshot was saved meanwhile """
+        with self._snapshot_lock:
+            with self._log_lock:
+                if snapshot.last_index <= self._state.log.snapshot_index:
+                    return False
+            # the slow part, the raft loop and appends carry on meanwhile
+            self._state.write_snapshot(snapshot)
+            with self._log_lock:
+                self._state.use_snapshot(snapshot)
+        return True
+
+    def send_snapshot_chunk(self, follower):
+        snapshot = self._state.snapshot
+        last_index, offset = self._state.snapshot_offset.get(follower, (None, 0))
+        if last_index != snapshot.last_index:
+            offset = 0
+        chunk = snapshot.data[offset : offset + self._config.snapshot_chunk_size]
+        install_snapshot = InstallSnapshot(
+            term=self._state.current_term,
+            leader_id=self.node_num,
+            last_index=snapshot.last_index,
+            last_term=snapshot.last_term,
+            offset=offset,
+            data=chunk,
+            done=offset + len(chunk) >= len(snapshot.data))
+        self._send_message_callback(follower, install_snapshot)
+
+    def handle_install_snapshot(self, install_snapshot):
+        # Snapshot chunk from a leader whose log no longer holds our next entry (received by a follower)
+        self._term_check(install_snapshot.term)
+        if not self._state.is_follower() or install_snapshot.term < self._state.current_term:
+            return
+        self._state.reset_election_timeout()
+        self._state.leader_contact = self._state.clock()
+        self._state.implicit_leader = install_snapshot.leader_id
+        pending = self._state.pending_snapshot
+        if install_snapshot.offset == 0 or pending is None or pending.last_index != install_snapshot.last_index:
+            pending = Snapshot(install_snapshot.last_index, install_snapshot.last_term, bytearray())
+            self._state.pending_snapshot = pending
+        if install_snapshot.offset == len(pending.data):
+            pending.data += install_snapshot.data
+        done = install_snapshot.done and install_snapshot.offset + len(install_snapshot.data) == len(pending.data)
+        if done:
+            self._state.pending_snapshot = None
+            if install_snapshot.last_index > self._state.commit_index:
+                self.install_snapshot(Snapshot(pending.last_index, pending.last_term, bytes(pending.data)))
+        response = InstallSnapshotResponse(
+            follower_id=self.node_num,
+            term=self._state.current_term,
+            last_index=install_snapshot.last_index,
+            offset=len(pending.data),
+            done=done)
+        self._send_message_callback(install_snapshot.leader_id, response)
+
+    def install_snapshot(self, snapshot):
+        self._save_snapshot(snapshot)
+        logger.info("installed snapshot", extra=fields(node=self.node_num, snapshot=snapshot))
+        self._state.commit_index = max(self._state.commit_index, snapshot.last_index)
+        if self._install_snapshot_callback is not None and self._state.last_applied < snapshot.last_index:
+            self._install_snapshot_callback(snapshot)
+            self._state.last_applied = snapshot.last_index
+
+    def _quorum_index(self, follower):
+        """ Feed follower's match index to the quorum tracker, rebuilt only when match_index was replaced """
+        if self._state.quorum is None:
+            self._state.quorum = QuorumTracker(self._state.match_index, self._core.quorum_size(len(self.peers)))
         else:
-            self._core.step_back_index(response.follower_id, self._state.next_index, self._state.match_index)
+            self._state.quorum.update(follower, self._state.match_index[follower])
+        return self._state.quorum.quorum_index()
+
+    def handle_install_snapshot_response(self, response):
+        if self._term_check(response.term) or not self._state.is_leader():
+            return
+        follower = response.follower_id
+        self._state.last_ack[follower] = self._state.clock()
+        self._state.in_flight.pop(follower, None)
+        if response.done:
+            self._state.snapshot_offset.pop(follower, None)
+            if response.last_index > self._state.match_index.get(follower, 0):
+                self._state.match_index[follower] = response.last_index
+                self._state.next_index[follower] = max(self._state.next_index[follower], response.last_index + 1)
+                self._quorum_index(follower)
+        elif self._state.snapshot is not None and response.last_index == self._state.snapshot.last_index:
+            self._state.snapshot_offset[follower] = (response.last_index, response.offset)
+        # stream the next chunk or the entries after the snapshot without waiting for a heartbeat
+        self._replicate_to(follower, self._state.clock(), heartbeat=False)
+
+    def replicate(self):
+        """ Send new entries to every follower with nothing in flight, called when the log grows (leader) """
+        if self._state.is_leader():
+            now = self._state.clock()
+            for follower in self.peers:
+                self._replicate_to(follower, now, heartbeat=False)
 
     def handle_heartbeat(self):
+        """ Timer tick: retransmit stalled RPCs and send empty AppendEntries to idle followers (leader) """
         if self._state.is_leader():
+            now = self._state.clock()
+            if self._config.check_quorum and not self._quorum_alive(now):
+                self._step_down()
+                return
+            # messages sent from this tick on carry a new seq, their acknowledgements extend the lease
+            self._state.next_seq(now)
             for follower in self.peers:
-                entries_to_send = self._state.log.size() - self._state.next_index[follower] + 1
-                entries = self._state.log.get_n(self._state.next_index[follower], entries_to_send)
+                self._replicate_to(follower, now, heartbeat=True)
+            self._reads.retry(self._config.replication_timeout)
+
+    def _quorum_alive(self, now):
+        alive = sum(1 for follower in self.peers
+            if now - self._state.last_ack.get(follower, float('-inf')) < RaftState.ELECTION_TIMEOUT_MAX)
+        return alive >= self._core.quorum_size(len(self.peers))
+
+    def _step_down(self):
+        # same term and vote, a majority may already follow a new leader elected without us
+        logger.warning("lost contact with a majority, stepping down", extra=fields(node=self.node_num, term=self._state.current_term))
+        with self._log_lock:
+            self._state.status = Status.FOLLOWER
+        # no leader known until one reaches us, requests fail fast rather than being redirected back here
+        self._state.implicit_leader = None
+        self._state.reset_election_timeout()
+        self._reads.abort()
+
+    def _replicate_to(self, follower, now, heartbeat):
+        in_flight = self._state.in_flight.get(follower)
+        if in_flight and now - in_flight[0][2] >= self._config.replication_timeout:
+            if hot(logger, 'resend', logging.WARNING):
+                logger.warning("No response, resending", extra=fields(follower=follower, after=in_flight[0][0]))
+            self._rewind(follower)
+            in_flight = None
+            # it may be working through a backlog, a heartbeat gets to it ahead of the resent entries
+            stalled = True
+        else:
+            stalled = False
+        sent = False
+        # entries are pipelined, next_index moves on as soon as a batch is sent
+        while len(in_flight or ()) < self._config.max_in_flight:
+            with self._log_lock:
+                next_index = self._state.next_index[follower]
+                if next_index <= self._state.log.snapshot_index:
+                    if not in_flight:
+                        self.send_snapshot_chunk(follower)
+                        self._state.in_flight[follower] = deque([(next_index - 1, self._state.snapshot.last_index, now)])
+                        self._state.last_sent[follower] = now
+                    return
+                entries = self._fit_batch(self._state.log.get_n(next_index, self._config.max_append_entries))
+                prev_index = next_index - 1
+                prev_term = self._state.log.term_at(prev_index)
+            if not entries:
+                break
+            in_flight = self._state.in_flight.setdefault(follower, deque())
+            in_flight.append((prev_index, prev_index + len(entries), now))
+            self._state.next_index[follower] = prev_index + len(entries) + 1
+            self._send_append_entries(follower, prev_index, prev_term, entries, now)
+            sent = True
+        due = now - self._state.last_sent.get(follower, float('-inf')) >= self._config.heartbeat_interval
+        if stalled or (not sent and heartbeat and due):
+            with self._log_lock:
+                # behind batches still in flight, a follower handling heartbeats first must hold prev_index
                 prev_index = self._state.next_index[follower] - 1
-                prev_term = self._state.log.get(prev_index).term if self._state.next_index[follower] > 1 else None
-                append_entries = AppendEntries(
-                    term=self._state.current_term,
-                    leader_id=self.node_num,
-                    prev_term=prev_term,
-                    prev_index=prev_index,
-                    leader_commit=self._state.commit_index,
-                    entries=entries)
-                self._send_message_callback(follower, append_entries)
+                if in_flight:
+                    prev_index = max(in_flight[0][0], self._state.log.snapshot_index)
+                prev_term = self._state.log.term_at(prev_index)
+            self._send_append_entries(follower, prev_index, prev_term, [], now)
+
+    def _fit_batch(self, entries):
+        # the first entry always goes, the rest only while the batch stays within max_append_bytes
+        size = 0
+        for count, entry in enumerate(entries):
+            size += entry.encoded_size()
+            if count and size > self._config.max_append_bytes:
+                return entries[:count]
+        return entries
+
+    def _send_append_entries(self, follower, prev_index, prev_term, entries, now):
+        self._state.last_sent[follower] = now
+        append_entries = AppendEntries(
+            term=self._state.current_term,
+            leader_id=self.node_num,
+            prev_term=prev_term,
+            prev_index=prev_index,
+            leader_commit=self._state.commit_index,
+            entries=entries,
+            seq=self._state.seq)
+        self._send_message_callback(follower, append_entries)
+
+    def _rewind(self, follower):
+        # forget the pipeline and resume from the oldest unacknowledged entry
+        in_flight = self._state.in_flight.pop(follower, None)
+        if in_flight:
+            self._state.next_index[follower] = in_flight[0][0] + 1
+        # rejections of what was sent before are about a window that is gone, a new seq tells them apart
+        self._state.rewound_seq[follower] = self._state.next_seq(self._state.clock())
@@ -1,18 +1,163 @@
-from queue import Queue
-from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR
-from threading import Thread
+from collections import deque
+from socket import socket, AF_INET, SOCK_DGRAM, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, IPPROTO_TCP, TCP_NODELAY, SHUT_RDWR
+from threading import Thread, Lock, Condition
+from time import perf_counter
 import os
 
 from library.logging import get_logger
+from library.messages import frame, recv_message
+from schema.raft_rpc import AppendEntries, RequestVote, RequestVoteResponse, InstallSnapshot
 
 logger = get_logger(os.path.basename(__file__))
 
+# first byte of a datagram carrying several messages, each behind a 4 byte length
+PACKED = 255
+DATAGRAM_SIZE = 8192
+
+def supersedes(new, old):
+    """ Whether the newer AppendEntries new makes the pending old one pointless to send """
+    if not isinstance(old, AppendEntries) or not isinstance(new, AppendEntries):
+        return False
+    if new.term != old.term:
+        return new.term > old.term
+    # a heartbeat only carries leader_commit and seq, the newer message has both at least as high
+    if not old.entries:
+        return True
+    return new.prev_index <= old.prev_index and new.prev_index + len(new.entries) >= old.prev_index + len(old.entries)
+
+def pack(msgs, size=DATAGRAM_SIZE):
+    """ Serialized messages grouped into as few datagrams of at most size bytes as they fit in """
+    packets, packet, packet_size = [], [], 1
+    for msg in msgs:
+        if len(msg) > size:
+            # cut short it would not decode on the other side
+            logger.error(f"Dropping a {len(msg)} byte message, datagrams carry at most {size} bytes")
+            continue
+        if packet and packet_size + 4 + len(msg) > size:
+            packets.append(packet)
+            packet, packet_size = [], 1
+        packet.append(msg)
+        packet_size += 4 + len(msg)
+    if packet:
+        packets.append(packet)
+    # a lone message goes out as is
+    return [packet[0] if len(packet) == 1 else
+        bytes([PACKED]) + b''.join(len(msg).to_bytes(4, 'big') + msg for msg in packet)
+        for packet in packets]
+
+def unpack(packet):
+    if packet[:1] != bytes([PACKED]):
+        return [packet]
+    msgs, offset = [], 1
+    while offset < len(packet):
+        size = int.from_bytes(packet[offset:offset + 4], 'big')
+        msgs.append(packet[offset + 4:offset + 4 + size])
+        offset += 4 + size
+    return msgs
+
+class Outbox:
+    """
+    Messages waiting for one peer. A new AppendEntries replaces the pending ones it
+    supersedes and past max_pending the oldest message is dropped, so a slow or dead
+    peer holds a bounded backlog and only current messages go out when it returns.
+    """
+    def __init__(self, max_pending):
+        self._pending = deque()
+        self._max_pending = max_pending
+        self._closed = False
+        self._cond = Condition()
+        self.superseded = 0
+        self.dropped = 0
+
+    def put(self, msg):
+        with self._cond:
+            if isinstance(msg, AppendEntries):
+                kept = deque(old for old in self._pending if not supersedes(msg, old))
+                self.superseded += len(self._pending) - len(kept)
+                self._pending = kept
+            if len(self._pending) >= self._max_pending:
+                self._pending.popleft()
+                self.dropped += 1
+            self._pending.append(msg)
+            self._cond.notify()
+
+    def take(self):
+        """ Blocks until something is pending and returns all of it, [] once closed """
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            msgs = list(self._pending)
+            self._pending.clear()
+            return msgs
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._pending.clear()
+            self._cond.notify_all()
+
+    def __len__(self):
+        return len(self._pending)
+
+class InboundScheduler:
+    """
+    Inbound messages in three classes served in priority order: votes and heartbeats, then
+    responses, then AppendEntries carrying entries and snapshot chunks. A backlog of bulk
+    replication no longer holds back the messages that keep followers from starting elections.
+    Order within a class is kept, prioritize=False serves everything first in first out.
+    """
+    CONTROL, RESPONSES, BULK = range(3)
+    NAMES = ('control', 'responses', 'bulk')
+
+    def __init__(self, prioritize=True):
+        self._queues = [deque() for _ in self.NAMES]
+        self._prioritize = prioritize
+        self._cond = Condition()
+
+    @classmethod
+    def classify(cls, msg):
+        # None wakes a blocked receiver, it must not wait behind anything
+        if msg is None or RequestVote.is_type(msg) or RequestVoteResponse.is_type(msg) or AppendEntries.is_heartbeat(msg):
+            return cls.CONTROL
+        if AppendEntries.is_type(msg) or InstallSnapshot.is_type(msg):
+            return cls.BULK
+        return cls.RESPONSES
+
+    def put(self, msg):
+        klass = self.classify(msg) if self._prioritize else self.CONTROL
+        with self._cond:
+            self._queues[klass].append(msg)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """ The next message by priority, None after timeout seconds without one """
+        with self._cond:
+            if not self._cond.wait_for(self._pending, timeout):
+                return None
+            for queue in self._queues:
+                if queue:
+                    return queue.popleft()
+
+    def _pending(self):
+        return any(self._queues)
+
+    def empty(self):
+        return not self._pending()
+
+    def depths(self):
+        return [(name, len(queue)) for name, queue in zip(self.NAMES, self._queues)]
+
 class RaftNetworking:
     """ ascii format for send/receive, ascii encoded binary as wire format """
-    def __init__(self, addr, node_num_to_addrs):
+    # per peer, beyond it the oldest unsent message is dropped and left to raft to resend
+    MAX_PENDING = 256
+
+    def __init__(self, addr, node_num_to_addrs, inbound_priority=True):
         # My own address
-        self._msgs_inbound = Queue()
-        self._msgs_outbound = {n: Queue() for n in node_num_to_addrs}
+        self._msgs_inbound = InboundScheduler(inbound_priority)
+        self._msgs_outbound = {n: Outbox(self.MAX_PENDING) for n in node_num_to_addrs}
+        # syscalls made by the senders, each carrying one or more messages
+        self.packets_sent = 0
         self.node_num_to_addrs = node_num_to_addrs
         self._sock = self.build_socket(addr)
 
@@ -28,29 +173,152 @@ class RaftNetworking:
         sock.bind(addr)
         return sock
         
+    def queue_depths(self):
+        """ (labels, depth) pairs for the metrics endpoint """
+        depths = [({'queue': 'raft_inbound', 'class': name}, depth) for name, depth in self._msgs_inbound.depths()]
+        for destination, outbound in self._msgs_outbound.items():
+            depths.append(({'queue': 'raft_outbound', 'peer': destination}, len(outbound)))
+        return depths
+
     def inbound_queue_empty(self):
         return self._msgs_inbound.empty()
 
+    def wake(self):
+        """ Returns a blocked receive early so the event loop picks up work queued by other threads """
+        self._msgs_inbound.put(None)
+
     def end(self):
         self._msgs_inbound.put(None)
-	
+        for outbound in self._msgs_outbound.values():
+            outbound.close()
+
     # Send a msg to a specific node number (returns immediately)
     def send(self, destination, msg):
         self._msgs_outbound[destination].put(msg)
 
-    # Receive and return any msg sent to me (blocks)
-    def receive(self):
-        return self._msgs_inbound.get()
+    # Receive and return any msg sent to me (blocks), None after timeout seconds without one
+    def receive(self, timeout=None):
+        return self._msgs_inbound.get(timeout)
 
     def _msg_sender(self, destination):
         while True:
-            obj = self._msgs_outbound[destination].get()
+            objs = self._msgs_outbound[destination].take()
+            if not objs:
+                return
+            for packet in pack([obj.serialize() for obj in objs]):
+                try:
+                    self._sock.sendto(packet, self.node_num_to_addrs[destination])
+                    self.packets_sent += 1
+                except OSError:
+                    logger.error("Error: Not connected")
+
+    def _msg_receiver(self):
+        while True:
+            msg, addr = self._sock.recvfrom(DATAGRAM_SIZE)
+            for part in unpack(msg):
+                self._msgs_inbound.put(part)
+
+class StreamRaftNetworking(RaftNetworking):
+    """
+    Same interface over TCP: one outbound connection per peer carrying length prefixed
+    frames, so a message has no size limit, and everything pending goes out in one write.
+    A broken connection is reopened by the next message, messages that cannot be delivered
+    meanwhile are dropped and raft resends them.
+    """
+    CONNECT_TIMEOUT = 1.0
+    # after a failed connect, messages to that peer are dropped for this long instead of retrying each one
+    RECONNECT_BACKOFF = 0.1
+
+    def __init__(self, addr, node_num_to_addrs, inbound_priority=True):
+        self._running = True
+        self._connections = {}
+        self._inbound_sockets = set()
+        self._sockets_lock = Lock()
+        super().__init__(addr, node_num_to_addrs, inbound_priority)
+
+    @classmethod
+    def build_socket(cls, addr):
+        logger.info(f"Initialized stream transport at {addr}")
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        sock.bind(addr)
+        sock.listen()
+        return sock
+
+    def end(self):
+        self._running = False
+        with self._sockets_lock:
+            sockets = [self._sock] + list(self._inbound_sockets) + list(self._connections.values())
+        for sock in sockets:
+            # wakes threads blocked in accept or recv, close alone does not
             try:
-                self._sock.sendto(obj.serialize(), self.node_num_to_addrs[destination])
+                sock.shutdown(SHUT_RDWR)
             except OSError:
-                logger.error("Error: Not connected")
+                pass
+            sock.close()
+        super().end()
+
+    def _msg_sender(self, destination):
+        failed_at = float('-inf')
+        while self._running:
+            objs = self._msgs_outbound[destination].take()
+            if not objs:
+                return
+            sock = self._connections.get(destination)
+            if sock is None:
+                if perf_counter() - failed_at < self.RECONNECT_BACKOFF:
+                    continue
+                sock = self._connect(destination)
+                if sock is None:
+                    failed_at = perf_counter()
+                    continue
+            try:
+                sock.sendall(b''.join(frame(obj.serialize()) for obj in objs))
+                self.packets_sent += 1
+            except OSError:
+                logger.warning(f"Connection to {destination} lost, reconnecting on the next message")
+                self._disconnect(destination)
+
+    def _connect(self, destination):
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.settimeout(self.CONNECT_TIMEOUT)
+        try:
+            sock.connect(self.node_num_to_addrs[destination])
+        except OSError:
+            sock.close()
+            return None
+        sock.settimeout(None)
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        with self._sockets_lock:
+            if not self._running:
+                sock.close()
+                return None
+            self._connections[destination] = sock
+        return sock
+
+    def _disconnect(self, destination):
+        with self._sockets_lock:
+            sock = self._connections.pop(destination, None)
+        if sock is not None:
+            sock.close()
 
     def _msg_receiver(self):
-        while True:
-            msg, addr = self._sock.recvfrom(8192)
-            self._msgs_inbound.put(msg)
+        while self._running:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            with self._sockets_lock:
+                self._inbound_sockets.add(conn)
+            Thread(target=self._read_connection, args=[conn]).start()
+
+    def _read_connection(self, conn):
+        try:
+            while self._running:
+                self._msgs_inbound.put(recv_message(conn))
+        except (IOError, ValueError):
+            pass
+        finally:
+            with self._sockets_lock:
+                self._inbound_sockets.discard(conn)
+            conn.close()
@@ -0,0 +1,109 @@
+from threading import Lock, Event
+from time import perf_counter
+import os
+
+from library.logging import get_logger
+
+logger = get_logger(os.path.basename(__file__))
+
+class ReadRound:
+    def __init__(self):
+        self.term = None
+        self.read_index = None
+        self.seq = None
+        self.sent_at = None
+        self.acks = set()
+        self.confirmed = False
+        self.done = Event()
+
+class ReadIndexBatcher:
+    """
+    Coalesces linearizable reads into leadership confirmation rounds (ReadIndex).
+    probe_callback records the commit index, sends one empty AppendEntries round
+    and returns (term, commit_index, seq) where seq tags the round. Once quorum
+    peers acknowledged seq (or later) in that term the round's reads may be served
+    at its read index. One round is outstanding at a time, reads arriving
+    meanwhile share the next one. Readers only queue and call wake, probes are sent
+    from probe() so they come from the same thread as the rest of replication.
+    """
+    def __init__(self, probe_callback, quorum, clock=perf_counter, wake=None):
+        self._probe_callback = probe_callback
+        self._quorum = quorum
+        self._clock = clock
+        self._wake = wake if wake is not None else self.probe
+        self._lock = Lock()
+        self._outstanding = None
+        self._queued = None
+
+    def read(self, timeout):
+        """ Returns the index the state machine must reach before serving the read, None if leadership was not confirmed """
+        with self._lock:
+            if self._queued is None:
+                self._queued = ReadRound()
+            round = self._queued
+            idle = self._outstanding is None
+        if idle:
+            self._wake()
+        if not round.done.wait(timeout) or not round.confirmed:
+            return None
+        return round.read_index
+
+    def probe(self):
+        """ Starts a round for queued reads unless one is outstanding """
+        with self._lock:
+            if self._outstanding is None and self._queued is not None:
+                self._start()
+
+    def ack(self, follower, term, seq):
+        with self._lock:
+            round = self._outstanding
+            if round is None or term != round.term or seq < round.seq:
+                return
+            round.acks.add(follower)
+            self._check(round)
+
+    def retry(self, timeout):
+        """ Re-probe a round that has been waiting for acknowledgements longer than timeout """
+        with self._lock:
+            round = self._outstanding
+            if round is None or self._clock() - round.sent_at < timeout:
+                return
+            logger.warning(f"Read round {round.seq} not confirmed after {timeout}s, probing again")
+            term = self._probe(round)
+            if term != round.term:
+                self._finish(False)
+
+    def abort(self):
+        """ Leadership lost, fail every waiting read """
+        with self._lock:
+            for round in (self._outstanding, self._queued):
+                if round is not None:
+                    round.done.set()
+            self._outstanding = None
+            self._queued = None
+
+    def _start(self):
+        round, self._queued = self._queued, None
+        self._outstanding = round
+        round.term = self._probe(round)
+        self._check(round)
+
+    def _probe(self, round):
+        round.sent_at = self._clock()
+        term, commit_index, round.seq = self._probe_callback()
+        # a retried round keeps the index recorded before its first probe
+        if round.read_index is None:
+            round.read_index = commit_index
+        return term
+
+    def _check(self, round):
+        if len(round.acks) >= self._quorum:
+            self._finish(True)
+
+    def _finish(self, confirmed):
+        round = self._outstanding
+        self._outstanding = None
+        round.confirmed = confirmed
+        round.done.set()
+        if self._queued is not None:
+            self._start()
@@ -1,17 +1,29 @@
-from time import sleep
 from threading import Thread
+import logging
 import os
-from queue import Queue
+from queue import Queue, Empty
 import uuid
 
 from raft_handler import RaftHandler
-from raft_networking import RaftNetworking
+from raft_networking import RaftNetworking, StreamRaftNetworking
 from service_discovery import ServiceDiscovery
-from library.logging import get_logger
+from library.logging import get_logger, hot
+from library.utils import TimerHeap
 
 logger = get_logger(os.path.basename(__file__))
 
 class RaftRuntime:
+    """
+    One event loop thread owns raft message handling and timers. It blocks on the
+    inbound queue until a message arrives or the next deadline in its timer heap:
+    the election timeout of a follower or candidate, the heartbeat tick of a leader.
+    Client threads append to the log and wake it, replication and read probes are sent from here.
+    """
+    # leader heartbeat loop period, handle_heartbeat decides what is actually sent
+    HEARTBEAT_TICK = 0.005
+    # longest wait without a message, state changed outside the loop (console, tests) is picked up by then
+    MAX_WAIT = 0.05
+
     def __init__(self, raft_networking):
         self._running = False
         self._raft_handler = None
@@ -19,25 +31,30 @@ class RaftRuntime:
         self._execute_msg_queue = Queue()
 
     @classmethod
-    def build_runtime(cls, node_num=None, server_config=None):
+    def build_runtime(cls, node_num=None, server_config=None, config=None, metrics=None):
         peers_server_config = {n: addr for n, addr in server_config.items() if n != node_num}
         peers = sorted(peers_server_config.keys())
         addr = server_config[node_num]
-        raft_networking = RaftNetworking(addr, peers_server_config)
+        stream = config is not None and config.transport == 'tcp'
+        inbound_priority = config is None or config.inbound_priority
+        raft_networking = (StreamRaftNetworking if stream else RaftNetworking)(addr, peers_server_config, inbound_priority)
         runtime = RaftRuntime(raft_networking)
-        handler = RaftHandler.build_new(node_num, peers, raft_networking.send, runtime.put_msg_to_execute)
+        if metrics is not None:
+            metrics.gauge('kv_queue_depth', 'Items waiting in each queue', raft_networking.queue_depths)
+        handler = RaftHandler.build_new(
+            node_num, peers, raft_networking.send, runtime.put_msg_to_execute, config,
+            install_snapshot_callback=runtime.put_snapshot_to_install, metrics=metrics)
         runtime.add_raft_handler(handler)
         return runtime
     
     def add_raft_handler(self, handler):
         self._raft_handler = handler
+        handler.set_wake(self._raft_networking.wake)
 
     def start(self):
         assert(self._raft_handler is not None)
         self._running = True
-        Thread(target=self.election_loop).start()
-        Thread(target=self.process_messages).start()
-        Thread(target=self.process_heartheat).start()
+        Thread(target=self.event_loop).start()
 
     def stop(self):
         self._running = False
@@ -50,32 +67,73 @@ class RaftRuntime:
     def running(self):
         return self._running
 
-    def election_loop(self):
-        while self._running:
-            self._raft_handler.check_election_timeout()
-            sleep(0.001)
-
-    def process_heartheat(self):
+    def event_loop(self):
+        timers = TimerHeap()
+        clock = self._raft_handler._state.clock
         while self._running:
-            self._raft_handler.handle_heartbeat()
-            sleep(0.005)
+            now = clock()
+            for timer in timers.pop_due(now):
+                if timer == 'election':
+                    self._raft_handler.check_election_timeout()
+                else:
+                    self._raft_handler.handle_heartbeat()
+            self._arm_timers(timers, now)
+            deadline = min(timers.next_deadline(), now + self.MAX_WAIT)
+            msg = self._raft_networking.receive(timeout=max(0, deadline - clock()))
+            # None on timeout, or a touch to wake the loop or end blocked threads on queue.get()
+            if msg is not None:
+                try:
+                    self._raft_handler.receive(msg)
+                except Exception as e:
+                    # a truncated or malformed message is dropped, the loop is the node's only raft thread
+                    if hot(logger, 'bad_message', logging.ERROR):
+                        logger.error(f"Dropping message that could not be handled: {e!r}")
+            self._raft_handler.run_pending()
 
-    def process_messages(self):
-        while self._running:
-            msg = self._raft_networking.receive()
-            if msg is None:  # touch, used to end blocked threads on queue.get()
-                continue
-            self._raft_handler.receive(msg)
-    
-    def get_msg_to_execute(self):
-        return self._execute_msg_queue.get()
+    def _arm_timers(self, timers, now):
+        state = self._raft_handler._state
+        if state.is_leader():
+            timers.cancel('election')
+            if not timers.scheduled('heartbeat'):
+                timers.schedule('heartbeat', now + self.HEARTBEAT_TICK)
+        else:
+            timers.cancel('heartbeat')
+            timers.schedule('election', state.election_deadline)
     
-    def put_msg_to_execute(self, msg):
-        return self._execute_msg_queue.put(msg)
+    def put_msg_to_execute(self, first_idx, msgs):
+        """ Queues a committed range, msgs holds the commands of first_idx onwards """
+        return self._execute_msg_queue.put((first_idx, msgs))
+
+    def get_msgs_to_execute(self, max_items):
+        """ Blocks for one queued item then takes whatever else is already waiting, up to max_items """
+        items = [self._execute_msg_queue.get()]
+        while len(items) < max_items:
+            try:
+                items.append(self._execute_msg_queue.get_nowait())
+            except Empty:
+                break
+        return items
+
+    def put_snapshot_to_install(self, snapshot):
+        # queued behind the commands it replaces so the state machine sees them in log order
+        return self._execute_msg_queue.put((snapshot.last_index, snapshot))
+
+    def compact(self, idx, data):
+        return self._raft_handler.compact(idx, data)
+
+    @property
+    def config(self):
+        return self._raft_handler.config
     
-    def log_append(self, msg):
-        return self._raft_handler.log_append(msg)
+    def log_append(self, msg, queued=None):
+        return self._raft_handler.log_append(msg, queued)
     
+    def read_index(self):
+        return self._raft_handler.read_index(RaftHandler.REQUEST_TIMEOUT)
+
+    def follower_read_index(self, max_staleness):
+        return self._raft_handler.follower_read_index(max_staleness, RaftHandler.REQUEST_TIMEOUT)
+
     def redirect_to_leader(self):
         return self._raft_handler.redirect_to_leader()
 
@@ -1,8 +1,9 @@
 from enum import Enum
+import json
 import os
 import uuid
 
-from library.utils import split_and_pad
+from library.utils import split_and_pad, pairwise
 from schema.base_schema import BaseSchema
 from library.logging import get_logger
 
@@ -19,32 +20,72 @@ class Action(Enum):
     GET = 1
     SET = 2
     DELETE = 3
+    # multi key actions, key is a list of keys and MSET's value the list of their values
+    MGET = 4
+    MSET = 5
+    MDELETE = 6
+    # metrics of the node receiving it, never replicated
+    STATS = 7
+
+MULTI_KEY_ACTIONS = (Action.MGET, Action.MSET, Action.MDELETE)
+
+class Consistency(Enum):
+    """ How fresh a GET must be: STRONG reads are linearizable and served by the leader,
+    BOUNDED reads may be served by a follower that held everything the leader had committed within max_staleness seconds,
+    ANY reads are served by whichever node receives them """
+    STRONG = 1
+    BOUNDED = 2
+    ANY = 3
 
 class KVStoreRequest(BaseSchema):
     KEY = 0
+    DEFAULT_MAX_STALENESS = 1.0
 
-    def __init__(self, action, key=None, value=None, id=None):
+    def __init__(self, action, key=None, value=None, id=None, consistency=Consistency.STRONG, max_staleness=None):
         # validation
-        if action not in (Action.GET, Action.SET, Action.DELETE)\
+        if not isinstance(action, Action)\
                 or (action == Action.GET and (not key or value))\
                 or (action == Action.SET and not (key or value))\
-                or (action == Action.DELETE and (not key or value)):
+                or (action == Action.DELETE and (not key or value))\
+                or (action in MULTI_KEY_ACTIONS and (not isinstance(key, list) or not key))\
+                or (action in (Action.MGET, Action.MDELETE) and value)\
+                or (action == Action.MSET and (not isinstance(value, list) or len(key) != len(value)))\
+                or (action == Action.STATS and (key or value)):
             raise ValueError("Invalid request")
         self._id = str(uuid.uuid4()) if id is None else id
         self._action = action
         self._key = key
         self._value = value
+        self._consistency = consistency
+        self._max_staleness = max_staleness if max_staleness is not None else self.DEFAULT_MAX_STALENESS
 
     @classmethod
     def build_from_msg(self, msg):
+        action = Action[msg.split(" ", 1)[0].upper()]
+        if action in MULTI_KEY_ACTIONS:
+            # mget <key>..., mdelete <key>..., mset <key> <value>...
+            args = msg.split()[1:]
+            if action == Action.MSET:
+                if len(args) % 2:
+                    raise ValueError("mset needs a value for every key")
+                pairs = list(pairwise(args))
+                return KVStoreRequest(action, [k for k, _ in pairs], [v for _, v in pairs])
+            return KVStoreRequest(action, args)
         command, key, value = split_and_pad(msg, " ", 3)
-        return KVStoreRequest(Action[command.upper()], key, value)
+        if action == Action.GET and value:
+            # get <key> <strong|bounded|any>
+            return KVStoreRequest(action, key, consistency=Consistency[value.upper()])
+        return KVStoreRequest(action, key, value)
 
     def __repr__(self):
         if self._action == Action.GET or self._action == Action.DELETE:
             return f"{self._id}{self._action.value}{self._key}"
         elif self._action == Action.SET:
             return f"{self._id}{self._action.value}{self._key}>{self._value}"
+        elif self._action == Action.MSET:
+            return f"{self._id}{self._action.value}{json.dumps([self._key, self._value])}"
+        else:
+            return f"{self._id}{self._action.value}{json.dumps(self._key)}"
     
     @classmethod
     def from_serialized_msg(cls, msg):
@@ -55,6 +96,11 @@ class KVStoreRequest(BaseSchema):
         elif action == Action.SET:
             key, value = msg[37:].split(">")
             return KVStoreRequest(action, key, value, id=id)
+        elif action == Action.MSET:
+            keys, values = json.loads(msg[37:])
+            return KVStoreRequest(action, keys, values, id=id)
+        elif action in MULTI_KEY_ACTIONS:
+            return KVStoreRequest(action, json.loads(msg[37:]), id=id)
         else:
             raise ValueError("Invalid format")
 
@@ -65,22 +111,47 @@ class KVStoreRequest(BaseSchema):
     def is_get(self):
         return self._action == Action.GET
 
+    def is_read(self):
+        return self._action in (Action.GET, Action.MGET)
+
+    def is_mget(self):
+        return self._action == Action.MGET
+
+    def is_mset(self):
+        return self._action == Action.MSET
+
+    def is_mdelete(self):
+        return self._action == Action.MDELETE
+
     def is_set(self):
         return self._action == Action.SET
 
     def is_delete(self):
         return self._action == Action.DELETE
 
+    def is_stats(self):
+        return self._action == Action.STATS
+
     @property
     def value(self):
         return self._value
 
+    @property
+    def consistency(self):
+        return self._consistency
+
+    @property
+    def max_staleness(self):
+        return self._max_staleness
+
 class KVStoreResponse(BaseSchema):
     KEY = 1
 
-    def __init__(self, status, msg=None):
+    def __init__(self, status, msg=None, id=None):
         self._status = status
         self._msg = msg
+        # id of the request answered, pipelined clients match responses with it
+        self._id = id
 
     def __repr__(self):
         return f"{self._status.name} '{self._msg}'" if self._msg is not None else self._status.name
@@ -89,6 +160,14 @@ class KVStoreResponse(BaseSchema):
     def msg(self):
         return self._msg
 
+    @property
+    def id(self):
+        return self._id
+
+    @id.setter
+    def id(self, new_id):
+        self._id = new_id
+
     def is_success(self):
         return self._status == Status.SUCCESS
 
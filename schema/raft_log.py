@@ -1,8 +1,53 @@
+import struct
 
 class LogEntry:
+    """
+    Wire and disk layout is term | length | item as utf-8, NO_ITEM as length means item is None.
+    Entries read off the wire keep their payload as a memoryview and only decode it when item is used.
+    """
+    HEADER = struct.Struct('>QI')
+    NO_ITEM = 0xFFFFFFFF
+
     def __init__(self, term, item):
         self.term = term
-        self.item = item
+        self._item = item
+        self._raw = None
+
+    @property
+    def item(self):
+        if self._raw is not None:
+            self._item = str(self._raw, 'utf-8')
+            self._raw = None
+        return self._item
+
+    def payload(self):
+        if self._raw is not None:
+            return self._raw
+        return None if self._item is None else self._item.encode()
+
+    def encoded_size(self):
+        payload = self.payload()
+        return self.HEADER.size + (0 if payload is None else len(payload))
+
+    def encode(self):
+        payload = self.payload()
+        if payload is None:
+            return self.HEADER.pack(self.term, self.NO_ITEM)
+        return self.HEADER.pack(self.term, len(payload)) + payload
+
+    @classmethod
+    def decode(cls, buf, offset=0):
+        """ Returns the entry at offset of buf and the offset just past it """
+        term, length = cls.HEADER.unpack_from(buf, offset)
+        offset += cls.HEADER.size
+        entry = LogEntry(term, None)
+        if length != cls.NO_ITEM:
+            entry._raw = memoryview(buf)[offset : offset + length]
+            offset += length
+        return entry, offset
+
+    def __getstate__(self):
+        return {'term': self.term, '_item': self.item, '_raw': None}
 
     @classmethod
     def from_str(cls, s):
@@ -17,47 +62,231 @@ class LogEntry:
 
     def __eq__(self, other):
         if isinstance(other, LogEntry):
-            return self.term == other.term and self.item == other.item
+            return self.term == other.term and self.payload() == other.payload()
         else:
             return False
 
+def encode_entries(entries):
+    return b''.join(entry.encode() for entry in entries)
+
+def decode_entries(buf, offset, count):
+    # LogEntry.decode unrolled, this runs once per replicated entry on every follower
+    view = memoryview(buf)
+    unpack_from = LogEntry.HEADER.unpack_from
+    header_size = LogEntry.HEADER.size
+    no_item = LogEntry.NO_ITEM
+    entries = []
+    for _ in range(count):
+        term, length = unpack_from(view, offset)
+        offset += header_size
+        entry = LogEntry.__new__(LogEntry)
+        entry.term = term
+        entry._item = None
+        if length != no_item:
+            entry._raw = view[offset : offset + length]
+            offset += length
+        else:
+            entry._raw = None
+        entries.append(entry)
+    return entries, offset
+
 def log_entries_list_to_str(log_entries):
     return ",".join([str(x) for x in log_entries])
 
 def str_to_log_entries_list(log_entries_str):
     return [LogEntry.from_str(x) for x in log_entries_str.split(",") if x != ""]
 
+class Snapshot:
+    """ State machine image covering every log entry up to and including last_index """
+    def __init__(self, last_index, last_term, data):
+        self.last_index = last_index
+        self.last_term = last_term
+        self.data = data
+
+    def __repr__(self):
+        return f"Snapshot({self.last_index}@{self.last_term}, {len(self.data)} bytes)"
+
+    def __eq__(self, other):
+        if isinstance(other, Snapshot):
+            return (self.last_index, self.last_term, self.data) == (other.last_index, other.last_term, other.data)
+        else:
+            return False
+
 class Logs:
-    """ idx starts at 1 """
-    def __init__(self, entries=None):
+    """ idx starts at 1, entries up to snapshot_index are compacted away """
+    def __init__(self, entries=None, snapshot_index=0, snapshot_term=None):
+        self.snapshot_index = snapshot_index
+        self.snapshot_term = snapshot_term
         self.logs = entries or []
 
+    @property
+    def logs(self):
+        return self._logs
+
+    @logs.setter
+    def logs(self, entries):
+        self._logs = entries
+        # [term, first index] for every run of entries, terms only grow along the log
+        self._term_starts = []
+        self._index_terms(self.snapshot_index + 1)
+
+    def _index_terms(self, idx):
+        """ Refresh the term table for entries from idx on """
+        while self._term_starts and self._term_starts[-1][1] >= idx:
+            self._term_starts.pop()
+        last_term = self._term_starts[-1][0] if self._term_starts else None
+        for n, entry in enumerate(self._logs[idx - 1 - self.snapshot_index:]):
+            if entry.term != last_term:
+                last_term = entry.term
+                self._term_starts.append([last_term, idx + n])
+
+    def _term_run(self, term):
+        # searched from the end, the current term is always the last run
+        for pos in range(len(self._term_starts) - 1, -1, -1):
+            run_term = self._term_starts[pos][0]
+            if run_term == term:
+                return pos
+            if run_term < term:
+                return None
+        return None
+
+    def first_index_of_term(self, term):
+        """ First index holding an entry of term, None if the log has none past the snapshot """
+        pos = self._term_run(term)
+        return self._term_starts[pos][1] if pos is not None else None
+
+    def last_index_of_term(self, term):
+        pos = self._term_run(term)
+        if pos is None:
+            return None
+        if pos + 1 < len(self._term_starts):
+            return self._term_starts[pos + 1][1] - 1
+        return self.size()
+
     def get(self, idx):
-        return self.logs[idx - 1]
+        assert(idx > self.snapshot_index)
+        return self.logs[idx - 1 - self.snapshot_index]
 
     def get_n(self, idx, n):
-        return self.logs[idx - 1 : idx - 1 + n]
+        assert(idx > self.snapshot_index)
+        offset = idx - 1 - self.snapshot_index
+        return self.logs[offset : offset + n]
 
     def get_last(self):
         return self.logs[-1]
 
+    def term_at(self, idx):
+        if idx == self.snapshot_index:
+            return self.snapshot_term
+        return self.get(idx).term
+
     def size(self):
-        return len(self.logs)
+        return self.snapshot_index + len(self.logs)
 
     def trim(self, idx):
-        del self.logs[idx - 1:]
+        assert(idx > self.snapshot_index)
+        del self.logs[idx - 1 - self.snapshot_index:]
+        self._index_terms(idx)
 
     def add_at(self, idx, entries):
-        self.logs[idx - 1 : idx - 1 + len(entries)] = entries
+        offset = idx - 1 - self.snapshot_index
+        self.logs[offset : offset + len(entries)] = entries
+        self._index_terms(idx)
+
+    def compact(self, idx, term):
+        """ Drop entries up to idx, they are covered by a snapshot """
+        if idx <= self.snapshot_index:
+            return
+        if idx <= self.size() and self.term_at(idx) == term:
+            remaining = self.logs[idx - self.snapshot_index:]
+        else:
+            remaining = []
+        self.snapshot_index = idx
+        self.snapshot_term = term
+        self.logs = remaining
 
     def get_last_term(self):
-        return self.logs[-1].term if self.logs else None
+        return self.logs[-1].term if self.logs else self.snapshot_term
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
 
     def __repr__(self):
         return "[" + ','.join([str(x) for x in self.logs]) + "]"
 
     def __eq__(self, other):
         if isinstance(other, Logs):
-            return self.logs == other.logs
+            return self.logs == other.logs and self.snapshot_index == other.snapshot_index
         else:
             return False
+
+class DurableLogs(Logs):
+    """ Logs mirrored into a WriteAheadLog, the in memory list serves reads """
+    def __init__(self, wal, snapshot=None):
+        self._wal = wal
+        snapshot_index = snapshot.last_index if snapshot is not None else 0
+        snapshot_term = snapshot.last_term if snapshot is not None else None
+        records = wal.replay()
+        if records and records[0][0] > snapshot_index + 1:
+            raise IOError(f"Log starts at {records[0][0]} but the snapshot ends at {snapshot_index}")
+        if records and snapshot_index and not self._continues(records, snapshot_index, snapshot_term):
+            # a crash between saving the snapshot and compacting: the log does not go on from it, as in compact
+            wal.reset()
+            records = []
+        entries = [self.decode(payload) for idx, payload in records if idx > snapshot_index]
+        super().__init__(entries, snapshot_index, snapshot_term)
+
+    @classmethod
+    def _continues(cls, records, snapshot_index, snapshot_term):
+        """ Whether records hold entries after the snapshot that follow its last entry """
+        if records[-1][0] <= snapshot_index:
+            return False
+        if records[0][0] > snapshot_index:
+            # compacted right up to the snapshot
+            return True
+        return cls.decode(records[snapshot_index - records[0][0]][1]).term == snapshot_term
+
+    @classmethod
+    def encode(cls, entry):
+        return entry.encode()
+
+    @classmethod
+    def decode(cls, payload):
+        return LogEntry.decode(payload)[0]
+
+    def trim(self, idx):
+        self._wal.truncate(idx)
+        super().trim(idx)
+
+    def add_at(self, idx, entries):
+        # entries already in the log are kept, the first conflicting one drops the rest of the log
+        skip = 0
+        for entry in entries:
+            if idx + skip > self.size():
+                break
+            if self.get(idx + skip) != entry:
+                self.trim(idx + skip)
+                break
+            skip += 1
+        for n, entry in enumerate(entries[skip:]):
+            self._wal.append(idx + skip + n, self.encode(entry))
+        self.logs.extend(entries[skip:])
+        self._index_terms(idx + skip)
+
+    def compact(self, idx, term):
+        if idx <= self.snapshot_index:
+            return
+        if idx <= self.size() and self.term_at(idx) == term:
+            self._wal.compact(idx)
+        else:
+            self._wal.reset()
+        super().compact(idx, term)
+
+    def sync(self):
+        self._wal.sync()
+
+    def close(self):
+        self._wal.close()
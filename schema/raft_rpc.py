@@ -1,14 +1,23 @@
 from enum import Enum
-import re
+import struct
 
 from schema.base_schema import BaseSchema
-from schema.raft_log import LogEntry, log_entries_list_to_str, str_to_log_entries_list
-from library.utils import split_and_pad, strip_field_names, chunkwise
+from schema.raft_log import encode_entries, decode_entries
+
+# Fixed layout wire format, the first byte is always KEY so is_type works on raw messages.
+# Terms start at 1 so 0 stands in for a missing term, -1 for a missing index.
+
+def _none_to(value, missing):
+    return missing if value is None else value
+
+def _to_none(value, missing):
+    return None if value == missing else value
 
 class AppendEntries(BaseSchema):
     KEY = 0
+    FORMAT = struct.Struct('>BQiQQQQI')
 
-    def __init__(self, term, leader_id, prev_term, prev_index, leader_commit, entries):
+    def __init__(self, term, leader_id, prev_term, prev_index, leader_commit, entries, seq=0):
         assert(term is not None and leader_id is not None and prev_index is not None and leader_commit is not None)
         self._term = term
         self._leader_id = leader_id
@@ -16,6 +25,7 @@ class AppendEntries(BaseSchema):
         self._prev_index = prev_index
         self._leader_commit = leader_commit
         self._entries = entries
+        self._seq = seq
 
     @property
     def term(self):
@@ -41,10 +51,34 @@ class AppendEntries(BaseSchema):
     def entries(self):
         return self._entries
 
+    @property
+    def seq(self):
+        """ leader side send counter, echoed back so responses can be matched to read confirmations """
+        return self._seq
+
+    def serialize(self):
+        header = self.FORMAT.pack(
+            self.KEY, self._term, self._leader_id, _none_to(self._prev_term, 0),
+            self._prev_index, self._leader_commit, self._seq, len(self._entries))
+        return header + encode_entries(self._entries)
+
+    @classmethod
+    def is_heartbeat(cls, msg):
+        """ An AppendEntries without entries, read from the raw header without decoding the message """
+        return cls.is_type(msg) and cls.FORMAT.unpack_from(msg)[-1] == 0
+
+    @classmethod
+    def deserialize(cls, msg):
+        _, term, leader_id, prev_term, prev_index, leader_commit, seq, count = cls.FORMAT.unpack_from(msg)
+        # entry payloads stay views into msg until something reads their item
+        entries, _ = decode_entries(memoryview(msg), cls.FORMAT.size, count)
+        return AppendEntries(term, leader_id, _to_none(prev_term, 0), prev_index, leader_commit, entries, seq)
+
 class AppendEntriesResponse(BaseSchema):
     KEY = 1
+    FORMAT = struct.Struct('>B?iqQQQQ')
 
-    def __init__(self, success, follower_id, match_index = None):
+    def __init__(self, success, follower_id, match_index = None, term=None, seq=0, conflict_term=None, conflict_index=None):
         assert(
             follower_id is not None and
             (
@@ -55,6 +89,12 @@ class AppendEntriesResponse(BaseSchema):
         self._success = success
         self._follower_id = follower_id
         self._match_index = match_index
+        self._term = term
+        self._seq = seq
+        # on rejection: the follower's term at prev_index and the first index it holds of that term,
+        # or no term and the index after its last entry when prev_index is past its log
+        self._conflict_term = conflict_term
+        self._conflict_index = conflict_index
 
     @property
     def success(self):
@@ -68,10 +108,39 @@ class AppendEntriesResponse(BaseSchema):
     def match_index(self):
         return self._match_index
 
+    @property
+    def term(self):
+        return self._term
+
+    @property
+    def seq(self):
+        return self._seq
+
+    @property
+    def conflict_term(self):
+        return self._conflict_term
+
+    @property
+    def conflict_index(self):
+        return self._conflict_index
+
+    def serialize(self):
+        return self.FORMAT.pack(
+            self.KEY, self._success, self._follower_id, _none_to(self._match_index, -1),
+            _none_to(self._term, 0), self._seq, _none_to(self._conflict_term, 0), _none_to(self._conflict_index, 0))
+
+    @classmethod
+    def deserialize(cls, msg):
+        _, success, follower_id, match_index, term, seq, conflict_term, conflict_index = cls.FORMAT.unpack_from(msg)
+        return AppendEntriesResponse(
+            success, follower_id, _to_none(match_index, -1), _to_none(term, 0), seq,
+            _to_none(conflict_term, 0), _to_none(conflict_index, 0))
+
 class RequestVote(BaseSchema):
     KEY = 2
+    FORMAT = struct.Struct('>BQiQQ?')
 
-    def __init__(self, term, candidate_id, last_log_index, last_log_term):
+    def __init__(self, term, candidate_id, last_log_index, last_log_term, pre_vote=False):
         assert(
             term is not None and
             candidate_id is not None and
@@ -81,6 +150,7 @@ class RequestVote(BaseSchema):
         self._candidate_id = candidate_id
         self._last_log_index = last_log_index
         self._last_log_term = last_log_term
+        self._pre_vote = pre_vote
 
     @property
     def term(self):
@@ -98,10 +168,25 @@ class RequestVote(BaseSchema):
     def last_log_term(self):
         return self._last_log_term
 
+    @property
+    def pre_vote(self):
+        """ asks whether the vote would be granted for term, without the receiver changing its term or vote """
+        return self._pre_vote
+
+    def serialize(self):
+        return self.FORMAT.pack(
+            self.KEY, self._term, self._candidate_id, self._last_log_index, _none_to(self._last_log_term, 0), self._pre_vote)
+
+    @classmethod
+    def deserialize(cls, msg):
+        _, term, candidate_id, last_log_index, last_log_term, pre_vote = cls.FORMAT.unpack_from(msg)
+        return RequestVote(term, candidate_id, last_log_index, _to_none(last_log_term, 0), pre_vote)
+
 class RequestVoteResponse(BaseSchema):
     KEY = 3
+    FORMAT = struct.Struct('>BiQ??')
 
-    def __init__(self, follower_id, term, vote_granted):
+    def __init__(self, follower_id, term, vote_granted, pre_vote=False):
         assert(
             follower_id is not None and
             term is not None and
@@ -110,6 +195,7 @@ class RequestVoteResponse(BaseSchema):
         self._follower_id = follower_id
         self._term = term
         self._vote_granted = vote_granted
+        self._pre_vote = pre_vote
 
     @property
     def follower_id(self):
@@ -123,6 +209,123 @@ class RequestVoteResponse(BaseSchema):
     def vote_granted(self):
         return self._vote_granted
 
+    @property
+    def pre_vote(self):
+        return self._pre_vote
+
+    def serialize(self):
+        return self.FORMAT.pack(self.KEY, self._follower_id, self._term, self._vote_granted, self._pre_vote)
+
+    @classmethod
+    def deserialize(cls, msg):
+        _, follower_id, term, vote_granted, pre_vote = cls.FORMAT.unpack_from(msg)
+        return RequestVoteResponse(follower_id, term, vote_granted, pre_vote)
+
+class InstallSnapshot(BaseSchema):
+    KEY = 4
+    FORMAT = struct.Struct('>BQiQQQ?I')
+
+    def __init__(self, term, leader_id, last_index, last_term, offset, data, done):
+        assert(
+            term is not None and
+            leader_id is not None and
+            last_index is not None and
+            offset is not None
+        )
+        self._term = term
+        self._leader_id = leader_id
+        self._last_index = last_index
+        self._last_term = last_term
+        self._offset = offset
+        self._data = data
+        self._done = done
+
+    @property
+    def term(self):
+        return self._term
+
+    @property
+    def leader_id(self):
+        return self._leader_id
+
+    @property
+    def last_index(self):
+        return self._last_index
+
+    @property
+    def last_term(self):
+        return self._last_term
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def done(self):
+        return self._done
+
+    def serialize(self):
+        header = self.FORMAT.pack(
+            self.KEY, self._term, self._leader_id, self._last_index, _none_to(self._last_term, 0),
+            self._offset, self._done, len(self._data))
+        return header + self._data
+
+    @classmethod
+    def deserialize(cls, msg):
+        _, term, leader_id, last_index, last_term, offset, done, length = cls.FORMAT.unpack_from(msg)
+        data = memoryview(msg)[cls.FORMAT.size : cls.FORMAT.size + length]
+        return InstallSnapshot(term, leader_id, last_index, _to_none(last_term, 0), offset, data, done)
+
+class InstallSnapshotResponse(BaseSchema):
+    KEY = 5
+    FORMAT = struct.Struct('>BiQQQ?')
+
+    def __init__(self, follower_id, term, last_index, offset, done):
+        assert(
+            follower_id is not None and
+            term is not None and
+            last_index is not None and
+            offset is not None
+        )
+        self._follower_id = follower_id
+        self._term = term
+        self._last_index = last_index
+        self._offset = offset
+        self._done = done
+
+    @property
+    def follower_id(self):
+        return self._follower_id
+
+    @property
+    def term(self):
+        return self._term
+
+    @property
+    def last_index(self):
+        return self._last_index
+
+    @property
+    def offset(self):
+        """ next byte of the snapshot the follower expects """
+        return self._offset
+
+    @property
+    def done(self):
+        return self._done
+
+    def serialize(self):
+        return self.FORMAT.pack(self.KEY, self._follower_id, self._term, self._last_index, self._offset, self._done)
+
+    @classmethod
+    def deserialize(cls, msg):
+        _, follower_id, term, last_index, offset, done = cls.FORMAT.unpack_from(msg)
+        return InstallSnapshotResponse(follower_id, term, last_index, offset, done)
+
 class ResultState(Enum):
     COMMITED = 1
     PENDING_REPLICATION = 2
@@ -1,11 +1,15 @@
 from enum import Enum
 from time import perf_counter
+from collections import deque
+from threading import Lock
 import os
 import random
 
 from schema.base_schema import BaseSchema
-from schema.raft_log import Logs
-from library.logging import get_logger
+from schema.raft_log import Logs, DurableLogs, Snapshot
+from library.logging import get_logger, hot, fields
+from library.utils import IndexWaiters
+from library.wal import WriteAheadLog, HardState, SnapshotStore
 
 logger = get_logger(os.path.basename(__file__))
 
@@ -16,27 +20,90 @@ class Status(Enum):
 
 class RaftState(BaseSchema):
     KEY = -5
-    NON_REPR_FIELDS = set(['_election_timeout'])
+    ELECTION_TIMEOUT_MIN = 0.15
+    ELECTION_TIMEOUT_MAX = 0.3
+    SEQ_HISTORY = 1024
+    NON_REPR_FIELDS = set([
+        '_election_timeout', '_hard_state', '_snapshot', '_snapshot_store',
+        '_snapshot_offset', '_pending_snapshot', '_commit_waiters', '_in_flight', '_last_sent', '_rewound_seq',
+        '_seq', '_seq_sent', '_seq_lock', '_acked_seq', '_last_ack', '_leader_contact', '_caught_up_at', '_quorum', '_pre_votes_from',
+        '_clock', '_rng'])
 
-    def __init__(self, node_num, peers):
-        self._log = Logs()
-        self._current_term = 1
+    def __init__(self, node_num, peers, log=None, hard_state=None, snapshot=None, snapshot_store=None,
+            clock=perf_counter, rng=random):
+        # every protocol timer reads clock and election timeouts are drawn from rng, a simulator passes its own
+        self._clock = clock
+        self._rng = rng
+        self._log = log if log is not None else Logs()
+        self._hard_state = hard_state
+        self._snapshot = snapshot
+        self._snapshot_store = snapshot_store
+        self._snapshot_offset = {}
+        self._pending_snapshot = None
+        self._in_flight = {}
+        self._last_sent = {}
+        self._rewound_seq = {}
+        self._seq = 0
+        self._seq_sent = deque(maxlen=self.SEQ_HISTORY)
+        self._seq_lock = Lock()
+        self._acked_seq = {}
+        self._last_ack = {}
+        self._leader_contact = float('-inf')
+        self._caught_up_at = float('-inf')
+        term, voted_for = hard_state.load() if hard_state is not None else (None, None)
+        self._current_term = term if term is not None else 1
         self._status = Status.FOLLOWER
-        self._voted_for = None
-        self._commit_index = 0
-        self._last_applied = 0
+        self._voted_for = voted_for
+        self._commit_index = snapshot.last_index if snapshot is not None else 0
+        self._last_applied = self._commit_index
+        self._commit_waiters = IndexWaiters(self._commit_index)
         self._next_index = {}
         self._match_index = {}
+        self._quorum = None
         self._received_votes_from = set()
+        # peers that would vote for us in the next term, None unless a pre-vote is running
+        self._pre_votes_from = None
         self._peers = peers
         self._node_num = node_num
         self.reset_election_timeout()
         self._implicit_leader = None
 
+    @classmethod
+    def open(cls, node_num, peers, data_dir, segment_size=None):
+        snapshot_store = SnapshotStore(data_dir)
+        saved = snapshot_store.load()
+        snapshot = Snapshot(*saved) if saved is not None else None
+        log = DurableLogs(WriteAheadLog(os.path.join(data_dir, 'log'), segment_size), snapshot)
+        return RaftState(
+            node_num, peers, log=log, hard_state=HardState(data_dir),
+            snapshot=snapshot, snapshot_store=snapshot_store)
+
+    def close(self):
+        self._log.close()
+
+    def save_snapshot(self, snapshot):
+        # the snapshot must be durable before the log entries it covers are dropped
+        self.write_snapshot(snapshot)
+        self.use_snapshot(snapshot)
+
+    def write_snapshot(self, snapshot):
+        """ Serializes and fsyncs the snapshot, the log is left as is """
+        if self._snapshot_store is not None:
+            self._snapshot_store.save(snapshot.last_index, snapshot.last_term, snapshot.data)
+
+    def use_snapshot(self, snapshot):
+        """ Swaps in a written snapshot and drops the log entries it covers """
+        self._snapshot = snapshot
+        self._log.compact(snapshot.last_index, snapshot.last_term)
+
+    def _persist(self):
+        if self._hard_state is not None:
+            self._hard_state.save(self._current_term, self._voted_for)
+
     def __repr__(self):
         fields = ""
         for key, value in sorted(self.__dict__.items()):
-            if key == "_election_timeout":
+            if key in self.NON_REPR_FIELDS:
                 continue
             fields += f"{key}={value}, "
         return self.__class__.__name__ + "(" + fields.rstrip(",") + ")"
@@ -51,27 +118,73 @@ class RaftState(BaseSchema):
         return self.status == Status.CANDIDATE
 
     def reset_election_timeout(self):
-        self._election_timeout = perf_counter() + random.uniform(0.15, 0.3)
+        self._election_timeout = self._clock() + self._rng.uniform(self.ELECTION_TIMEOUT_MIN, self.ELECTION_TIMEOUT_MAX)
 
     def election_timeout(self):
-        return perf_counter() >= self._election_timeout
+        return self._clock() >= self._election_timeout
+
+    @property
+    def election_deadline(self):
+        return self._election_timeout
+
+    @property
+    def clock(self):
+        return self._clock
+
+    def next_seq(self, now):
+        """ Starts a new AppendEntries sequence number, messages tagged with it are sent no earlier than now """
+        with self._seq_lock:
+            self._seq += 1
+            self._seq_sent.append((self._seq, now))
+            return self._seq
+
+    def seq_sent_at(self, seq):
+        with self._seq_lock:
+            if not self._seq_sent or seq < self._seq_sent[0][0] or seq > self._seq:
+                return None
+            return self._seq_sent[seq - self._seq_sent[0][0]][1]
 
     def become_leader(self):
         self.status = Status.LEADER
         self.voted_for = None
         self.next_index = {x: self.log.size() + 1 for x in self.peers}
         self.match_index = {x: 0 for x in self.peers}
+        self._snapshot_offset = {}
+        self._in_flight = {}
+        self._last_sent = {}
+        self._rewound_seq = {}
+        self._acked_seq = {}
+        # a new leader gives every follower an election timeout to answer before check quorum counts it out
+        self._last_ack = {x: self._clock() for x in self.peers}
+        self._pre_votes_from = None
+
+    def advance_term(self, term, voted_for=None):
+        """ Moves to term with voted_for as its vote, saved in one write so a crash never keeps one without the other """
+        logger.info("change", extra=fields(node=self._node_num, current_term=(self._current_term, term), voted_for=(self._voted_for, voted_for)))
+        self._current_term = term
+        self._voted_for = voted_for
+        self._persist()
 
-    def become_follower(self):
+    def _log_change(self, name, old, new):
+        logger.info("change", extra=fields(node=self._node_num, field=name, old=old, new=new))
+
+    def become_follower(self, term=None):
+        """ Follower in term, which starts without a vote, or in the current term keeping its vote """
         self.status = Status.FOLLOWER
-        self.voted_for = None
+        if term is not None:
+            self.advance_term(term)
+        self._pre_votes_from = None
         self.reset_election_timeout()
 
     def become_candidate(self):
-        self.current_term += 1
+        self.advance_term(self.current_term + 1, self.node_num)
         self.status = Status.CANDIDATE
-        self.voted_for = self.node_num
         self.received_votes_from = set()
+        self._pre_votes_from = None
+        self.reset_election_timeout()
+
+    def start_pre_vote(self):
+        self.pre_votes_from = set()
         self.reset_election_timeout()
 
     # setters and getters
@@ -81,17 +194,80 @@ class RaftState(BaseSchema):
     
     @log.setter
     def log(self, new_log):
-        logger.info(f"Node {self._node_num} change {self._log} -> {new_log} for 'log'")
+        self._log_change('log', self._log, new_log)
         self._log = new_log
 
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def snapshot_offset(self):
+        return self._snapshot_offset
+
+    @property
+    def in_flight(self):
+        """ follower -> deque of (prev_index, last_index, send time) for AppendEntries awaiting a response """
+        return self._in_flight
+
+    @property
+    def last_sent(self):
+        return self._last_sent
+
+    @property
+    def rewound_seq(self):
+        """ follower -> first sequence number sent after its pipeline was last rewound """
+        return self._rewound_seq
+
+    @property
+    def seq(self):
+        return self._seq
+
+    @property
+    def acked_seq(self):
+        """ follower -> highest sequence number it acknowledged in the current term """
+        return self._acked_seq
+
+    @property
+    def last_ack(self):
+        """ follower -> when the leader last received an answer from it in the current term """
+        return self._last_ack
+
+    @property
+    def leader_contact(self):
+        """ when this node last accepted an AppendEntries or snapshot chunk from a leader """
+        return self._leader_contact
+
+    @leader_contact.setter
+    def leader_contact(self, new_leader_contact):
+        self._leader_contact = new_leader_contact
+
+    @property
+    def caught_up_at(self):
+        """ when this node last held everything its leader had committed, follower reads are bounded by it """
+        return self._caught_up_at
+
+    @caught_up_at.setter
+    def caught_up_at(self, new_caught_up_at):
+        self._caught_up_at = new_caught_up_at
+
+    @property
+    def pending_snapshot(self):
+        return self._pending_snapshot
+
+    @pending_snapshot.setter
+    def pending_snapshot(self, new_pending_snapshot):
+        self._pending_snapshot = new_pending_snapshot
+
     @property
     def current_term(self):
         return self._current_term
     
     @current_term.setter
     def current_term(self, new_term):
-        logger.info(f"Node {self._node_num} change {self._current_term} -> {new_term} for 'current_term'")
+        self._log_change('current_term', self._current_term, new_term)
         self._current_term = new_term
+        self._persist()
     
     @property
     def status(self):
@@ -99,7 +275,7 @@ class RaftState(BaseSchema):
     
     @status.setter
     def status(self, new_status):
-        logger.info(f"Node {self._node_num} change {self._status} -> {new_status} for 'status'")
+        self._log_change('status', self._status, new_status)
         self._status = new_status
     
     @property
@@ -108,8 +284,9 @@ class RaftState(BaseSchema):
     
     @voted_for.setter
     def voted_for(self, new_voted_for):
-        logger.info(f"Node {self._node_num} change {self._voted_for} -> {new_voted_for} for 'voted_for'")
+        self._log_change('voted_for', self._voted_for, new_voted_for)
         self._voted_for = new_voted_for
+        self._persist()
     
     @property
     def commit_index(self):
@@ -119,8 +296,14 @@ class RaftState(BaseSchema):
     def commit_index(self, new_commit_index):
         if new_commit_index == self._commit_index:
             return
-        logger.info(f"Node {self._node_num} change {self._commit_index} -> {new_commit_index} for 'commit_index'")
+        if hot(logger, 'commit_index'):
+            self._log_change('commit_index', self._commit_index, new_commit_index)
         self._commit_index = new_commit_index
+        self._commit_waiters.advance(new_commit_index)
+
+    @property
+    def commit_waiters(self):
+        return self._commit_waiters
     
     @property
     def last_applied(self):
@@ -128,7 +311,8 @@ class RaftState(BaseSchema):
     
     @last_applied.setter
     def last_applied(self, new_last_applied):
-        logger.info(f"Node {self._node_num} change {self._last_applied} -> {new_last_applied} for 'last_applied'")
+        if hot(logger, 'last_applied'):
+            self._log_change('last_applied', self._last_applied, new_last_applied)
         self._last_applied = new_last_applied
     
     @property
@@ -137,7 +321,8 @@ class RaftState(BaseSchema):
     
     @next_index.setter
     def next_index(self, new_next_index):
-        logger.info(f"Node {self._node_num} change {self._next_index} -> {new_next_index} for 'next_index'")
+        if hot(logger, 'next_index'):
+            self._log_change('next_index', self._next_index, new_next_index)
         self._next_index = new_next_index
     
     @property
@@ -146,8 +331,19 @@ class RaftState(BaseSchema):
     
     @match_index.setter
     def match_index(self, new_match_index):
-        logger.info(f"Node {self._node_num} change {self._match_index} -> {new_match_index} for 'match_index'")
+        if hot(logger, 'match_index'):
+            self._log_change('match_index', self._match_index, new_match_index)
         self._match_index = new_match_index
+        self._quorum = None
+
+    @property
+    def quorum(self):
+        """ QuorumTracker over match_index, built by the handler on first use after match_index is replaced """
+        return self._quorum
+
+    @quorum.setter
+    def quorum(self, quorum):
+        self._quorum = quorum
     
     @property
     def received_votes_from(self):
@@ -155,16 +351,25 @@ class RaftState(BaseSchema):
     
     @received_votes_from.setter
     def received_votes_from(self, new_received_votes_from):
-        logger.info(f"Node {self._node_num} change {self._received_votes_from} -> {new_received_votes_from} for 'received_votes_from'")
+        self._log_change('received_votes_from', self._received_votes_from, new_received_votes_from)
         self._received_votes_from = new_received_votes_from
     
+    @property
+    def pre_votes_from(self):
+        return self._pre_votes_from
+
+    @pre_votes_from.setter
+    def pre_votes_from(self, new_pre_votes_from):
+        self._log_change('pre_votes_from', self._pre_votes_from, new_pre_votes_from)
+        self._pre_votes_from = new_pre_votes_from
+
     @property
     def peers(self):
         return self._peers
     
     @peers.setter
     def peers(self, new_peers):
-        logger.info(f"Node {self._node_num} change {self._peers} -> {new_peers} for 'peers'")
+        self._log_change('peers', self._peers, new_peers)
         self._peers = new_peers
     
     @property
@@ -173,7 +378,7 @@ class RaftState(BaseSchema):
     
     @node_num.setter
     def node_num(self, new_node_num):
-        logger.info(f"Node {self._node_num} change {self._node_num} -> {new_node_num} for 'node_num'")
+        self._log_change('node_num', self._node_num, new_node_num)
         self._node_num = new_node_num
     
     @property
@@ -184,5 +389,5 @@ class RaftState(BaseSchema):
     def implicit_leader(self, new_implicit_leader):
         if new_implicit_leader == self._implicit_leader:
             return
-        logger.info(f"Node {self._node_num} change {self._implicit_leader} -> {new_implicit_leader} for 'implicit_leader'")
+        self._log_change('implicit_leader', self._implicit_leader, new_implicit_leader)
         self._implicit_leader = new_implicit_leader
@@ -15,6 +15,10 @@ class ServiceDiscovery:
     def get_server_config(self):
         return self.SERVERS
 
+    def get_raft_config(self, port_offset=0):
+        """ Raft addresses, a stream transport needs ports apart from the kv ports """
+        return {n: (host, port + port_offset) for n, (host, port) in self.SERVERS.items()}
+
     def get_total_servers(self):
         return len(self.SERVERS)
 
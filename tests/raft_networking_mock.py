@@ -1,4 +1,5 @@
-from queue import Queue
+from queue import Queue, Empty
+import heapq
 
 class RaftNetworkingMock:
     def __init__(self, node_num, msg_queue):
@@ -19,8 +20,93 @@ class RaftNetworkingMock:
     def send(self, destination, obj):
         self._msg_queue[destination].put(obj.serialize())
 
-    def receive(self):
-        return self._msg_queue[self._node_num].get()
+    def receive(self, timeout=None):
+        try:
+            return self._msg_queue[self._node_num].get(timeout=timeout)
+        except Empty:
+            return None
+
+    def wake(self):
+        self._msg_queue[self._node_num].put(None)
 
     def end(self):
         self._msg_queue[self._node_num].put(None)
+
+class SimulatedNetwork:
+    """
+    Delivers messages on a virtual clock through an event heap. Each message takes
+    latency plus up to jitter seconds, so messages sent close together may arrive
+    reordered, and is lost with probability loss. Nodes in different partitions
+    cannot reach each other. All randomness comes from rng.
+    """
+    def __init__(self, total_nodes, rng, latency=0.001, jitter=0.0, loss=0.0):
+        self.now = 0.0
+        self.rng = rng
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.delivered = 0
+        self.dropped = 0
+        self._events = []
+        self._seq = 0
+        self._group = {n: 0 for n in range(total_nodes)}
+        self.endpoints = [SimulatedEndpoint(self, n) for n in range(total_nodes)]
+
+    def clock(self):
+        return self.now
+
+    def schedule(self, at, callback):
+        self._seq += 1
+        heapq.heappush(self._events, (at, self._seq, callback))
+
+    def partition(self, *groups):
+        """ Nodes left out of every group stay connected to each other """
+        for n in self._group:
+            self._group[n] = 0
+        for number, group in enumerate(groups, 1):
+            for n in group:
+                self._group[n] = number
+
+    def heal(self):
+        self.partition()
+
+    def connected(self, source, destination):
+        return self._group[source] == self._group[destination]
+
+    def send(self, source, destination, obj):
+        if not self.connected(source, destination) or self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        msg = obj.serialize()
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        self.schedule(self.now + delay, lambda: self._deliver(source, destination, msg))
+
+    def _deliver(self, source, destination, msg):
+        # a partition that started while the message was in flight still cuts it
+        if not self.connected(source, destination):
+            self.dropped += 1
+            return
+        self.delivered += 1
+        self.endpoints[destination].deliver(msg)
+
+    def run_until(self, until):
+        """ Runs events in time order up to the virtual time until """
+        while self._events and self._events[0][0] <= until:
+            at, _, callback = heapq.heappop(self._events)
+            self.now = at
+            callback()
+        self.now = max(self.now, until)
+
+class SimulatedEndpoint:
+    """ Same send interface as RaftNetworkingMock, delivery hands the message straight to on_receive """
+    def __init__(self, network, node_num):
+        self._network = network
+        self._node_num = node_num
+        self.on_receive = None
+
+    def send(self, destination, obj):
+        self._network.send(self._node_num, destination, obj)
+
+    def deliver(self, msg):
+        if self.on_receive is not None:
+            self.on_receive(msg)
@@ -0,0 +1,267 @@
+""" Discrete event simulation of a raft cluster on a virtual clock: python -m tests.raft_simulator --seed 1 """
+import argparse
+import json
+import random
+
+from tests.raft_networking_mock import SimulatedNetwork
+from raft_handler import RaftHandler
+from raft_networking import InboundScheduler
+from raft_config import RaftConfig
+from schema.raft_state import RaftState
+
+class RaftSimulation:
+    """
+    Drives RaftHandlers directly: messages, election deadlines and heartbeat ticks are
+    events on one heap, so simulated seconds cost only the work done in them and a run
+    is reproducible from its seed.
+    With service_time or byte_cost set a node handles one message at a time, each taking
+    service_time plus byte_cost per byte, and messages wait in its InboundScheduler meanwhile.
+    """
+    # RaftRuntime's heartbeat loop period
+    HEARTBEAT_TICK = 0.005
+
+    def __init__(self, nodes=5, seed=0, latency=0.001, jitter=0.0, loss=0.0, config=None, service_time=0.0, byte_cost=0.0):
+        self.rng = random.Random(seed)
+        self.network = SimulatedNetwork(nodes, self.rng, latency, jitter, loss)
+        self.config = config if config is not None else RaftConfig()
+        self.handlers = []
+        self.applied = [0] * nodes
+        # term -> leader elected in it
+        self.leaders = {}
+        self._timer_at = [float('inf')] * nodes
+        self._proposed = 0
+        # command number -> when it was proposed, until a node applies it
+        self._proposed_at = {}
+        self.commit_latencies = []
+        # simulated seconds nodes spent as leader of a term that has since been superseded, taking writes in vain
+        self.stale_leader_s = 0.0
+        self.pending_limit = 0
+        self.service_time = service_time
+        self.byte_cost = byte_cost
+        self._inbound = [InboundScheduler(self.config.inbound_priority) for _ in range(nodes)]
+        self._busy = [False] * nodes
+        for n in range(nodes):
+            peers = [peer for peer in range(nodes) if peer != n]
+            state = RaftState(n, peers, clock=self.network.clock, rng=self.rng)
+            handler = RaftHandler(
+                state, self.network.endpoints[n].send,
+                execute_message_callback=lambda first_idx, cmds, n=n: self._on_apply(n, cmds),
+                config=self.config)
+            self.handlers.append(handler)
+            self.network.endpoints[n].on_receive = lambda msg, n=n: self._on_receive(n, msg)
+            self._arm_election(n)
+            self.network.schedule(self.rng.uniform(0, self.HEARTBEAT_TICK), lambda n=n: self._on_tick(n))
+
+    @property
+    def now(self):
+        return self.network.now
+
+    def _on_receive(self, n, msg):
+        if not self.service_time and not self.byte_cost:
+            self._handle(n, msg)
+            return
+        self._inbound[n].put(msg)
+        if not self._busy[n]:
+            self._serve(n)
+
+    def _serve(self, n):
+        msg = self._inbound[n].get(0)
+        self._busy[n] = msg is not None
+        if msg is not None:
+            def done():
+                self._handle(n, msg)
+                self._serve(n)
+            self.network.schedule(self.now + self.service_time + self.byte_cost * len(msg), done)
+
+    def _handle(self, n, msg):
+        self.handlers[n].receive(msg)
+        self._observe(n)
+
+    def _on_apply(self, n, cmds):
+        self.applied[n] += len(cmds)
+        for cmd in cmds:
+            proposed_at = self._proposed_at.pop(int(cmd[:36]), None) if cmd is not None else None
+            if proposed_at is not None:
+                self.commit_latencies.append(self.now - proposed_at)
+
+    def _arm_election(self, n):
+        # leaders have no election deadline, others only need a timer when it comes before the armed one
+        state = self.handlers[n]._state
+        deadline = state.election_deadline
+        if not state.is_leader() and deadline < self._timer_at[n]:
+            self._timer_at[n] = deadline
+            self.network.schedule(deadline, lambda: self._on_election_timer(n, deadline))
+
+    def _on_election_timer(self, n, deadline):
+        if deadline != self._timer_at[n]:
+            return
+        self._timer_at[n] = float('inf')
+        self.handlers[n].check_election_timeout()
+        self._observe(n)
+
+    def _on_tick(self, n):
+        handler = self.handlers[n]
+        handler.handle_heartbeat()
+        if handler._state.is_leader():
+            self._propose(handler)
+            if handler._state.current_term < self.terms():
+                self.stale_leader_s += self.HEARTBEAT_TICK
+        self._observe(n)
+        self.network.schedule(self.now + self.HEARTBEAT_TICK, lambda: self._on_tick(n))
+
+    def _observe(self, n):
+        state = self.handlers[n]._state
+        if state.is_leader() and state.current_term not in self.leaders:
+            self.leaders[state.current_term] = n
+        self._arm_election(n)
+
+    def _propose(self, handler):
+        # closed loop load: keep up to pending_limit commands proposed but not committed
+        outstanding = handler._state.log.size() - handler._state.commit_index
+        count = self.pending_limit - outstanding
+        if count > 0:
+            for _ in range(count):
+                self._proposed += 1
+                self._proposed_at[self._proposed] = self.now
+                handler._batcher.submit(f"{self._proposed:036d}cmd")
+
+    def leader(self):
+        """ The leader of the highest term, once a majority of the cluster follows it """
+        if not self.leaders:
+            return None
+        term = max(self.leaders)
+        n = self.leaders[term]
+        if not self.handlers[n]._state.is_leader():
+            return None
+        followers = sum(1 for handler in self.handlers
+            if handler._state.current_term == term and (handler.node_num == n or handler._state.implicit_leader == n))
+        return n if followers > len(self.handlers) // 2 else None
+
+    def run(self, seconds):
+        self.network.run_until(self.now + seconds)
+
+    def run_until_leader(self, timeout=10.0, step=0.001, exclude=None):
+        """ Simulated seconds until a leader other than exclude is established, None on timeout """
+        start = self.now
+        while self.now - start < timeout:
+            if self.leader() not in (None, exclude):
+                return self.now - start
+            self.run(step)
+        return None
+
+    def crash_leader(self):
+        """ Isolates the current leader until heal() """
+        n = self.leader()
+        self.network.partition([n])
+        return n
+
+    def terms(self):
+        return max(handler._state.current_term for handler in self.handlers)
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {'trials': 0}
+    return {
+        'trials': len(values),
+        'p50': values[len(values) // 2],
+        'p99': values[min(len(values) - 1, int(len(values) * 0.99))],
+        'max': values[-1],
+    }
+
+def saturated_failover(args, inbound_priority):
+    """ Elections needed to replace a crashed leader while every node has a backlog of entries to work through """
+    sim = RaftSimulation(args.nodes, args.seed, args.latency, args.jitter, args.loss,
+        RaftConfig(inbound_priority=inbound_priority), args.service_time, args.byte_cost)
+    sim.run_until_leader()
+    sim.pending_limit = args.saturation_pending
+    sim.run(2.0)
+    start_term, reelection = sim.terms(), []
+    for _ in range(args.failovers):
+        reelection.append(sim.run_until_leader(exclude=sim.crash_leader()))
+        sim.network.heal()
+        sim.run(1.0)
+    return {
+        'failovers': args.failovers,
+        'terms': sim.terms() - start_term,
+        'reelection_s': summarize([r for r in reelection if r is not None]),
+    }
+
+def flapping(args, pre_vote, check_quorum):
+    """ Under load, cut one node off and bring it back over and over, alternating between a follower and the leader """
+    sim = RaftSimulation(args.nodes, args.seed, args.latency, args.jitter, args.loss,
+        RaftConfig(pre_vote=pre_vote, check_quorum=check_quorum))
+    sim.pending_limit = args.pending
+    sim.run_until_leader()
+    sim.run(1.0)
+    start_term, start_leaders = sim.terms(), len(sim.leaders)
+    sim.commit_latencies, sim.stale_leader_s = [], 0.0
+    for flap in range(args.flaps):
+        leader = sim.leader()
+        if leader is None:
+            leader = max(sim.leaders.items())[1]
+        sim.network.partition([leader if flap % 2 else (leader + 1) % args.nodes])
+        sim.run(args.flap_down)
+        sim.network.heal()
+        sim.run(args.flap_up)
+    return {
+        'terms': sim.terms() - start_term,
+        'leader_changes': len(sim.leaders) - start_leaders,
+        'commit_latency_s': summarize(sim.commit_latencies),
+        'stale_leader_s': sim.stale_leader_s,
+    }
+
+def measure(args):
+    convergence = []
+    for seed in range(args.seed, args.seed + args.trials):
+        sim = RaftSimulation(args.nodes, seed, args.latency, args.jitter, args.loss)
+        elected = sim.run_until_leader()
+        if elected is not None:
+            reelected = sim.run_until_leader(exclude=sim.crash_leader())
+            convergence.append((elected, reelected))
+    sim = RaftSimulation(args.nodes, args.seed, args.latency, args.jitter, args.loss)
+    sim.pending_limit = args.pending
+    sim.run_until_leader()
+    start_time, start_commit = sim.now, max(h._state.commit_index for h in sim.handlers)
+    sim.run(args.seconds)
+    committed = max(h._state.commit_index for h in sim.handlers) - start_commit
+    return {
+        'first_election_s': summarize([e for e, _ in convergence]),
+        'reelection_s': summarize([r for _, r in convergence if r is not None]),
+        'commits_per_sim_s': committed / (sim.now - start_time),
+        'terms': sim.terms(),
+        'leader_changes': len(sim.leaders),
+        'messages_delivered': sim.network.delivered,
+        'messages_dropped': sim.network.dropped,
+        'flapping': {
+            'plain': flapping(args, pre_vote=False, check_quorum=False),
+            'pre_vote': flapping(args, pre_vote=True, check_quorum=False),
+            'pre_vote_check_quorum': flapping(args, pre_vote=True, check_quorum=True),
+        },
+        'saturated_failover': {
+            'fifo': saturated_failover(args, inbound_priority=False),
+            'priority': saturated_failover(args, inbound_priority=True),
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trials', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=60.0, help="simulated seconds of closed loop load")
+    parser.add_argument('--latency', type=float, default=0.001)
+    parser.add_argument('--jitter', type=float, default=0.001)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--pending', type=int, default=64, help="commands the leader keeps uncommitted")
+    parser.add_argument('--flaps', type=int, default=10)
+    parser.add_argument('--flap-down', type=float, default=1.0, help="seconds a flapping node stays cut off")
+    parser.add_argument('--flap-up', type=float, default=1.0)
+    parser.add_argument('--failovers', type=int, default=10)
+    parser.add_argument('--saturation-pending', type=int, default=2000)
+    parser.add_argument('--service-time', type=float, default=0.0001, help="seconds a saturated node spends per message")
+    parser.add_argument('--byte-cost', type=float, default=0.00001, help="and per message byte")
+    print(json.dumps(measure(parser.parse_args()), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import unittest
+import asyncio
+import time
+from socket import socket, AF_INET, SOCK_STREAM
+from threading import Thread
+from unittest.mock import MagicMock
+
+from library.messages import send_message, recv_message
+from kv_store_async_server import AsyncKVStoreServer, AsyncConnection
+from kv_store_handler import KVStoreHandler
+from schema.kv_store import KVStoreRequest, KVStoreResponse, Action, Consistency
+
+class TestAsyncKVStoreServer(unittest.TestCase):
+    def setUp(self):
+        handler = KVStoreHandler()
+        handler.receive(KVStoreRequest(Action.SET, "foo", "bar"))
+        probe = socket(AF_INET, SOCK_STREAM)
+        probe.bind(('localhost', 0))
+        self.addr = probe.getsockname()
+        probe.close()
+        raft = MagicMock()
+        raft.get_msgs_to_execute.side_effect = lambda max_items: time.sleep(0.01)
+        self.server = AsyncKVStoreServer(self.addr, raft=raft, handler=handler, workers=2)
+        self.thread = Thread(target=self.server.start)
+        self.thread.start()
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.server.stop()
+        self.thread.join(5)
+
+    def connect(self):
+        for _ in range(100):
+            try:
+                sock = socket(AF_INET, SOCK_STREAM)
+                sock.settimeout(2)
+                sock.connect(self.addr)
+                self.sockets.append(sock)
+                return sock
+            except ConnectionRefusedError:
+                sock.close()
+                time.sleep(0.01)
+        raise Exception("Server did not start")
+
+    def get(self, sock):
+        send_message(sock, KVStoreRequest(Action.GET, "foo", consistency=Consistency.ANY).serialize())
+        return KVStoreResponse.deserialize(recv_message(sock))
+
+    def test_more_connections_than_workers(self):
+        connections = [self.connect() for _ in range(20)]
+        for sock in connections:
+            self.assertEqual(self.get(sock).msg, "bar")
+        # every connection stays usable
+        self.assertTrue(self.get(connections[0]).is_success())
+
+    def test_stop_before_start(self):
+        server = AsyncKVStoreServer(self.addr, raft=MagicMock(), handler=KVStoreHandler(), workers=1)
+        server.stop()
+
+    def test_connection_outlives_loop(self):
+        loop = asyncio.new_event_loop()
+        loop.close()
+        conn = AsyncConnection(loop, MagicMock())
+        # a response finished after stop is dropped like one for a closed socket
+        with self.assertRaises(OSError):
+            conn.sendall(b'late')
+        conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import time
+from unittest.mock import MagicMock
+
+from tests.raft_networking_mock import RaftNetworkingMock
+from raft_handler import RaftHandler
+from kv_store_server import KVStoreServer
+from kv_store_handler import KVStoreHandler
+from schema.raft_state import RaftState
+from schema.raft_log import LogEntry
+from schema.raft_rpc import AppendEntries
+from schema.kv_store import KVStoreRequest, KVStoreResponse, Status, Action, Consistency
+
+class TestFollowerReadIndex(unittest.TestCase):
+    def setUp(self):
+        raft_networking_lst = RaftNetworkingMock.init_n_servers(2)
+        self.networking = raft_networking_lst
+        self.leader = RaftHandler(RaftState(0, [1]), raft_networking_lst[0].send)
+        self.follower = RaftHandler(RaftState(1, [0]), raft_networking_lst[1].send)
+        self.leader._state._log.logs = [LogEntry(1, "a"), LogEntry(1, "b")]
+        self.leader._state.commit_index = 2
+        self.leader._state.become_leader()
+
+    def test_follower_without_leader(self):
+        self.assertIsNone(self.follower.follower_read_index(1.0, 1))
+
+    def test_follower_reads_its_commit_index(self):
+        self.leader.handle_heartbeat()
+        for _ in range(5):
+            for handler, networking in zip((self.leader, self.follower), self.networking):
+                while not networking.inbound_queue_empty():
+                    handler.receive(networking.receive())
+            self.leader.handle_heartbeat()
+        self.assertEqual(self.follower.follower_read_index(1.0, 1), 2)
+        time.sleep(0.02)
+        self.assertIsNone(self.follower.follower_read_index(0.01, 1))
+
+    def test_lagging_follower_refuses(self):
+        # the leader's heartbeats are accepted but the follower only holds the first entry
+        self.follower._state._log.logs = [LogEntry(1, "a")]
+        self.follower.receive(AppendEntries(1, 0, 1, 1, 2, []).serialize())
+        self.assertEqual(self.follower._state.commit_index, 1)
+        self.assertIsNone(self.follower.follower_read_index(1.0, 1))
+        # rejected, prev_index is past the follower's log
+        self.follower.receive(AppendEntries(1, 0, 1, 2, 2, []).serialize())
+        self.assertIsNone(self.follower.follower_read_index(1.0, 1))
+        self.follower.receive(AppendEntries(1, 0, 1, 1, 2, [LogEntry(1, "b")]).serialize())
+        self.assertEqual(self.follower.follower_read_index(1.0, 1), 2)
+
+class TestFollowerReads(unittest.TestCase):
+    def setUp(self):
+        self.raft = MagicMock()
+        self.handler = KVStoreHandler()
+        self.handler.receive(KVStoreRequest(Action.SET, "foo", "bar"))
+        self.server = KVStoreServer(('localhost', 0), raft=self.raft, handler=self.handler, workers=1)
+
+    def test_any_is_served_locally(self):
+        response = self.server.follower_read(KVStoreRequest(Action.GET, "foo", consistency=Consistency.ANY))
+        self.assertEqual(response, KVStoreResponse(Status.SUCCESS, "bar"))
+        self.raft.follower_read_index.assert_not_called()
+
+    def test_bounded_waits_for_apply(self):
+        self.raft.follower_read_index.return_value = 3
+        request = KVStoreRequest(Action.GET, "foo", consistency=Consistency.BOUNDED, max_staleness=0.5)
+        self.server.applied.advance(3)
+        self.assertEqual(self.server.follower_read(request), KVStoreResponse(Status.SUCCESS, "bar"))
+        self.raft.follower_read_index.assert_called_once_with(0.5)
+
+    def test_stale_follower_defers_to_leader(self):
+        self.raft.follower_read_index.return_value = None
+        request = KVStoreRequest(Action.GET, "foo", consistency=Consistency.BOUNDED)
+        self.assertIsNone(self.server.follower_read(request))
+
+    def test_build_from_msg(self):
+        request = KVStoreRequest.build_from_msg("get foo any")
+        self.assertEqual(request.consistency, Consistency.ANY)
+        self.assertEqual(KVStoreRequest.build_from_msg("get foo").consistency, Consistency.STRONG)
+
+if __name__ == '__main__':
+    unittest.main()
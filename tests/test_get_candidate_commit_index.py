@@ -2,6 +2,7 @@ import unittest
 
 from raft_core import RaftCore
 from schema.raft_log import LogEntry, Logs
+from library.utils import QuorumTracker
 
 class TestRaftComponent(unittest.TestCase):
     def setUp(self):
@@ -39,11 +40,16 @@ class TestRaftComponent(unittest.TestCase):
 
     def test_no_majority_with_current_term(self):
         current_term = 3
-        match_index = {1: 5, 2: 3, 3: 3, 4: 9}
+        match_index = {1: 5, 2: 3, 3: 3, 4: 3}
         expected = None
         result = RaftCore.get_candidate_commit_index(match_index, self.log, current_term, 4)
         self.assertEqual(expected, result)
 
+    def test_leader_and_half_the_followers_commit(self):
+        # 3 of 5 nodes hold index 5
+        match_index = {1: 5, 2: 3, 3: 3, 4: 9}
+        self.assertEqual(RaftCore.get_candidate_commit_index(match_index, self.log, 3, 4), 5)
+
     def test_no_match_index_values(self):
         current_term = 3
         match_index = {}
@@ -51,5 +57,35 @@ class TestRaftComponent(unittest.TestCase):
         result = RaftCore.get_candidate_commit_index(match_index, self.log, current_term, 4)
         self.assertEqual(expected, result)
 
+class TestQuorumTracker(unittest.TestCase):
+    def test_matches_sorting(self):
+        match_index = {1: 0, 2: 0, 3: 0, 4: 0}
+        tracker = QuorumTracker(match_index, RaftCore.quorum_size(4))
+        for follower, index in [(1, 5), (4, 9), (2, 3), (3, 5), (2, 7), (1, 2)]:
+            match_index[follower] = index
+            tracker.update(follower, index)
+            expected = sorted(match_index.values())[-RaftCore.quorum_size(4)]
+            self.assertEqual(tracker.quorum_index(), expected)
+
+    def test_not_enough_followers(self):
+        self.assertIsNone(QuorumTracker({1: 4}, 2).quorum_index())
+
+class TestTermIndex(unittest.TestCase):
+    def test_term_bounds(self):
+        log = Logs([LogEntry(term, "x") for term in [1, 1, 2, 2, 3, 4, 4]])
+        self.assertEqual((log.first_index_of_term(2), log.last_index_of_term(2)), (3, 4))
+        self.assertEqual((log.first_index_of_term(4), log.last_index_of_term(4)), (6, 7))
+        self.assertIsNone(log.first_index_of_term(5))
+
+    def test_follows_mutations(self):
+        log = Logs([LogEntry(term, "x") for term in [1, 1, 2, 2]])
+        log.trim(4)
+        log.add_at(4, [LogEntry(3, "y"), LogEntry(3, "y")])
+        self.assertEqual((log.first_index_of_term(2), log.last_index_of_term(2)), (3, 3))
+        self.assertEqual((log.first_index_of_term(3), log.last_index_of_term(3)), (4, 5))
+        log.compact(3, 2)
+        self.assertIsNone(log.first_index_of_term(2))
+        self.assertEqual(log.first_index_of_term(3), 4)
+
 if __name__ == '__main__':
     unittest.main()
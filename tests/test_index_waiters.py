@@ -0,0 +1,68 @@
+import unittest
+import time
+from threading import Thread
+
+from library.utils import IndexWaiters, TimerHeap
+from schema.raft_state import RaftState
+
+class TestIndexWaiters(unittest.TestCase):
+    def test_reached(self):
+        waiters = IndexWaiters(5)
+        self.assertTrue(waiters.wait(3, timeout=0))
+        self.assertTrue(waiters.wait(5, timeout=0))
+
+    def test_timeout(self):
+        waiters = IndexWaiters()
+        start = time.time()
+        self.assertFalse(waiters.wait(1, timeout=0.05))
+        self.assertGreaterEqual(time.time() - start, 0.05)
+
+    def test_bulk_wake(self):
+        waiters = IndexWaiters()
+        results = {}
+        def wait(target):
+            results[target] = waiters.wait(target, timeout=2)
+        threads = [Thread(target=wait, args=[x]) for x in range(1, 101)]
+        for thread in threads:
+            thread.start()
+        while waiters.pending() < 100:
+            time.sleep(0.001)
+        waiters.advance(60)
+        waiters.advance(40)
+        time.sleep(0.05)
+        self.assertEqual(sorted(results), list(range(1, 61)))
+        self.assertEqual(waiters.pending(), 40)
+        waiters.advance(100)
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(results.values()))
+        self.assertEqual(waiters.pending(), 0)
+
+    def test_commit_index_wakes_waiters(self):
+        state = RaftState(0, [1, 2])
+        result = []
+        thread = Thread(target=lambda: result.append(state.commit_waiters.wait(3, timeout=2)))
+        thread.start()
+        state.commit_index = 3
+        thread.join()
+        self.assertEqual(result, [True])
+
+class TestTimerHeap(unittest.TestCase):
+    def test_reschedule_replaces_deadline(self):
+        timers = TimerHeap()
+        timers.schedule('election', 5)
+        timers.schedule('heartbeat', 3)
+        timers.schedule('election', 2)
+        self.assertEqual(timers.next_deadline(), 2)
+        self.assertEqual(timers.pop_due(4), ['election', 'heartbeat'])
+        self.assertIsNone(timers.next_deadline())
+
+    def test_cancel(self):
+        timers = TimerHeap()
+        timers.schedule('heartbeat', 1)
+        timers.cancel('heartbeat')
+        self.assertFalse(timers.scheduled('heartbeat'))
+        self.assertEqual(timers.pop_due(10), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,8 @@ from unittest.mock import MagicMock
 
 from schema.kv_store import KVStoreRequest, KVStoreResponse, Status, Action
 from kv_store_handler import KVStoreHandler
+from kv_store_server import KVStoreServer
+from schema.raft_log import Snapshot
 
 class TestProcessor(unittest.TestCase):
     def setUp(self):
@@ -23,5 +25,72 @@ class TestProcessor(unittest.TestCase):
         self.assertEqual(result, KVStoreResponse(Status.SUCCESS, 'bar'))
         self._kv.get.assert_called_once_with('foo')
 
+    def test_mset(self):
+        self._handler.receive(KVStoreRequest(Action.MSET, ["a", "b"], ["1", "2"]))
+        self._kv.mset.assert_called_once_with(["a", "b"], ["1", "2"])
+
+    def test_mget(self):
+        self._kv.mget.return_value = ['1', None]
+        result = self._handler.receive(KVStoreRequest(Action.MGET, ["a", "b"]))
+        self.assertEqual(result, KVStoreResponse(Status.SUCCESS, ['1', None]))
+
+class TestApplyBatch(unittest.TestCase):
+    def setUp(self):
+        self.handler = KVStoreHandler()
+        self.raft = MagicMock()
+        self.raft.config.snapshot_threshold = 10000
+        self.server = KVStoreServer(('localhost', 0), raft=self.raft, handler=self.handler, workers=1)
+
+    def apply(self, items):
+        def drain(max_items):
+            self.server.running = False
+            return items
+        self.raft.get_msgs_to_execute.side_effect = drain
+        self.server.running = True
+        self.server.execute_message()
+
+    def test_ranges_applied_together(self):
+        self.server.applied = MagicMock()
+        self.apply([
+            (1, [str(KVStoreRequest(Action.SET, "a", "1")), None]),
+            (3, [str(KVStoreRequest(Action.SET, "b", "2")), str(KVStoreRequest(Action.DELETE, "a"))])])
+        self.assertEqual(self.handler._kv_storage.kv, {"b": "2"})
+        # published once for the whole batch
+        self.server.applied.advance.assert_called_once_with(4)
+
+    def test_snapshot_replaces_earlier_commands(self):
+        other = KVStoreHandler()
+        other.receive(KVStoreRequest(Action.SET, "c", "3"))
+        self.apply([
+            (1, [str(KVStoreRequest(Action.SET, "a", "1"))]),
+            (5, Snapshot(5, 1, other.snapshot())),
+            (6, [str(KVStoreRequest(Action.SET, "b", "2"))])])
+        self.assertEqual(self.handler._kv_storage.kv, {"c": "3", "b": "2"})
+        self.assertEqual(self.server.applied.index, 6)
+        self.assertEqual(self.server.snapshot_index, 5)
+
+class TestMultiKeyRequest(unittest.TestCase):
+    def test_log_entry_roundtrip(self):
+        for request in (
+                KVStoreRequest(Action.MSET, ["a", "b>c"], ["1", "x y"]),
+                KVStoreRequest(Action.MDELETE, ["a", "b"]),
+                KVStoreRequest(Action.MGET, ["a"])):
+            parsed = KVStoreRequest.from_serialized_msg(str(request))
+            self.assertEqual(str(parsed), str(request))
+            self.assertEqual(parsed.id, request.id)
+
+    def test_build_from_msg(self):
+        request = KVStoreRequest.build_from_msg("mset a 1 b 2")
+        self.assertEqual((request._key, request.value), (["a", "b"], ["1", "2"]))
+        self.assertTrue(KVStoreRequest.build_from_msg("mdelete a b").is_mdelete())
+        with self.assertRaises(ValueError):
+            KVStoreRequest.build_from_msg("mset a 1 b")
+
+    def test_validation(self):
+        with self.assertRaises(ValueError):
+            KVStoreRequest(Action.MSET, ["a", "b"], ["1"])
+        with self.assertRaises(ValueError):
+            KVStoreRequest(Action.MGET, [])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -18,5 +18,11 @@ class TestKVStorage(unittest.TestCase):
         self.store.delete("foo")
         self.assertEqual(self.store.get("foo"), None)
 
+    def test_multi_key(self):
+        self.store.mset(["a", "b"], ["1", "2"])
+        self.assertEqual(self.store.mget(["a", "b", "c"]), ["1", "2", None])
+        self.store.mdelete(["a", "c"])
+        self.assertEqual(self.store.mget(["a", "b"]), [None, "2"])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+import logging
+import logging.handlers
+import os
+import queue
+import tempfile
+from unittest.mock import patch
+
+import library.logging as kv_logging
+from library.logging import get_logger, hot, fields, set_levels, StructuredFormatter, ModuleFileHandler, FieldsQueueHandler
+
+class TestLogging(unittest.TestCase):
+    def test_queue_handler_added_once(self):
+        log = get_logger('test_logging_once')
+        get_logger('test_logging_once')
+        self.assertEqual(len(log.handlers), 1)
+        self.assertIsInstance(log.handlers[0], logging.handlers.QueueHandler)
+
+    def test_levels_from_env_and_runtime(self):
+        with patch.dict(os.environ, {kv_logging.LEVELS_ENV: 'test_logging_env=WARNING'}):
+            log = get_logger('test_logging_env')
+        self.assertFalse(log.isEnabledFor(logging.INFO))
+        set_levels('test_logging_env=DEBUG')
+        self.assertTrue(log.isEnabledFor(logging.DEBUG))
+
+    def test_hot_lines_sampled(self):
+        log = get_logger('test_logging_hot')
+        self.assertTrue(hot(log, 'key', interval=60))
+        self.assertFalse(hot(log, 'key', interval=60))
+        self.assertTrue(hot(log, 'other', interval=60))
+        # below the logger's level nothing is ever emitted
+        self.assertFalse(hot(log, 'debug', logging.DEBUG, interval=60))
+
+    def test_structured_fields_in_module_file(self):
+        record = logging.LogRecord('test_logging_file', logging.INFO, __file__, 1, "commit", None, None)
+        record.__dict__.update(fields(term=3, index=7))
+        with tempfile.TemporaryDirectory() as path, patch.object(kv_logging, 'LOG_DIR', path):
+            handler = ModuleFileHandler()
+            handler.setFormatter(StructuredFormatter('%(message)s'))
+            handler.handle(record)
+            handler.close()
+            with open(os.path.join(path, 'log_test_logging_file.log')) as f:
+                self.assertEqual(f.read(), "commit term=3 index=7\n")
+
+    def test_fields_rendered_when_queued(self):
+        records = queue.SimpleQueue()
+        log = logging.getLogger('test_logging_queued')
+        log.addHandler(FieldsQueueHandler(records))
+        match_index = {1: 3}
+        log.warning("match index", extra=fields(match_index=match_index))
+        match_index[1] = 4
+        self.assertEqual(StructuredFormatter('%(message)s').format(records.get_nowait()), "match index match_index={1: 3}")
+
+if __name__ == '__main__':
+    unittest.main()
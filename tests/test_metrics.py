@@ -0,0 +1,49 @@
+import unittest
+from unittest.mock import MagicMock
+
+from library.metrics import Metrics, Histogram
+from kv_store_server import KVStoreServer
+from raft_handler import RaftHandler
+from schema.raft_state import RaftState
+from schema.raft_log import LogEntry
+from schema.kv_store import KVStoreRequest, Action
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_buckets(self):
+        histogram = Histogram(buckets=(0.001, 0.01))
+        for value in (0.0005, 0.005, 0.005, 1):
+            histogram.observe(value)
+        buckets, total = histogram.snapshot()
+        self.assertEqual(buckets, [(0.001, 1), (0.01, 3), ('+Inf', 4)])
+        self.assertAlmostEqual(total, 1.0105)
+
+    def test_render(self):
+        metrics = Metrics()
+        metrics.stage('apply').observe(0.002)
+        metrics.gauge('kv_queue_depth', 'Items waiting in each queue', lambda: [({'queue': 'kv_outbound'}, 3)])
+        text = metrics.render()
+        self.assertIn('# TYPE kv_stage_seconds histogram', text)
+        self.assertIn('kv_stage_seconds_bucket{stage="apply",le="0.0025"} 1', text)
+        self.assertIn('kv_stage_seconds_count{stage="apply"} 1', text)
+        self.assertIn('kv_queue_depth{queue="kv_outbound"} 3', text)
+
+    def test_replication_lag(self):
+        metrics = Metrics()
+        handler = RaftHandler(RaftState(0, [1, 2]), MagicMock(), metrics=metrics)
+        handler._state._log.logs = [LogEntry(1, "a"), LogEntry(1, "b"), LogEntry(1, "c")]
+        handler._state.become_leader()
+        handler._state.match_index[1] = 3
+        self.assertEqual(handler.replication_lag(), [({'follower': 1}, 0), ({'follower': 2}, 3)])
+        self.assertIn('kv_replication_lag_entries{follower="2"} 3', metrics.render())
+
+    def test_stats_request(self):
+        server = KVStoreServer(('localhost', 0), raft=MagicMock(), handler=MagicMock(), workers=1)
+        server.handle_request(MagicMock(), KVStoreRequest(Action.STATS), received_at=0)
+        _, response, _ = server.outbound_queue.get_nowait()
+        self.assertTrue(response.is_success())
+        self.assertIn('kv_stage_seconds_count{stage="accept"} 1', response.msg)
+        self.assertIn('kv_queue_depth{queue="kv_outbound"} 0', response.msg)
+        server.request_executor.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import unittest
+import asyncio
+import time
+from socket import socket, AF_INET, SOCK_STREAM
+from threading import Thread
+from unittest.mock import MagicMock
+
+from kv_store_server import KVStoreServer, RequestOrder
+from kv_store_async_server import AsyncKVStoreServer
+from kv_store_client import PipelinedKVStoreClient
+from kv_store_async_client import AsyncKVStoreClient
+from kv_store_handler import KVStoreHandler
+from library.messages import send_message, recv_message
+from schema.kv_store import KVStoreRequest, KVStoreResponse, Status, Action, Consistency
+from schema.raft_rpc import ResultState
+
+class SlowHandler(KVStoreHandler):
+    def receive(self, request):
+        if request._key == "slow":
+            time.sleep(0.2)
+        return super().receive(request)
+
+def get(key):
+    return KVStoreRequest(Action.GET, key, consistency=Consistency.ANY)
+
+class TestRequestOrder(unittest.TestCase):
+    def test_writes_in_order_and_reads_see_them(self):
+        handler = KVStoreHandler()
+        raft = MagicMock()
+        raft.redirect_to_leader.return_value = None
+        server = KVStoreServer(('localhost', 0), raft=raft, handler=handler, workers=4)
+        appended = []
+        def log_append(entry, queued):
+            request = KVStoreRequest.from_serialized_msg(entry)
+            if request.value == "1":
+                # the first write is the slowest to reach raft
+                time.sleep(0.1)
+            queued()
+            appended.append(request.value)
+            handler.receive(request)
+            server.applied.advance(len(appended))
+            return ResultState.COMMITED, len(appended)
+        raft.log_append.side_effect = log_append
+        order = RequestOrder()
+        read = get("k")
+        for request in (KVStoreRequest(Action.SET, "k", "1"), KVStoreRequest(Action.SET, "k", "2"), read):
+            server.request_executor.submit(server.handle_request, None, request, None, order.ticket(request))
+        _, response, _ = server.outbound_queue.get(timeout=1)
+        self.assertEqual(response.id, read.id)
+        self.assertEqual(response.msg, "2")
+        self.assertEqual(appended, ["1", "2"])
+        server.request_executor.shutdown()
+
+class TestPipelinedClient(unittest.TestCase):
+
+    SERVER = KVStoreServer
+
+    def setUp(self):
+        handler = SlowHandler()
+        handler.receive(KVStoreRequest(Action.SET, "slow", "1"))
+        handler.receive(KVStoreRequest(Action.SET, "fast", "2"))
+        probe = socket(AF_INET, SOCK_STREAM)
+        probe.bind(('localhost', 0))
+        self.addr = probe.getsockname()
+        probe.close()
+        raft = MagicMock()
+        raft.get_msgs_to_execute.side_effect = lambda max_items: time.sleep(0.01)
+        self.server = self.SERVER(self.addr, raft=raft, handler=handler, workers=4)
+        self.thread = Thread(target=self.server.start)
+        self.thread.start()
+        self.wait_for_server()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join(5)
+
+    def wait_for_server(self):
+        for _ in range(100):
+            sock = socket(AF_INET, SOCK_STREAM)
+            try:
+                sock.connect(self.addr)
+                return
+            except ConnectionRefusedError:
+                time.sleep(0.01)
+            finally:
+                sock.close()
+
+    def test_out_of_order_responses(self):
+        client = PipelinedKVStoreClient(MagicMock(), self.addr)
+        slow = client.submit(get("slow"))
+        fast = client.submit(get("fast"))
+        self.assertEqual(fast.result(1).msg, "2")
+        self.assertFalse(slow.done())
+        self.assertEqual(slow.result(1).msg, "1")
+        client.end()
+
+    def test_many_outstanding(self):
+        client = PipelinedKVStoreClient(MagicMock(), self.addr)
+        futures = [client.submit(get("fast")) for _ in range(200)]
+        self.assertTrue(all(future.result(2).msg == "2" for future in futures))
+        client.end()
+
+    def redirecting_follower(self):
+        """ A follower that redirects the first request and drops the connection without answering the second """
+        follower = socket(AF_INET, SOCK_STREAM)
+        follower.bind(('localhost', 0))
+        follower.listen()
+        def redirect_once():
+            conn, _ = follower.accept()
+            first = KVStoreRequest.deserialize(recv_message(conn))
+            recv_message(conn)
+            response = KVStoreResponse(Status.REDIRECT, "0", first.id)
+            send_message(conn, response.serialize())
+            time.sleep(0.05)
+            conn.close()
+        Thread(target=redirect_once).start()
+        discovery = MagicMock()
+        discovery.get_addr.return_value = self.addr
+        return follower, discovery
+
+    def test_requests_left_on_old_connection_follow_redirect(self):
+        follower, discovery = self.redirecting_follower()
+        client = PipelinedKVStoreClient(discovery, follower.getsockname())
+        futures = [client.submit(get("fast")), client.submit(get("fast"))]
+        self.assertEqual([future.result(2).msg for future in futures], ["2", "2"])
+        client.end()
+        follower.close()
+
+class TestAsyncPipelinedClient(TestPipelinedClient):
+
+    SERVER = AsyncKVStoreServer
+
+    def test_asyncio_client(self):
+        async def run():
+            client = await AsyncKVStoreClient.connect(MagicMock(), self.addr)
+            slow = asyncio.ensure_future(client.send_message(get("slow")))
+            fast = await client.send_message(get("fast"))
+            self.assertFalse(slow.done())
+            responses = await asyncio.gather(slow, *[client.send_message(get("fast")) for _ in range(50)])
+            await client.end()
+            return fast, responses
+        fast, responses = asyncio.run(run())
+        self.assertEqual(fast.msg, "2")
+        self.assertEqual(responses[0].msg, "1")
+        self.assertEqual([response.msg for response in responses[1:]], ["2"] * 50)
+
+    def test_asyncio_requests_left_on_old_connection_follow_redirect(self):
+        follower, discovery = self.redirecting_follower()
+        async def run():
+            client = await AsyncKVStoreClient.connect(discovery, follower.getsockname())
+            responses = await asyncio.wait_for(
+                asyncio.gather(client.send_message(get("fast")), client.send_message(get("fast"))), 2)
+            await client.end()
+            return responses
+        self.assertEqual([response.msg for response in asyncio.run(run())], ["2", "2"])
+        follower.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+import time
+from threading import Thread
+
+from raft_batcher import RaftBatcher
+
+class TestRaftBatcher(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+        self.flushes = []
+
+    def flush(self, commands):
+        # slow enough that later submitters pile up behind the running flush
+        time.sleep(0.01)
+        first_index = len(self.log) + 1
+        self.log.extend(commands)
+        self.flushes.append(len(commands))
+        return first_index
+
+    def submit_concurrently(self, batcher, n):
+        results = {}
+        def submit(command):
+            results[command] = batcher.submit(command)
+        threads = [Thread(target=submit, args=[f"cmd{x}"]) for x in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_commands_share_flushes(self):
+        results = self.submit_concurrently(RaftBatcher(self.flush), 50)
+        self.assertEqual(sorted(results.values()), list(range(1, 51)))
+        for command, index in results.items():
+            self.assertEqual(self.log[index - 1], command)
+        self.assertLess(len(self.flushes), 50)
+
+    def test_window(self):
+        results = self.submit_concurrently(RaftBatcher(self.flush, window=0.2), 20)
+        self.assertEqual(sorted(results.values()), list(range(1, 21)))
+        self.assertEqual(self.flushes, [20])
+
+    def test_max_size(self):
+        self.submit_concurrently(RaftBatcher(self.flush, window=0.2, max_size=5), 20)
+        self.assertEqual(sum(self.flushes), 20)
+        self.assertTrue(all(x <= 5 for x in self.flushes))
+
+    def test_failed_flush(self):
+        batcher = RaftBatcher(lambda commands: None)
+        self.assertIsNone(batcher.submit("cmd"))
+
+if __name__ == '__main__':
+    unittest.main()
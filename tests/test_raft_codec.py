@@ -0,0 +1,48 @@
+import unittest
+from copy import deepcopy
+
+from schema.raft_log import LogEntry
+from schema.raft_rpc import AppendEntries, AppendEntriesResponse, RequestVote, RequestVoteResponse
+from schema.raft_rpc import InstallSnapshot, InstallSnapshotResponse
+
+class TestRaftCodec(unittest.TestCase):
+    def roundtrip(self, msg):
+        raw = msg.serialize()
+        self.assertTrue(type(msg).is_type(raw))
+        decoded = type(msg).deserialize(raw)
+        self.assertEqual(decoded, msg)
+        return decoded
+
+    def test_append_entries(self):
+        entries = [LogEntry(1, "id1>x"), LogEntry(2, None), LogEntry(3, "ünïcode")]
+        decoded = self.roundtrip(AppendEntries(3, 0, 2, 10, 9, entries))
+        self.assertEqual(decoded.entries, entries)
+        self.roundtrip(AppendEntries(1, 4, None, 0, 0, []))
+
+    def test_entries_decoded_lazily(self):
+        raw = AppendEntries(3, 0, 2, 10, 9, [LogEntry(3, "set x")]).serialize()
+        entry = AppendEntries.deserialize(raw).entries[0]
+        self.assertIsInstance(entry.payload(), memoryview)
+        # re-encoding for the log does not need the item
+        self.assertEqual(entry.encode(), LogEntry(3, "set x").encode())
+        self.assertEqual(entry.item, "set x")
+        self.assertEqual(deepcopy(entry), LogEntry(3, "set x"))
+
+    def test_responses(self):
+        self.roundtrip(AppendEntriesResponse(True, 2, 17))
+        self.roundtrip(AppendEntriesResponse(False, 2))
+        self.roundtrip(RequestVoteResponse(1, 5, True))
+        self.roundtrip(RequestVoteResponse(1, 5, False, pre_vote=True))
+
+    def test_request_vote(self):
+        self.roundtrip(RequestVote(5, 3, 12, 4))
+        self.roundtrip(RequestVote(5, 3, 0, None))
+        self.roundtrip(RequestVote(6, 3, 12, 4, pre_vote=True))
+
+    def test_install_snapshot(self):
+        decoded = self.roundtrip(InstallSnapshot(4, 0, 100, 3, 4096, b'chunk', False))
+        self.assertEqual(bytes(decoded.data), b'chunk')
+        self.roundtrip(InstallSnapshotResponse(2, 4, 100, 4101, True))
+
+if __name__ == '__main__':
+    unittest.main()
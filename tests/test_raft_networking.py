@@ -0,0 +1,112 @@
+import unittest
+from socket import socket
+
+from raft_networking import StreamRaftNetworking, Outbox, InboundScheduler, pack, unpack
+from schema.raft_log import LogEntry
+from schema.raft_rpc import AppendEntries, AppendEntriesResponse, RequestVote
+
+def free_port():
+    with socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+def append_entries(term, prev_index, count, commit=0):
+    return AppendEntries(term, 0, term, prev_index, commit, [LogEntry(term, f"cmd{x}") for x in range(count)])
+
+class TestOutbox(unittest.TestCase):
+    def test_newer_append_entries_supersede(self):
+        outbox = Outbox(16)
+        outbox.put(append_entries(1, 0, 0))
+        outbox.put(append_entries(1, 0, 5))
+        outbox.put(append_entries(1, 5, 5))
+        # the heartbeat is replaced, the pipelined batches are both still needed
+        self.assertEqual([(m.prev_index, len(m.entries)) for m in outbox.take()], [(0, 5), (5, 5)])
+        outbox.put(append_entries(1, 0, 5))
+        outbox.put(append_entries(1, 0, 10))
+        outbox.put(append_entries(1, 10, 0, commit=10))
+        self.assertEqual([(m.prev_index, len(m.entries)) for m in outbox.take()], [(0, 10), (10, 0)])
+        self.assertEqual(outbox.superseded, 2)
+
+    def test_bounded_while_peer_is_down(self):
+        outbox = Outbox(4)
+        for n in range(1000):
+            outbox.put(append_entries(1, 0, 0, commit=n))
+            outbox.put(RequestVote(n, 1, 0, 0))
+        msgs = outbox.take()
+        self.assertEqual(len(msgs), 4)
+        # the latest heartbeat survives
+        self.assertEqual(max(m.leader_commit for m in msgs if isinstance(m, AppendEntries)), 999)
+
+    def test_pack_round_trip(self):
+        msgs = [bytes([n % 6]) + b'x' * 1000 for n in range(20)]
+        packets = pack(msgs)
+        self.assertEqual(len(packets), 3)
+        self.assertTrue(all(len(packet) <= 8192 for packet in packets))
+        self.assertEqual([msg for packet in packets for msg in unpack(packet)], msgs)
+        # a single message is sent unchanged
+        self.assertEqual(pack(msgs[:1]), msgs[:1])
+
+    def test_pack_drops_oversized_messages(self):
+        msgs = [b'a' * 100, b'b' * 9000, b'c' * 100]
+        # a datagram would truncate it, it is dropped rather than delivered broken
+        self.assertEqual([msg for packet in pack(msgs) for msg in unpack(packet)], [msgs[0], msgs[2]])
+        self.assertEqual(pack(msgs[1:2]), [])
+
+class TestInboundScheduler(unittest.TestCase):
+    def test_control_first_and_in_order_within_a_class(self):
+        msgs = [
+            append_entries(1, 0, 5).serialize(),
+            AppendEntriesResponse(True, 1, 5, 1).serialize(),
+            append_entries(1, 0, 0).serialize(),
+            append_entries(1, 5, 5).serialize(),
+            RequestVote(2, 1, 0, 0).serialize(),
+        ]
+        inbound = InboundScheduler()
+        for msg in msgs:
+            inbound.put(msg)
+        self.assertEqual(dict(inbound.depths()), {'control': 2, 'responses': 1, 'bulk': 2})
+        self.assertEqual([inbound.get(0) for _ in msgs], [msgs[n] for n in (2, 4, 1, 0, 3)])
+        self.assertIsNone(inbound.get(0))
+
+    def test_fifo_without_priority(self):
+        inbound = InboundScheduler(prioritize=False)
+        msgs = [append_entries(1, 0, 5).serialize(), append_entries(1, 0, 0).serialize()]
+        for msg in msgs:
+            inbound.put(msg)
+        self.assertEqual([inbound.get(0), inbound.get(0)], msgs)
+
+class TestStreamRaftNetworking(unittest.TestCase):
+    def setUp(self):
+        self.addrs = {n: ('localhost', free_port()) for n in range(2)}
+        self.nodes = [self.build(n) for n in range(2)]
+
+    def tearDown(self):
+        for node in self.nodes:
+            node.end()
+
+    def build(self, n):
+        return StreamRaftNetworking(self.addrs[n], {peer: addr for peer, addr in self.addrs.items() if peer != n})
+
+    def test_message_larger_than_a_datagram(self):
+        entries = [LogEntry(1, f"{x:036d}2key{x}>{'v' * 100}") for x in range(1000)]
+        msg = AppendEntries(1, 0, 1, 0, 0, entries)
+        self.nodes[0].send(1, msg)
+        raw = self.nodes[1].receive(timeout=5)
+        self.assertGreater(len(raw), 100000)
+        self.assertEqual(AppendEntries.deserialize(raw), msg)
+
+    def test_reconnects_after_peer_restart(self):
+        self.nodes[0].send(1, AppendEntries(1, 0, 0, 0, 0, []))
+        self.assertIsNotNone(self.nodes[1].receive(timeout=5))
+        self.nodes[1].end()
+        self.nodes[1] = self.build(1)
+        # messages sent while the broken connection is noticed are dropped, raft resends
+        for _ in range(50):
+            self.nodes[0].send(1, AppendEntries(2, 0, 0, 0, 0, []))
+            raw = self.nodes[1].receive(timeout=0.1)
+            if raw is not None:
+                break
+        self.assertEqual(AppendEntries.deserialize(raw).term, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,14 @@
 import unittest
 import time
+from threading import Thread
 from copy import deepcopy
 
 from tests.raft_networking_mock import RaftNetworkingMock
 from raft_handler import RaftHandler
 from schema.raft_state import RaftState
 from schema.raft_log import LogEntry
+from schema.raft_rpc import AppendEntries, AppendEntriesResponse
+from raft_config import RaftConfig
 
 class TestRaftReplication(unittest.TestCase):
 
@@ -85,3 +88,157 @@ class TestRaftReplication(unittest.TestCase):
 
         for handler in self._raft_handlers:
             assert(str(handler._state._log.logs) == str(self.entries))
+
+    def test_conflict_hints_skip_terms(self):
+        leader = self._raft_handlers[0]
+        leader._state.become_leader()
+        follower = self._raft_handlers[1]
+        # diverged after index 4: three entries of a term 2 leader that never committed
+        follower._state._log.logs = deepcopy(self.entries[:4]) + [LogEntry(2, 'stale')] * 3
+        rounds = 0
+        while str(follower._state._log.logs) != str(self.entries):
+            rounds += 1
+            self.assertLessEqual(rounds, 3)
+            leader._state.last_sent.clear()
+            leader.handle_heartbeat()
+            self.step()
+
+    def queued(self, n):
+        return self._raft_networking_lst[n]._msg_queue[n].qsize()
+
+    def test_in_flight_entries_not_resent(self):
+        leader = self._raft_handlers[0]
+        leader._state.become_leader()
+        leader._state.next_index = {1: 6, 2: 9, 3: 3, 4: 8}
+        leader.handle_heartbeat()
+        self.assertEqual([self.queued(n) for n in range(1, 5)], [1, 1, 1, 1])
+
+        # entries in flight are not sent again and the idle follower got a heartbeat moments ago
+        leader.handle_heartbeat()
+        leader.replicate()
+        self.assertEqual([self.queued(n) for n in range(1, 5)], [1, 1, 1, 1])
+
+        self.step()
+        for handler in self._raft_handlers:
+            assert(str(handler._state._log.logs) == str(self.entries))
+        self.assertEqual(leader._state.in_flight, {})
+
+    def test_pipelined_batches(self):
+        leader = self._raft_handlers[0]
+        leader._config = RaftConfig(max_append_entries=2, max_in_flight=3)
+        leader._state.become_leader()
+        leader._state.next_index = {1: 1, 2: 9, 3: 9, 4: 9}
+        self._raft_handlers[1]._state._log.logs = []
+        leader.replicate()
+        self.assertEqual(self.queued(1), 3)
+        self.assertEqual(leader._state.next_index[1], 7)
+        self.assertEqual(len(leader._state.in_flight[1]), 3)
+
+        self.receive(1)
+        self.receive(0)
+        # acknowledgements refill the window with the last batch
+        self.assertEqual(leader._state.match_index[1], 6)
+        self.assertEqual(leader._state.next_index[1], 9)
+        self.receive(1)
+        self.receive(0)
+        assert(str(self._raft_handlers[1]._state._log.logs) == str(self.entries))
+        self.assertNotIn(1, leader._state.in_flight)
+
+    def test_batches_fit_in_a_datagram(self):
+        leader = self._raft_handlers[0]
+        leader._state.become_leader()
+        leader._state._log.logs = deepcopy(self.entries) + [LogEntry(3, 'v' * 500) for _ in range(40)]
+        leader._state.next_index = {1: 1, 2: 9, 3: 9, 4: 9}
+        self._raft_handlers[1]._state._log.logs = []
+        leader.replicate()
+        queue = self._raft_networking_lst[1]._msg_queue[1]
+        sent = [queue.get() for _ in range(queue.qsize())]
+        self.assertGreater(len(sent), 1)
+        self.assertTrue(all(len(msg) <= 8192 for msg in sent))
+        for msg in sent:
+            self._raft_handlers[1].receive(msg)
+        self.assertEqual(self._raft_handlers[1]._state.log.size(), leader._state.log.size())
+
+    def test_stalled_follower_gets_heartbeat_it_can_accept(self):
+        leader = self._raft_handlers[0]
+        leader._config = RaftConfig(max_append_entries=1, max_in_flight=2, replication_timeout=0)
+        leader._state.become_leader()
+        leader._state.next_index = {1: 6, 2: 9, 3: 9, 4: 9}
+        leader.replicate()
+        # no response in time: the batches from 5 are sent again behind a heartbeat at index 5
+        leader.handle_heartbeat()
+        queue = self._raft_networking_lst[1]._msg_queue[1]
+        sent = [AppendEntries.deserialize(queue.get()) for _ in range(queue.qsize())]
+        heartbeats = [msg for msg in sent[2:] if not msg.entries]
+        self.assertEqual([msg.prev_index for msg in heartbeats], [5])
+        # handled ahead of the entries it is accepted
+        self._raft_handlers[1].receive(heartbeats[0].serialize())
+        response = AppendEntriesResponse.deserialize(self._raft_networking_lst[0].receive())
+        self.assertTrue(response.success)
+
+    def test_pipeline_rewinds_on_rejection(self):
+        leader = self._raft_handlers[0]
+        leader._config = RaftConfig(max_append_entries=1, max_in_flight=3)
+        leader._state.become_leader()
+        leader._state.next_index = {1: 7, 2: 9, 3: 9, 4: 9}
+        leader.replicate()
+        self.assertEqual(leader._state.next_index[1], 9)
+        # follower 1 only holds 5 entries, the first batch is rejected
+        self.receive(1)
+        self._raft_handlers[0].receive(self._raft_networking_lst[0].receive())
+        self.assertEqual(leader._state.next_index[1], 6)
+        self.assertNotIn(1, leader._state.in_flight)
+
+    def test_stale_rejections_ignored_after_rewind(self):
+        leader = self._raft_handlers[0]
+        leader._config = RaftConfig(max_append_entries=1, max_in_flight=3)
+        leader._state.become_leader()
+        leader._state.next_index = {1: 6, 2: 9, 3: 9, 4: 9}
+        self._raft_handlers[1]._state._log.logs = deepcopy(self.entries[:4])
+        leader.replicate()
+        # follower 1 only holds 4 entries and rejects all three batches
+        self.receive(1)
+        self.assertEqual(self.queued(0), 3)
+        leader.receive(self._raft_networking_lst[0].receive())
+        self.assertEqual(leader._state.next_index[1], 5)
+        leader.replicate()
+        window = list(leader._state.in_flight[1])
+        self.assertEqual(leader._state.next_index[1], 8)
+        # the other two rejections answer batches sent before the rewind
+        leader.receive(self._raft_networking_lst[0].receive())
+        leader.receive(self._raft_networking_lst[0].receive())
+        self.assertEqual(list(leader._state.in_flight[1]), window)
+        self.assertEqual(leader._state.next_index[1], 8)
+        for _ in range(2):
+            self.receive(1)
+            self.receive(0)
+        assert(str(self._raft_handlers[1]._state._log.logs) == str(self.entries))
+
+    def test_step_down_waits_for_append(self):
+        leader = self._raft_handlers[0]
+        leader._state.become_leader()
+        # an append in progress holds the log lock, the leader cannot leave its term under it
+        with leader._log_lock:
+            thread = Thread(target=leader._term_check, args=[4])
+            thread.start()
+            thread.join(0.1)
+            self.assertTrue(leader._state.is_leader())
+            self.assertEqual(leader._state.current_term, 3)
+        thread.join()
+        self.assertTrue(leader._state.is_follower())
+        self.assertEqual(leader._state.current_term, 4)
+        self.assertIsNone(leader.flush_batch(['z<1']))
+
+    def test_appends_replicated_from_loop(self):
+        leader = self._raft_handlers[0]
+        leader._state.become_leader()
+        wakes = []
+        leader.set_wake(lambda: wakes.append(1))
+        leader.log_append('z<1')
+        # the client thread only appended and woke the loop
+        self.assertEqual(leader._state.log.size(), len(self.entries) + 1)
+        self.assertEqual(wakes, [1])
+        self.assertEqual([self.queued(n) for n in range(1, self.CLUSTER_SIZE)], [0] * 4)
+        leader.run_pending()
+        self.assertEqual([self.queued(n) for n in range(1, self.CLUSTER_SIZE)], [1] * 4)
+
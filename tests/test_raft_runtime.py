@@ -5,6 +5,7 @@ import uuid
 from tests.raft_networking_mock import RaftNetworkingMock
 from raft_runtime import RaftRuntime
 from raft_handler import RaftHandler
+from schema.raft_rpc import AppendEntries, ResultState
 
 class TestRaftRuntime(unittest.TestCase):
 
@@ -52,6 +53,38 @@ class TestRaftRuntime(unittest.TestCase):
             'RaftState(_commit_index=2, _current_term=1, _implicit_leader=0, _last_applied=0, _log=[1>' + id + 'test,1>' + id2 + 'test], _match_index={}, _next_index={}, _node_num=1, _peers=[0, 2, 3, 4], _received_votes_from=set(), _status=Status.FOLLOWER, _voted_for=None, )'
         )
 
+    def test_elects_leader_without_polling(self):
+        for runtime in self.raft_runtimes:
+            runtime.start()
+        for _ in range(100):
+            leaders = [runtime for runtime in self.raft_runtimes if runtime._raft_handler._state.is_leader()]
+            if leaders:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(leaders), 1)
+        id = str(uuid.uuid4())
+        _, index = leaders[0]._raft_handler.log_append(id + "test")
+        # the new leader's no-op went first
+        self.assertEqual(index, 2)
+        self.assertEqual(leaders[0]._raft_handler._state.commit_index, 2)
+
+    def test_malformed_messages_dropped(self):
+        heartbeat = AppendEntries(term=1, leader_id=1, prev_term=None, prev_index=0, leader_commit=0, entries=[]).serialize()
+        for runtime in self.raft_runtimes:
+            networking = runtime._raft_networking
+            networking._msg_queue[networking._node_num].put(heartbeat[:len(heartbeat) // 2])
+            networking._msg_queue[networking._node_num].put(b'\xff')
+            runtime.start()
+        # every loop survived: a leader is elected and commits
+        for _ in range(100):
+            leaders = [runtime for runtime in self.raft_runtimes if runtime._raft_handler._state.is_leader()]
+            if leaders:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(leaders), 1)
+        result, _ = leaders[0]._raft_handler.log_append(str(uuid.uuid4()) + "test")
+        self.assertEqual(result, ResultState.COMMITED)
+
     def tearDown(self):
         for runtime in self.raft_runtimes:
             runtime.stop()
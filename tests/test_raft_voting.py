@@ -5,6 +5,7 @@ from tests.raft_networking_mock import RaftNetworkingMock
 from raft_handler import RaftHandler
 from schema.raft_state import RaftState
 from schema.raft_log import LogEntry
+from raft_config import RaftConfig
 
 class TestRaftVoting(unittest.TestCase):
 
@@ -79,3 +80,24 @@ class TestRaftVoting(unittest.TestCase):
         self.step()
         assert(self._raft_handlers[4]._state.is_leader())
         assert(self._raft_handlers[4]._state._received_votes_from == set([1,3]))
+
+    def test_pre_vote(self):
+        for handler in self._raft_handlers:
+            handler._config = RaftConfig(pre_vote=True)
+        # node 3's log is behind, no one would vote for it so no term moves
+        self._raft_handlers[3].request_pre_vote()
+        self.step()
+        assert(self._raft_handlers[3]._state.is_follower())
+        self.assertEqual([handler._state.current_term for handler in self._raft_handlers], [3] * self.CLUSTER_SIZE)
+
+        self._raft_handlers[0].request_pre_vote()
+        self.step()
+        self.step()
+        assert(self._raft_handlers[0]._state.is_leader())
+        self.assertEqual(self._raft_handlers[0]._state.current_term, 4)
+
+        # the followers just heard from the leader
+        self._raft_handlers[2].request_pre_vote()
+        self.step()
+        assert(self._raft_handlers[0]._state.is_leader())
+        self.assertEqual([handler._state.current_term for handler in self._raft_handlers], [4] * self.CLUSTER_SIZE)
@@ -0,0 +1,159 @@
+import unittest
+import time
+from threading import Thread
+
+from tests.raft_networking_mock import RaftNetworkingMock
+from raft_config import RaftConfig
+from raft_handler import RaftHandler
+from schema.raft_state import RaftState
+from schema.raft_log import LogEntry
+from schema.raft_rpc import RequestVote
+
+class TestReadIndex(unittest.TestCase):
+
+    CLUSTER_SIZE = 3
+    CONFIG = None
+
+    def setUp(self):
+        self._raft_networking_lst = RaftNetworkingMock.init_n_servers(self.CLUSTER_SIZE)
+        self._raft_handlers = []
+        self.probes = []
+        for server, raft_networking in enumerate(self._raft_networking_lst):
+            peers = [peer for peer in range(self.CLUSTER_SIZE) if peer != server]
+            state = RaftState(server, peers)
+            self._raft_handlers.append(
+                RaftHandler(state, send_message_callback=raft_networking.send, config=self.CONFIG))
+        self.leader = self._raft_handlers[0]
+        self.leader._state.become_leader()
+        # count confirmation rounds
+        probe = self.leader._reads._probe_callback
+        def counting_probe():
+            result = probe()
+            self.probes.append(result[2])
+            return result
+        self.leader._reads._probe_callback = counting_probe
+
+    def step(self, nodes=None):
+        for n in nodes if nodes is not None else range(self.CLUSTER_SIZE):
+            while not self._raft_networking_lst[n].inbound_queue_empty():
+                self._raft_handlers[n].receive(self._raft_networking_lst[n].receive())
+
+    def read_concurrently(self, n, nodes=None):
+        results = []
+        threads = [Thread(target=lambda: results.append(self.leader.read_index(1))) for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            self.step(nodes)
+            time.sleep(0.001)
+        return results
+
+    def test_read_commits_entry_from_current_term(self):
+        self.assertEqual(self.read_concurrently(1), [1])
+        # the no-op makes the leader's commit index current before it is trusted
+        self.assertEqual(self.leader._state.log.logs, [LogEntry(1, None)])
+        self.assertEqual(self.leader._state.commit_index, 1)
+
+    def test_reads_share_one_noop(self):
+        self.assertEqual(self.read_concurrently(20), [1] * 20)
+        self.assertEqual(self.leader._state.log.logs, [LogEntry(1, None)])
+
+    def test_elected_leader_appends_noop(self):
+        candidate = self._raft_handlers[1]
+        candidate._state.become_candidate()
+        candidate._state.received_votes_from.add(2)
+        candidate._count_votes()
+        self.assertTrue(candidate._state.is_leader())
+        self.assertEqual(candidate._state.log.logs, [LogEntry(2, None)])
+        self.leader = candidate
+        self.assertEqual(self.read_concurrently(1), [1])
+        self.assertEqual(candidate._state.log.logs, [LogEntry(2, None)])
+
+    def test_read_index_is_commit_index(self):
+        self.leader._state._log.logs = [LogEntry(1, "a"), LogEntry(1, "b")]
+        self.leader._state.commit_index = 2
+        self.assertEqual(self.read_concurrently(1), [2])
+        self.assertEqual(self.leader._state.log.size(), 2)
+
+    def test_concurrent_reads_share_rounds(self):
+        self.leader._state._log.logs = [LogEntry(1, "a")]
+        self.leader._state.commit_index = 1
+        self.assertEqual(self.read_concurrently(50), [1] * 50)
+        self.assertLess(len(self.probes), 50)
+
+    def test_minority_cannot_confirm(self):
+        self.leader._state._log.logs = [LogEntry(1, "a")]
+        self.leader._state.commit_index = 1
+        # a leader that cannot reach its followers must not serve reads
+        self.assertEqual(self.read_concurrently(1, nodes=[0]), [None])
+
+    def test_deposed_leader_fails_reads(self):
+        self.leader._state._log.logs = [LogEntry(1, "a")]
+        self.leader._state.commit_index = 1
+        for n in (1, 2):
+            self._raft_handlers[n]._state.current_term = 2
+        self.assertEqual(self.read_concurrently(1), [None])
+        self.assertTrue(self.leader._state.is_follower())
+        self.assertEqual(self.leader._state.current_term, 2)
+
+    def test_follower_does_not_serve_reads(self):
+        self.assertIsNone(self._raft_handlers[1].read_index(1))
+
+    def test_probes_sent_from_loop(self):
+        self.leader._state._log.logs = [LogEntry(1, "a")]
+        self.leader._state.commit_index = 1
+        wakes = []
+        self.leader.set_wake(lambda: wakes.append(1))
+        results = []
+        thread = Thread(target=lambda: results.append(self.leader.read_index(1)))
+        thread.start()
+        while not wakes:
+            time.sleep(0.001)
+        # the reader queued its read and woke the loop, it did not probe
+        self.assertEqual(self.probes, [])
+        while thread.is_alive():
+            self.leader.run_pending()
+            self.step()
+            time.sleep(0.001)
+        self.assertEqual(results, [1])
+        self.assertEqual(len(self.probes), 1)
+
+
+class TestLeaseReads(TestReadIndex):
+
+    CONFIG = RaftConfig(lease_reads=True)
+
+    def heartbeat(self):
+        self.leader.handle_heartbeat()
+        self.step()
+        self.step()
+
+    def test_reads_within_lease_skip_confirmation(self):
+        self.leader._state._log.logs = [LogEntry(1, "a")]
+        self.leader._state.commit_index = 1
+        self.heartbeat()
+        self.assertTrue(self.leader.lease_valid(time.perf_counter()))
+        self.assertEqual([self.leader.read_index(1) for _ in range(10)], [1] * 10)
+        self.assertEqual(self.probes, [])
+
+    def test_expired_lease_falls_back_to_read_index(self):
+        self.leader._state._log.logs = [LogEntry(1, "a")]
+        self.leader._state.commit_index = 1
+        self.heartbeat()
+        time.sleep(self.leader.lease_duration())
+        self.assertFalse(self.leader.lease_valid(time.perf_counter()))
+        self.assertEqual(self.read_concurrently(1), [1])
+        self.assertEqual(len(self.probes), 1)
+
+    def test_follower_ignores_votes_while_leader_alive(self):
+        self.heartbeat()
+        follower = self._raft_handlers[1]
+        follower.handle_request_vote(RequestVote(term=2, candidate_id=2, last_log_index=5, last_log_term=1))
+        self.assertEqual(follower._state.current_term, 1)
+        self.assertIsNone(follower._state.voted_for)
+        time.sleep(follower._state.ELECTION_TIMEOUT_MIN)
+        follower.handle_request_vote(RequestVote(term=2, candidate_id=2, last_log_index=5, last_log_term=1))
+        self.assertEqual(follower._state.voted_for, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import unittest
+import tempfile
+
+from tests.raft_networking_mock import RaftNetworkingMock
+from raft_core import RaftCore
+from raft_config import RaftConfig
+from raft_handler import RaftHandler
+from schema.raft_state import RaftState
+from schema.raft_log import LogEntry, Logs, Snapshot
+
+class TestLogCompaction(unittest.TestCase):
+    def setUp(self):
+        self.log = Logs([LogEntry(1, "a"), LogEntry(1, "b"), LogEntry(2, "c"), LogEntry(2, "d")])
+
+    def test_compact(self):
+        self.log.compact(2, 1)
+        self.assertEqual(self.log.size(), 4)
+        self.assertEqual(self.log.term_at(2), 1)
+        self.assertEqual(self.log.get(3), LogEntry(2, "c"))
+        self.assertEqual(self.log.get_n(3, 5), [LogEntry(2, "c"), LogEntry(2, "d")])
+
+    def test_compact_past_log(self):
+        self.log.compact(10, 3)
+        self.assertEqual(self.log.size(), 10)
+        self.assertEqual(self.log.get_last_term(), 3)
+
+    def test_append_entries_behind_snapshot(self):
+        self.log.compact(3, 2)
+        self.assertEqual(
+            RaftCore.append_entries(self.log, 1, 1, [LogEntry(1, "b"), LogEntry(2, "c"), LogEntry(2, "d"), LogEntry(2, "e")]),
+            True)
+        self.assertEqual(self.log.size(), 5)
+        self.assertEqual(RaftCore.append_entries(self.log, 1, 1, [LogEntry(1, "b")]), True)
+        self.assertEqual(self.log.size(), 5)
+
+class TestInstallSnapshot(unittest.TestCase):
+
+    CLUSTER_SIZE = 3
+
+    def setUp(self):
+        self._raft_networking_lst = RaftNetworkingMock.init_n_servers(self.CLUSTER_SIZE)
+        self._raft_handlers = []
+        self.installed = {n: [] for n in range(self.CLUSTER_SIZE)}
+        self.executed = {n: [] for n in range(self.CLUSTER_SIZE)}
+        config = RaftConfig(snapshot_chunk_size=4)
+        for server, raft_networking in enumerate(self._raft_networking_lst):
+            peers = [peer for peer in range(self.CLUSTER_SIZE) if peer != server]
+            state = RaftState(server, peers)
+            state.current_term = 2
+            self._raft_handlers.append(
+                RaftHandler(
+                    state,
+                    send_message_callback=raft_networking.send,
+                    execute_message_callback=lambda idx, cmds, n=server: self.executed[n].append((idx, cmds)),
+                    config=config,
+                    install_snapshot_callback=self.installed[server].append))
+
+    def receive(self, n):
+        while not self._raft_networking_lst[n].inbound_queue_empty():
+            self._raft_handlers[n].receive(self._raft_networking_lst[n].receive())
+
+    def step(self):
+        for n in range(self.CLUSTER_SIZE):
+            self.receive(n)
+
+    def test_lagging_follower_receives_snapshot(self):
+        leader = self._raft_handlers[0]
+        leader._state._log.logs = [LogEntry(1, "a"), LogEntry(1, "b"), LogEntry(2, "c"), LogEntry(2, "d")]
+        leader._state.commit_index = 3
+        leader._state.last_applied = 3
+        leader.compact(3, b'state machine image')
+        self.assertEqual(leader._state.log.logs, [LogEntry(2, "d")])
+
+        leader._state.become_leader()
+        leader._state.next_index = {1: 1, 2: 1}
+        leader.handle_heartbeat()
+        for _ in range(20):
+            self.step()
+
+        for n in (1, 2):
+            follower = self._raft_handlers[n]
+            self.assertEqual(self.installed[n], [Snapshot(3, 2, b'state machine image')])
+            self.assertEqual(follower._state.log.snapshot_index, 3)
+            self.assertEqual(follower._state.last_applied, 3)
+            # entries past the snapshot follow as soon as the install is acknowledged
+            self.assertEqual(follower._state.log.logs, [LogEntry(2, "d")])
+            self.assertEqual(leader._state.match_index[n], 4)
+        self.assertEqual(leader._state.commit_index, 4)
+
+    def test_compact_requires_commit(self):
+        leader = self._raft_handlers[0]
+        leader._state._log.logs = [LogEntry(1, "a"), LogEntry(1, "b")]
+        leader._state.commit_index = 1
+        leader.compact(2, b'x')
+        self.assertIsNone(leader._state.snapshot)
+
+    def test_snapshot_written_outside_log_lock(self):
+        leader = self._raft_handlers[0]
+        leader._state._log.logs = [LogEntry(1, "a"), LogEntry(1, "b")]
+        leader._state.commit_index = 2
+        locked = []
+        write = leader._state.write_snapshot
+        def observing_write(snapshot):
+            locked.append(leader._log_lock.locked())
+            write(snapshot)
+        leader._state.write_snapshot = observing_write
+        leader.compact(2, b'x')
+        self.assertEqual(locked, [False])
+        self.assertEqual(leader._state.snapshot, Snapshot(2, 1, b'x'))
+        self.assertEqual(leader._state.log.snapshot_index, 2)
+
+class TestDurableSnapshot(unittest.TestCase):
+    def test_restart_from_snapshot(self):
+        with tempfile.TemporaryDirectory() as path:
+            state = RaftState.open(0, [1, 2], path, segment_size=64)
+            RaftCore.append_entries(state.log, 0, None, [LogEntry(1, str(x)) for x in range(20)])
+            state.save_snapshot(Snapshot(15, 1, b'image'))
+            state.close()
+
+            state = RaftState.open(0, [1, 2], path, segment_size=64)
+            self.assertEqual(state.snapshot, Snapshot(15, 1, b'image'))
+            self.assertEqual(state.commit_index, 15)
+            self.assertEqual(state.log.size(), 20)
+            self.assertEqual(state.log.get(16), LogEntry(1, "15"))
+            RaftCore.append_entries(state.log, 20, 1, [LogEntry(2, "new")])
+            state.close()
+
+            state = RaftState.open(0, [1, 2], path, segment_size=64)
+            self.assertEqual(state.log.size(), 21)
+            state.close()
+
+
+    def crash_before_compacting(self, path, snapshot):
+        state = RaftState.open(0, [1, 2], path, segment_size=64)
+        RaftCore.append_entries(state.log, 0, None, [LogEntry(1, str(x)) for x in range(10)])
+        # the snapshot is durable, the node dies before the log is compacted
+        state.write_snapshot(snapshot)
+        state.close()
+        return RaftState.open(0, [1, 2], path, segment_size=64)
+
+    def test_restart_with_snapshot_past_log(self):
+        with tempfile.TemporaryDirectory() as path:
+            state = self.crash_before_compacting(path, Snapshot(15, 2, b'image'))
+            self.assertEqual((state.log.snapshot_index, state.log.size()), (15, 15))
+            RaftCore.append_entries(state.log, 15, 2, [LogEntry(2, "new")])
+            state.close()
+            state = RaftState.open(0, [1, 2], path, segment_size=64)
+            self.assertEqual(state.log.get(16), LogEntry(2, "new"))
+            state.close()
+
+    def test_restart_with_snapshot_of_other_term(self):
+        with tempfile.TemporaryDirectory() as path:
+            state = self.crash_before_compacting(path, Snapshot(5, 2, b'image'))
+            # entries after 5 came from a history the snapshot replaced
+            self.assertEqual(state.log.size(), 5)
+            RaftCore.append_entries(state.log, 5, 2, [LogEntry(2, "new")])
+            self.assertEqual(state.log.get(6), LogEntry(2, "new"))
+            state.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,9 @@
 import unittest
 from raft_core import RaftCore
+from schema.raft_log import LogEntry, Logs
+
+def log_of_terms(*terms):
+    return Logs([LogEntry(term, str(idx)) for idx, term in enumerate(terms)])
 
 class TestStepBackIndex(unittest.TestCase):
     def test_step_back_index(self):
@@ -37,3 +41,31 @@ class TestStepBackIndex(unittest.TestCase):
         RaftCore.step_back_index(1, next_index, match_index)
         self.assertEqual(next_index[1], 1)
         self.assertEqual(match_index[1], 0)
+
+class TestConflictHints(unittest.TestCase):
+    def test_find_conflict_past_log(self):
+        self.assertEqual(RaftCore.find_conflict(log_of_terms(1, 1, 2), 7), (None, 4))
+
+    def test_find_conflict_first_index_of_term(self):
+        self.assertEqual(RaftCore.find_conflict(log_of_terms(1, 1, 2, 2, 2, 2), 5), (2, 3))
+        self.assertEqual(RaftCore.find_conflict(log_of_terms(2, 2), 2), (2, 1))
+
+    def test_next_index_from_conflict(self):
+        leader_log = log_of_terms(1, 1, 1, 2, 3, 3, 3, 3)
+        # leader holds term 2 up to index 4
+        self.assertEqual(RaftCore.next_index_from_conflict(leader_log, 2, 4), 5)
+        # leader has no entry of term 4, skip the follower's whole term
+        self.assertEqual(RaftCore.next_index_from_conflict(log_of_terms(1, 1, 5), 4, 3), 3)
+        self.assertEqual(RaftCore.next_index_from_conflict(leader_log, None, 3), 3)
+
+    def test_conflict_hints_after_compaction(self):
+        # entries 1..3 of term 2 are in the snapshot, the log keeps 4..6
+        log = Logs([LogEntry(2, '4'), LogEntry(3, '5'), LogEntry(3, '6')], snapshot_index=3, snapshot_term=2)
+        self.assertEqual(RaftCore.find_conflict(log, 4), (2, 4))
+        self.assertEqual(RaftCore.find_conflict(log, 6), (3, 5))
+        self.assertEqual(RaftCore.next_index_from_conflict(log, 2, 2), 5)
+        # term 1 only lives in the snapshot
+        self.assertEqual(RaftCore.next_index_from_conflict(log, 1, 2), 2)
+
+if __name__ == '__main__':
+    unittest.main()
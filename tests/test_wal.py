@@ -0,0 +1,172 @@
+import unittest
+import os
+import tempfile
+from threading import Thread
+
+from raft_core import RaftCore
+from library.wal import WriteAheadLog, HardState
+from schema.raft_log import DurableLogs, LogEntry, Logs
+from schema.raft_state import RaftState
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = self.dir.name
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def reopen(self, wal, segment_size=None):
+        wal.close()
+        wal = WriteAheadLog(self.path, segment_size)
+        return wal, wal.replay()
+
+    def test_replay(self):
+        wal = WriteAheadLog(self.path)
+        wal.replay()
+        for idx in range(1, 4):
+            wal.append(idx, b'x%d' % idx)
+        wal.sync()
+        wal, records = self.reopen(wal)
+        self.assertEqual(records, [(1, b'x1'), (2, b'x2'), (3, b'x3')])
+        wal.close()
+
+    def test_segment_rotation(self):
+        wal = WriteAheadLog(self.path, segment_size=40)
+        wal.replay()
+        for idx in range(1, 11):
+            wal.append(idx, b'payload')
+        self.assertGreater(len(os.listdir(self.path)), 1)
+        wal, records = self.reopen(wal, segment_size=40)
+        self.assertEqual([x[0] for x in records], list(range(1, 11)))
+        wal.close()
+
+    def test_truncate(self):
+        wal = WriteAheadLog(self.path, segment_size=40)
+        wal.replay()
+        for idx in range(1, 11):
+            wal.append(idx, b'payload')
+        wal.truncate(4)
+        wal.append(4, b'new')
+        wal, records = self.reopen(wal, segment_size=40)
+        self.assertEqual([x[0] for x in records], [1, 2, 3, 4])
+        self.assertEqual(records[-1][1], b'new')
+        wal.close()
+
+    def test_torn_tail(self):
+        wal = WriteAheadLog(self.path)
+        wal.replay()
+        wal.append(1, b'first')
+        wal.append(2, b'second')
+        wal.close()
+        segment = os.path.join(self.path, WriteAheadLog.segment_name(1))
+        os.truncate(segment, os.path.getsize(segment) - 3)
+        wal = WriteAheadLog(self.path)
+        self.assertEqual(wal.replay(), [(1, b'first')])
+        wal.append(2, b'again')
+        wal, records = self.reopen(wal)
+        self.assertEqual(records, [(1, b'first'), (2, b'again')])
+        wal.close()
+
+    def test_corrupt_record(self):
+        wal = WriteAheadLog(self.path)
+        wal.replay()
+        wal.append(1, b'first')
+        wal.append(2, b'second')
+        wal.close()
+        segment = os.path.join(self.path, WriteAheadLog.segment_name(1))
+        with open(segment, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'!')
+        wal = WriteAheadLog(self.path)
+        self.assertEqual(wal.replay(), [(1, b'first')])
+        wal.close()
+
+    def test_group_commit(self):
+        wal = WriteAheadLog(self.path)
+        wal.replay()
+        for idx in range(1, 51):
+            wal.append(idx, b'x')
+        fsyncs = []
+        original_fsync = os.fsync
+        def counting_fsync(fd):
+            fsyncs.append(fd)
+            original_fsync(fd)
+        os.fsync = counting_fsync
+        try:
+            threads = [Thread(target=wal.sync) for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            os.fsync = original_fsync
+        self.assertEqual(len(fsyncs), 1)
+        wal.close()
+
+class TestDurableLogs(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def open(self):
+        return DurableLogs(WriteAheadLog(self.dir.name))
+
+    def test_append_entries_survives_restart(self):
+        log = self.open()
+        RaftCore.append_entries(log, 0, None, [LogEntry(1, "a"), LogEntry(1, "b"), LogEntry(2, "c")])
+        # conflicting suffix from a new leader
+        RaftCore.append_entries(log, 2, 1, [LogEntry(3, "d")])
+        log.close()
+        log = self.open()
+        self.assertEqual(log, Logs([LogEntry(1, "a"), LogEntry(1, "b"), LogEntry(3, "d")]))
+        log.close()
+
+    def test_idempotent_add(self):
+        log = self.open()
+        entries = [LogEntry(1, "a"), LogEntry(1, "b")]
+        RaftCore.append_entries(log, 0, None, entries)
+        RaftCore.append_entries(log, 0, None, entries)
+        self.assertEqual(log.size(), 2)
+        log.close()
+        log = self.open()
+        self.assertEqual(log.size(), 2)
+        log.close()
+
+class TestHardState(unittest.TestCase):
+    def test_state_persists_term_and_vote(self):
+        with tempfile.TemporaryDirectory() as path:
+            state = RaftState.open(0, [1, 2], path)
+            state.become_candidate()
+            RaftCore.append_entries(state.log, 0, None, [LogEntry(state.current_term, "a")])
+            state.close()
+            state = RaftState.open(0, [1, 2], path)
+            self.assertEqual(state.current_term, 2)
+            self.assertEqual(state.voted_for, 0)
+            self.assertEqual(state.log.size(), 1)
+            state.close()
+            self.assertEqual(HardState(path).load(), (2, 0))
+
+    def test_term_and_vote_saved_together(self):
+        with tempfile.TemporaryDirectory() as path:
+            state = RaftState.open(0, [1, 2], path)
+            state.voted_for = 1
+            saves = []
+            save = state._hard_state.save
+            def recording_save(term, voted_for):
+                saves.append((term, voted_for))
+                save(term, voted_for)
+            state._hard_state.save = recording_save
+            state.become_follower(3)
+            state.become_candidate()
+            state.close()
+            # one write per transition, a crash between writes never pairs a term with another term's vote
+            self.assertEqual(saves, [(3, None), (4, 0)])
+            state = RaftState.open(0, [1, 2], path)
+            self.assertEqual((state.current_term, state.voted_for), (4, 0))
+            state.close()
+
+if __name__ == '__main__':
+    unittest.main()